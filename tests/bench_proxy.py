@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# flake8: noqa: E402
+
+'''
+End-to-end benchmark of the proxy, without a browser. Starts websockify
+with a local TCP target and drives a number of concurrent WebSocket
+clients through it.
+
+The target behaves a bit like a VNC server. Each client first asks it
+for a stream of data (like framebuffer updates), which measures
+throughput. Then it sends small messages that the target echoes back
+(like input events), which measures latency.
+
+Reports throughput, p50/p99 round trip latency, proxy CPU time per
+byte and proxy memory per connection. CPU and memory are read from
+/proc, so those are only available on Linux. Extra options for
+websockify can be given after --, e.g.:
+
+    python tests/bench_proxy.py --clients 50 -- --engine asyncio
+'''
+
+import json
+import optparse
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from websockify import websocket
+
+
+class Target:
+    """
+    TCP target that understands two commands:
+
+        'S' + 64-bit count: sends count bytes in chunk sized writes
+        'E' + 16-bit length + data: sends the data back
+    """
+
+    def __init__(self, chunk_size):
+        self.chunk = bytes(range(256)) * (chunk_size // 256 + 1)
+        self.chunk = self.chunk[:chunk_size]
+
+        self.lsock = socket.socket()
+        self.lsock.bind(('127.0.0.1', 0))
+        self.lsock.listen(128)
+        self.port = self.lsock.getsockname()[1]
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            try:
+                sock, _ = self.lsock.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self.serve, args=(sock,),
+                             daemon=True).start()
+
+    def serve(self, sock):
+        reader = sock.makefile('rb')
+        with sock, reader:
+            while True:
+                cmd = reader.read(1)
+                if cmd == b'S':
+                    count, = struct.unpack('>Q', reader.read(8))
+                    while count > 0:
+                        data = self.chunk[:count]
+                        sock.sendall(data)
+                        count -= len(data)
+                elif cmd == b'E':
+                    length, = struct.unpack('>H', reader.read(2))
+                    sock.sendall(reader.read(length))
+                else:
+                    return
+
+
+class Client:
+    def __init__(self, port):
+        self.ws = websocket.WebSocket()
+        self.ws.connect('ws://127.0.0.1:%d/' % port)
+        self.buffer = b''
+        self.latencies = []
+
+    def recv(self, size):
+        # Returns exactly size bytes, which may span messages
+        while len(self.buffer) < size:
+            try:
+                data = self.ws.recv()
+            except websocket.WebSocketWantReadError:
+                continue
+            if data is None:
+                raise Exception("Connection closed: %s" % self.ws.close_reason)
+            self.buffer += data
+        data = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return data
+
+    def throughput(self, count):
+        self.ws.sendmsg(b'S' + struct.pack('>Q', count))
+        while count > 0:
+            count -= len(self.recv(min(count, 1 << 20)))
+
+    def latency(self, messages, size):
+        payload = bytes(size)
+        for i in range(messages):
+            start = time.perf_counter()
+            self.ws.sendmsg(b'E' + struct.pack('>H', size) + payload)
+            self.recv(size)
+            self.latencies.append(time.perf_counter() - start)
+
+    def close(self):
+        self.ws.close()
+
+
+def proc_tree(pid):
+    # Returns the pid and all its descendants
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    pids = [pid]
+    for p in pids:
+        pids.extend(children.get(p, []))
+    return pids
+
+
+def rss(pid):
+    # Total resident memory in bytes for the process tree
+    total = 0
+    for p in proc_tree(pid):
+        try:
+            with open('/proc/%d/status' % p) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+def cpu_time(pid):
+    # CPU seconds used by the process and its reaped and live children
+    ticks = os.sysconf('SC_CLK_TCK')
+    total = 0
+    for i, p in enumerate(proc_tree(pid)):
+        try:
+            with open('/proc/%d/stat' % p) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        # utime, stime, and for the top process cutime, cstime
+        used = int(fields[11]) + int(fields[12])
+        if i == 0:
+            used += int(fields[13]) + int(fields[14])
+        total += used
+    return total / ticks
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def wait_for_port(port, proxy, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proxy.poll() is not None:
+            raise Exception("websockify exited with %d" % proxy.returncode)
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise Exception("websockify did not start")
+
+
+def run_clients(clients, func):
+    # Runs func for every client in parallel and returns the wall time
+    errors = []
+
+    def run(client):
+        try:
+            func(client)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(c,)) for c in clients]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    if errors:
+        raise errors[0]
+    return elapsed
+
+
+def main():
+    usage = "%prog [options] [-- websockify options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("--clients", type=int, default=10,
+                      help="number of concurrent clients")
+    parser.add_option("--bytes", type=int, default=16 << 20,
+                      help="bytes streamed from the target to each client")
+    parser.add_option("--chunk-size", type=int, default=65536,
+                      help="size of the target's writes when streaming")
+    parser.add_option("--messages", type=int, default=1000,
+                      help="messages echoed for each client")
+    parser.add_option("--message-size", type=int, default=16,
+                      help="size of the echoed messages")
+    parser.add_option("--save", metavar="FILE",
+                      help="save the results as JSON")
+    (opts, args) = parser.parse_args()
+
+    target = Target(opts.chunk_size)
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.join(os.path.dirname(__file__), "..")
+    cmd = [sys.executable, '-m', 'websockify',
+           '127.0.0.1:%d' % port, '127.0.0.1:%d' % target.port] + args
+    proxy = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.DEVNULL)
+
+    try:
+        wait_for_port(port, proxy)
+        # Let it settle after the probe connection
+        time.sleep(0.5)
+
+        have_proc = os.path.exists('/proc/%d/stat' % proxy.pid)
+        if have_proc:
+            idle_rss = rss(proxy.pid)
+
+        clients = [Client(port) for i in range(opts.clients)]
+
+        results = {'clients': opts.clients}
+
+        if have_proc:
+            time.sleep(0.5)
+            results['rss_per_connection'] = ((rss(proxy.pid) - idle_rss) /
+                                             opts.clients)
+            cpu_start = cpu_time(proxy.pid)
+
+        elapsed = run_clients(clients,
+                              lambda c: c.throughput(opts.bytes))
+        total = opts.bytes * opts.clients
+        results['throughput'] = total / elapsed
+
+        latency_start = time.perf_counter()
+        run_clients(clients,
+                    lambda c: c.latency(opts.messages, opts.message_size))
+        elapsed += time.perf_counter() - latency_start
+        total += 2 * opts.messages * opts.message_size * opts.clients
+
+        latencies = [lat for c in clients for lat in c.latencies]
+        results['latency_p50'] = percentile(latencies, 0.50)
+        results['latency_p99'] = percentile(latencies, 0.99)
+
+        if have_proc:
+            cpu = cpu_time(proxy.pid) - cpu_start
+            results['cpu_per_byte'] = cpu / total
+            results['cpu_utilisation'] = cpu / elapsed
+
+        for c in clients:
+            c.close()
+    finally:
+        proxy.terminate()
+        proxy.wait()
+
+    print("clients:          %d" % opts.clients)
+    print("throughput:       %.1f MB/s" % (results['throughput'] / 1e6))
+    print("latency p50:      %.3f ms" % (results['latency_p50'] * 1e3))
+    print("latency p99:      %.3f ms" % (results['latency_p99'] * 1e3))
+    if 'cpu_per_byte' in results:
+        print("proxy CPU:        %.2f ns/byte (%.0f%% of a core)" %
+              (results['cpu_per_byte'] * 1e9,
+               results['cpu_utilisation'] * 100))
+        print("proxy RSS:        %.1f KiB/connection" %
+              (results['rss_per_connection'] / 1024))
+
+    if opts.save:
+        with open(opts.save, "w") as f:
+            json.dump({"command": cmd[2:], "results": results}, f,
+                      indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# flake8: noqa: E402
+
+'''
+Microbenchmarks for the WebSocket codec. Synthetic frame streams are
+run through encoding, decoding, masking and message processing, without
+any sockets involved, and the cost is reported as ns/frame and MB/s.
+
+Results can be saved as a baseline with --save and later compared
+against with --baseline, e.g.:
+
+    python tests/bench_websocket.py --save before.json
+    (apply changes)
+    python tests/bench_websocket.py --baseline before.json
+'''
+
+import json
+import optparse
+import os
+import platform
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from websockify import masking
+from websockify import protocol
+from websockify import websocket
+
+
+SIZES = [2, 125, 1024, 16384, 65536, 1048576]
+
+MASK_KEY = b'\x37\xfa\x21\x3d'
+
+# Roughly how much payload each workload contains
+WORKLOAD_BYTES = 1 << 20
+
+
+class FakeSocket:
+    """Socket that returns a fixed stream in reads of up to 64 KiB"""
+
+    def __init__(self, stream):
+        self.stream = memoryview(stream)
+        self.pos = 0
+
+    def recv_into(self, buf, size):
+        count = min(size, len(self.stream) - self.pos, 65536)
+        buf[:count] = self.stream[self.pos:self.pos + count]
+        self.pos += count
+        return count
+
+    def send(self, buf):
+        return len(buf)
+
+
+def frame_count(size):
+    return min(1000, max(1, WORKLOAD_BYTES // size))
+
+
+def make_stream(size, masked, count, fragments=1):
+    # Encodes count messages of size bytes, split in to fragments
+    payload = bytes(range(256)) * (size // 256) + bytes(size % 256)
+    mask_key = MASK_KEY if masked else None
+    chunk = -(-size // fragments)
+
+    frames = []
+    for i in range(fragments):
+        opcode = 0x2 if i == 0 else 0x0
+        fin = i == fragments - 1
+        data = payload[i * chunk:(i + 1) * chunk]
+        frames.append(protocol.encode_frame(opcode, data, mask_key, fin))
+
+    return b''.join(frames) * count
+
+
+def bench_decode(size, masked):
+    count = frame_count(size)
+    stream = make_stream(size, masked, count)
+
+    def run():
+        view = memoryview(bytearray(stream))
+        pos = 0
+        while pos < len(view):
+            pos += protocol.decode_frame(view[pos:]).length
+
+    return run, count, size * count
+
+
+def bench_encode(size, masked):
+    count = frame_count(size)
+    payload = bytes(size)
+
+    def run():
+        proto = protocol.WebSocketProtocol(client=masked)
+        for i in range(count):
+            proto.send_message(payload)
+            bufs = proto.buffers_to_send()
+            proto.data_sent(sum(len(buf) for buf in bufs))
+
+    return run, count, size * count
+
+
+def bench_mask(size):
+    count = frame_count(size)
+    buf = bytearray(size)
+
+    def run():
+        for i in range(count):
+            masking.mask(buf, MASK_KEY)
+
+    return run, count, size * count
+
+
+def bench_protocol(size, fragments):
+    count = frame_count(size)
+    stream = make_stream(size, True, count, fragments)
+
+    def run():
+        proto = protocol.WebSocketProtocol()
+        proto.open()
+        events = proto.feed_data(stream)
+        assert len(events) == count
+
+    return run, count * fragments, size * count
+
+
+def bench_recvmsg(size):
+    count = frame_count(size)
+    stream = make_stream(size, True, count)
+
+    def run():
+        ws = websocket.WebSocket()
+        ws.accept(FakeSocket(stream),
+                  {'upgrade': 'websocket',
+                   'Sec-WebSocket-Version': '13',
+                   'Sec-WebSocket-Key': 'DKURYVK9cRFul1vOZVA56Q=='})
+        received = 0
+        while received < count:
+            try:
+                ws.recvmsg()
+                received += 1
+            except websocket.WebSocketWantReadError:
+                pass
+
+    return run, count, size * count
+
+
+def benchmarks():
+    for size in SIZES:
+        for masked in (False, True):
+            suffix = "masked" if masked else "plain"
+            yield "decode/%d/%s" % (size, suffix), bench_decode(size, masked)
+            yield "encode/%d/%s" % (size, suffix), bench_encode(size, masked)
+        yield "mask/%d" % size, bench_mask(size)
+        yield "protocol/%d" % size, bench_protocol(size, 1)
+        if size >= 1024:
+            yield "protocol/%d/fragmented" % size, bench_protocol(size, 8)
+        yield "recvmsg/%d" % size, bench_recvmsg(size)
+
+
+def measure(func, repeat, min_time):
+    # Returns the best time for a single run of func
+    timer = timeit.Timer(func)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    return min(timer.repeat(repeat, number)) / number
+
+
+def main():
+    usage = "%prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("--filter", default="",
+                      help="only run benchmarks with names containing FILTER")
+    parser.add_option("--repeat", type=int, default=5,
+                      help="number of timing runs, of which the best is used")
+    parser.add_option("--min-time", type=float, default=0.05,
+                      help="minimum seconds for each timing run")
+    parser.add_option("--mask-backend", default="auto",
+                      choices=["auto"] + list(masking.backends),
+                      help="implementation used for WebSocket masking")
+    parser.add_option("--save", metavar="FILE",
+                      help="save the results as a JSON baseline")
+    parser.add_option("--baseline", metavar="FILE",
+                      help="compare against a baseline saved with --save")
+    (opts, args) = parser.parse_args()
+
+    masking.select_backend(opts.mask_backend)
+
+    baseline = {}
+    if opts.baseline:
+        with open(opts.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    print("Python %s, masking: %s" % (platform.python_version(),
+                                      masking.backend()))
+    print("%-28s %12s %10s %10s" % ("benchmark", "ns/frame", "MB/s",
+                                    "change"))
+
+    results = {}
+    for name, (func, frames, size) in benchmarks():
+        if opts.filter not in name:
+            continue
+
+        elapsed = measure(func, opts.repeat, opts.min_time)
+        ns_per_frame = elapsed * 1e9 / frames
+        mb_per_sec = size / elapsed / 1e6
+        results[name] = {"ns_per_frame": ns_per_frame,
+                         "mb_per_sec": mb_per_sec}
+
+        change = ""
+        if name in baseline:
+            before = baseline[name]["ns_per_frame"]
+            change = "%+.1f%%" % ((ns_per_frame - before) * 100 / before)
+
+        print("%-28s %12.1f %10.1f %10s" % (name, ns_per_frame,
+                                            mb_per_sec, change))
+
+    if opts.save:
+        with open(opts.save, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "masking": masking.backend(),
+                       "results": results}, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
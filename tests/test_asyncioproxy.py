@@ -0,0 +1,230 @@
+""" Unit tests for asyncioproxy """
+import asyncio
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import unittest
+from unittest.mock import patch
+
+from websockify import asyncioproxy
+from websockify import websocket
+
+
+class EchoServer:
+    def __init__(self):
+        self.lsock = socket.socket()
+        self.lsock.bind(('127.0.0.1', 0))
+        self.lsock.listen(10)
+        self.port = self.lsock.getsockname()[1]
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            try:
+                sock, _ = self.lsock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.echo, args=(sock,),
+                             daemon=True).start()
+
+    def echo(self, sock):
+        with sock:
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    return
+                sock.sendall(data)
+
+    def close(self):
+        self.lsock.close()
+
+
+class AsyncioProxyServerTestCase(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.target = EchoServer()
+
+        self.server = asyncioproxy.AsyncioProxyServer(
+            listen_host='127.0.0.1', listen_port=0,
+            target_host='127.0.0.1', target_port=self.target.port)
+        lsock = self.server.socket('127.0.0.1', 0)
+        self.port = lsock.getsockname()[1]
+
+        started = threading.Event()
+
+        async def serve():
+            self.loop = asyncio.get_running_loop()
+            started.set()
+            await self.server.serve(lsock)
+
+        def run():
+            try:
+                asyncio.run(serve())
+            finally:
+                lsock.close()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        started.wait()
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.server.stop)
+        self.thread.join(10)
+        self.target.close()
+        super().tearDown()
+
+    def connect(self):
+        ws = websocket.WebSocket()
+        ws.connect('ws://127.0.0.1:%d/' % self.port)
+        return ws
+
+    def recv(self, ws, size):
+        data = b''
+        while len(data) < size:
+            try:
+                data += ws.recvmsg()
+            except websocket.WebSocketWantReadError:
+                pass
+        return data
+
+    def test_refresh_token_plugin(self):
+        release = threading.Event()
+        threads = []
+
+        class TestPlugin:
+            def refresh(self):
+                threads.append(threading.current_thread())
+                release.wait(10)
+
+        self.server.token_plugin = TestPlugin()
+
+        async def refresh():
+            # Neither waits for the refresh, and the second one is
+            # skipped while the first is still going
+            self.server.refresh_token_plugin()
+            self.server.refresh_token_plugin()
+            return threading.current_thread()
+
+        loop_thread = asyncio.run_coroutine_threadsafe(
+            refresh(), self.loop).result(10)
+        release.set()
+
+        async def wait():
+            await self.server._refreshing
+        asyncio.run_coroutine_threadsafe(wait(), self.loop).result(10)
+
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], loop_thread)
+
+    def test_echo(self):
+        clients = [self.connect() for _ in range(3)]
+        for i, ws in enumerate(clients):
+            ws.sendmsg(b'hello %d' % i)
+        for i, ws in enumerate(clients):
+            self.assertEqual(self.recv(ws, 7), b'hello %d' % i)
+
+        # Large enough to fill the socket buffers along the way
+        data = bytes(range(256)) * 8192
+        clients[0].sendmsg(data)
+        self.assertEqual(self.recv(clients[0], len(data)), data)
+
+        for ws in clients:
+            ws.close()
+
+    def test_target_unavailable(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.server.target_port = sock.getsockname()[1]
+
+        ws = self.connect()
+        while True:
+            try:
+                if ws.recvmsg() is None:
+                    break
+            except websocket.WebSocketWantReadError:
+                pass
+        self.assertEqual(ws.close_code, 1011)
+
+    def test_plain_http(self):
+        with socket.create_connection(('127.0.0.1', self.port)) as sock:
+            sock.sendall(b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            response = sock.recv(4096)
+        self.assertTrue(response.startswith(b'HTTP/1.1 405 '))
+
+
+class BufferedWebSocketTestCase(unittest.TestCase):
+    def test_flush(self):
+        class FakeSocket:
+            def __init__(self):
+                self.data = b''
+                self.space = 0
+
+            def send(self, buf):
+                sent = min(len(buf), self.space)
+                self.data += bytes(buf[:sent])
+                self.space -= sent
+                return sent
+
+        sock = FakeSocket()
+        ws = asyncioproxy.BufferedWebSocket(None)
+        ws.socket = sock
+        ws.client = False
+
+        # Nothing is raised when the socket is full
+        self.assertEqual(ws.sendmsg(b'hello'), 5)
+        self.assertEqual(ws.sendmsg(b'world'), 5)
+        self.assertTrue(ws.send_pending())
+        self.assertTrue(ws.flush())
+
+        sock.space = 9
+        self.assertTrue(ws.flush())
+        sock.space = 100
+        self.assertFalse(ws.flush())
+        self.assertEqual(sock.data, b'\x82\x05hello\x82\x05world')
+
+
+class WorkersTestCase(unittest.TestCase):
+    def test_restart_crashed_worker(self):
+        runs = multiprocessing.Array('i', 2)
+
+        class TestServer(asyncioproxy.AsyncioProxyServer):
+            worker_restart_delay = 0
+
+            def run_worker(self, index):
+                runs[index] += 1
+                # The first worker crashes once, then both finish
+                if index == 0 and runs[index] == 1:
+                    os._exit(1)
+
+        server = TestServer(listen_host='127.0.0.1', listen_port=0,
+                            target_host='127.0.0.1', target_port=1,
+                            workers=2)
+        with patch('signal.signal'):
+            server.start_workers()
+
+        self.assertEqual(list(runs), [2, 1])
+
+    def test_restart_failed_worker(self):
+        runs = multiprocessing.Array('i', 1)
+
+        class TestServer(asyncioproxy.AsyncioProxyServer):
+            worker_restart_delay = 0
+
+            def listen_socket(self, reuse_port=False):
+                if self.worker is None:
+                    return super().listen_socket(reuse_port)
+                runs[0] += 1
+                # Fails once, as listen_socket() does, then finishes
+                if runs[0] == 1:
+                    sys.exit()
+                os._exit(0)
+
+        server = TestServer(listen_host='127.0.0.1', listen_port=0,
+                            target_host='127.0.0.1', target_port=1,
+                            workers=1)
+        with patch('signal.signal'):
+            server.start_workers()
+
+        self.assertEqual(runs[0], 2)
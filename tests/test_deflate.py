@@ -0,0 +1,128 @@
+""" Unit tests for permessage-deflate """
+import os
+import unittest
+
+from websockify import deflate
+
+
+class ParseOffersTestCase(unittest.TestCase):
+    def test_parse_offers(self):
+        header = ('x-webkit-deflate-frame, permessage-deflate; '
+                  'client_max_window_bits, permessage-deflate; '
+                  'server_max_window_bits="10"; server_no_context_takeover')
+        self.assertEqual(deflate.parse_offers(header),
+                         [[('client_max_window_bits', None)],
+                          [('server_max_window_bits', '10'),
+                           ('server_no_context_takeover', None)]])
+        self.assertEqual(deflate.parse_offers(''), [])
+
+
+class NegotiateTestCase(unittest.TestCase):
+    def negotiate(self, header, **kwargs):
+        return deflate.negotiate(deflate.parse_offers(header), **kwargs)
+
+    def test_default(self):
+        ext = self.negotiate('permessage-deflate; client_max_window_bits')
+        self.assertEqual(ext.response, 'permessage-deflate')
+        self.assertEqual(ext.window_bits, 15)
+        self.assertFalse(ext.no_context_takeover)
+
+    def test_server_params(self):
+        ext = self.negotiate('permessage-deflate; server_max_window_bits=10; '
+                             'server_no_context_takeover')
+        self.assertEqual(ext.response, 'permessage-deflate; '
+                         'server_no_context_takeover; '
+                         'server_max_window_bits=10')
+        self.assertEqual(ext.window_bits, 10)
+        self.assertTrue(ext.no_context_takeover)
+
+    def test_server_preferences(self):
+        ext = self.negotiate('permessage-deflate; server_max_window_bits=12',
+                             window_bits=11, no_context_takeover=True)
+        self.assertEqual(ext.response, 'permessage-deflate; '
+                         'server_no_context_takeover; '
+                         'server_max_window_bits=11')
+
+    def test_declined(self):
+        for header in ('permessage-deflate; server_max_window_bits=8',
+                       'permessage-deflate; server_max_window_bits',
+                       'permessage-deflate; client_max_window_bits=16',
+                       'permessage-deflate; server_no_context_takeover=1',
+                       'permessage-deflate; something_else',
+                       'permessage-deflate; server_no_context_takeover; '
+                       'server_no_context_takeover'):
+            self.assertIsNone(self.negotiate(header), header)
+
+    def test_fallback(self):
+        ext = self.negotiate('permessage-deflate; server_max_window_bits=8, '
+                             'permessage-deflate')
+        self.assertEqual(ext.response, 'permessage-deflate')
+
+
+class PerMessageDeflateTestCase(unittest.TestCase):
+    def roundtrip(self, sender, receiver, data):
+        payload, compressed = sender.compress(data)
+        if compressed:
+            return receiver.decompress(payload), payload
+        return payload, None
+
+    def test_roundtrip(self):
+        sender = deflate.PerMessageDeflate()
+        receiver = deflate.PerMessageDeflate()
+        data = b'hextile ' * 100
+
+        result, payload = self.roundtrip(sender, receiver, data)
+        self.assertEqual(result, data)
+        self.assertLess(len(payload), len(data) // 10)
+
+        # The context is kept, so a repeat is even smaller
+        result, again = self.roundtrip(sender, receiver, data)
+        self.assertEqual(result, data)
+        self.assertLess(len(again), len(payload))
+
+    def test_no_context_takeover(self):
+        sender = deflate.PerMessageDeflate(no_context_takeover=True)
+        data = b'hextile ' * 100
+        first, _ = sender.compress(data)
+        second, _ = sender.compress(data)
+        self.assertEqual(first, second)
+
+    def test_threshold(self):
+        sender = deflate.PerMessageDeflate(threshold=100)
+        self.assertEqual(sender.compress(b'x' * 99), (b'x' * 99, False))
+        self.assertTrue(sender.compress(b'x' * 100)[1])
+
+    def test_incompressible(self):
+        sender = deflate.PerMessageDeflate()
+        receiver = deflate.PerMessageDeflate()
+        data = b'raw ' * 100
+
+        # Random data is sent as it is, and then not even tried for
+        # a while
+        noise = os.urandom(1000)
+        self.assertEqual(sender.compress(noise), (noise, False))
+        self.assertEqual(sender.compress(data), (data, False))
+        result, payload = self.roundtrip(sender, receiver, data)
+        self.assertEqual(result, data)
+        self.assertIsNotNone(payload)
+
+        # The pause gets longer while it keeps happening
+        sender.compress(noise)
+        sender.compress(data)
+        self.assertEqual(sender.compress(noise), (noise, False))
+        self.assertEqual(sender.compress(data), (data, False))
+        self.assertEqual(sender.compress(data), (data, False))
+        self.assertTrue(sender.compress(data)[1])
+
+    def test_invalid(self):
+        receiver = deflate.PerMessageDeflate()
+        with self.assertRaises(ValueError):
+            receiver.decompress(b'\xff\xff\xff')
+
+    def test_too_large(self):
+        sender = deflate.PerMessageDeflate()
+        receiver = deflate.PerMessageDeflate()
+        receiver.MAX_MESSAGE_SIZE = 1000
+        payload, _ = sender.compress(bytes(2000))
+        with self.assertRaises(deflate.MessageTooLarge):
+            receiver.decompress(payload)
@@ -0,0 +1,43 @@
+""" Unit tests for masking """
+import unittest
+
+from websockify import masking
+
+
+def reference_mask(data, key):
+    return bytes(b ^ key[i % 4] for i, b in enumerate(data))
+
+
+class MaskingTestCase(unittest.TestCase):
+    def tearDown(self):
+        masking.select_backend()
+        super().tearDown()
+
+    def test_backends(self):
+        key = b'\x37\xfa\x21\x3d'
+        for name in ['auto'] + list(masking.backends):
+            masking.select_backend(name)
+            for length in [0, 1, 3, 4, 5, 125, 1023, 1024, 1027, 70000]:
+                data = bytes(range(256)) * (length // 256 + 1)
+                data = data[:length]
+                buf = bytearray(data)
+                masking.mask(buf, key)
+                self.assertEqual(buf, reference_mask(data, key),
+                                 "%s failed for length %d" % (name, length))
+
+    def test_inplace_view(self):
+        key = b'\x01\x02\x03\x04'
+        for name in masking.backends:
+            masking.select_backend(name)
+            buf = bytearray(b'xxHello, world!xx')
+            with memoryview(buf) as view:
+                masking.mask(view[2:-2], key)
+            self.assertEqual(buf, b'xx' + reference_mask(b'Hello, world!', key) + b'xx')
+
+    def test_select_unknown_backend(self):
+        self.assertRaises(ValueError, masking.select_backend, 'gazonk')
+
+    def test_select_backend(self):
+        self.assertEqual(masking.select_backend('python'), 'python')
+        self.assertEqual(masking.backend(), 'python')
+        self.assertTrue(masking.select_backend().startswith('auto'))
@@ -0,0 +1,109 @@
+""" Unit tests for metrics """
+import json
+import os
+import time
+import unittest
+import urllib.request
+from unittest.mock import MagicMock
+
+from websockify import metrics
+
+
+class RegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.registry = metrics.Registry()
+        self.counter = self.registry.counter('test_total', 'A counter',
+                                             ('kind',))
+        self.gauge = self.registry.gauge('test_active', 'A gauge')
+        self.histogram = self.registry.histogram('test_seconds',
+                                                 'A histogram',
+                                                 buckets=(0.1, 1))
+
+    def test_disabled(self):
+        self.counter.inc(labels=('a',))
+        self.assertEqual(self.counter._values, {})
+
+    def test_render(self):
+        self.registry.enabled = True
+        self.counter.inc(labels=('a',))
+        self.counter.inc(2, labels=('b"\\',))
+        self.gauge.inc()
+        self.gauge.inc()
+        self.gauge.dec()
+        self.histogram.observe(0.05)
+        self.histogram.observe(0.5)
+        self.histogram.observe(5)
+
+        self.assertEqual(self.registry.render(),
+                         '# HELP test_total A counter\n'
+                         '# TYPE test_total counter\n'
+                         'test_total{kind="a"} 1\n'
+                         'test_total{kind="b\\"\\\\"} 2\n'
+                         '# HELP test_active A gauge\n'
+                         '# TYPE test_active gauge\n'
+                         'test_active 1\n'
+                         '# HELP test_seconds A histogram\n'
+                         '# TYPE test_seconds histogram\n'
+                         'test_seconds_bucket{le="0.1"} 1\n'
+                         'test_seconds_bucket{le="1"} 2\n'
+                         'test_seconds_bucket{le="+Inf"} 3\n'
+                         'test_seconds_sum 5.55\n'
+                         'test_seconds_count 3\n')
+
+    def wait_for(self, metric, key, value):
+        deadline = time.monotonic() + 5
+        while metric._values.get(key) != value:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_forked(self):
+        self.registry.enable()
+        self.counter.inc(labels=('a',))
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                # Only changes are sent, and gauges right away
+                self.gauge.inc()
+                self.counter.inc(labels=('a',))
+                self.histogram.observe(0.5)
+                self.registry.flush()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        self.wait_for(self.counter, ('a',), 2)
+        self.wait_for(self.gauge, (), 1)
+        self.wait_for(self.histogram, (), [0, 1, 0, 0.5, 1])
+
+    def test_flush_failed(self):
+        self.registry.enable()
+        self.registry._reporting = True
+        self.registry._report_sock = MagicMock()
+        self.registry._report_sock.send.side_effect = BlockingIOError
+        self.gauge.inc()
+        self.histogram.observe(0.5)
+        self.registry.flush()
+
+        # Kept for the next flush
+        self.assertEqual(self.gauge._values, {(): 1})
+        self.assertEqual(self.histogram._values, {(): [0, 1, 0, 0.5, 1]})
+
+        self.registry._report_sock.send.side_effect = None
+        self.gauge.inc()
+        self.assertEqual(self.gauge._values, {})
+        data = self.registry._report_sock.send.call_args[0][0]
+        self.assertEqual(json.loads(data)['test_active'], [[[], 2]])
+
+    def test_server(self):
+        host, port = self.registry.start_server('127.0.0.1', 0)
+        self.gauge.inc()
+
+        with urllib.request.urlopen('http://%s:%d/metrics' % (host, port)) as f:
+            self.assertEqual(f.status, 200)
+            body = f.read().decode('utf-8')
+
+        self.assertIn('\ntest_active 1\n', body)
+        self.registry._server.shutdown()
+        self.registry._server.server_close()
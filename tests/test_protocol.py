@@ -0,0 +1,167 @@
+""" Unit tests for protocol """
+import unittest
+
+from websockify import deflate
+from websockify import protocol
+
+
+HELLO = b'\x82\x85\x37\xfa\x21\x3d\x7f\x9f\x4d\x51\x58'
+
+
+class WebSocketProtocolTestCase(unittest.TestCase):
+    def _server(self):
+        proto = protocol.WebSocketProtocol()
+        proto.open()
+        return proto
+
+    def test_feed_data(self):
+        proto = self._server()
+
+        events = proto.feed_data(HELLO + HELLO[:5])
+        self.assertEqual(len(events), 1)
+        self.assertIsInstance(events[0], protocol.Message)
+        self.assertEqual(events[0].data, b'Hello')
+
+        events = proto.feed_data(HELLO[5:])
+        self.assertEqual([e.data for e in events], [b'Hello'])
+        self.assertFalse(proto.pending())
+
+    def test_get_buffer(self):
+        proto = self._server()
+
+        with proto.get_buffer(4096) as view:
+            self.assertEqual(len(view), 4096)
+            view[:len(HELLO)] = HELLO
+        proto.buffer_updated(len(HELLO))
+
+        self.assertTrue(proto.pending())
+        self.assertEqual(proto.next_event().data, b'Hello')
+        self.assertIsNone(proto.next_event())
+
+    def test_not_open(self):
+        proto = protocol.WebSocketProtocol(client=True)
+        self.assertEqual(proto.feed_data(b'HTTP/1.1 101 OK\r\n\r\n\x82\x02hi'), [])
+        self.assertEqual(proto.read_until(b'\r\n\r\n'), b'HTTP/1.1 101 OK')
+
+        proto.open()
+        self.assertEqual(proto.next_event().data, b'hi')
+
+    def test_ping(self):
+        proto = self._server()
+
+        events = proto.feed_data(b'\x89\x84\x00\x00\x00\x00ping')
+        self.assertIsInstance(events[0], protocol.Ping)
+        self.assertEqual(events[0].data, b'ping')
+
+        # Replies are up to the caller
+        self.assertFalse(proto.has_data_to_send())
+        proto.send_pong(events[0].data)
+        self.assertEqual(proto.data_to_send(), b'\x8a\x04ping')
+
+    def test_send(self):
+        proto = self._server()
+        proto.send_message(b'hello')
+        proto.send_message(b'world')
+
+        self.assertEqual(proto.buffers_to_send(),
+                         [b'\x82\x05', b'hello', b'\x82\x05', b'world'])
+        proto.data_sent(4)
+        self.assertEqual(b''.join(proto.buffers_to_send(coalesce=True)),
+                         b'llo\x82\x05world')
+        self.assertEqual(proto.data_to_send(), b'llo\x82\x05world')
+        self.assertFalse(proto.has_data_to_send())
+
+    def test_send_client(self):
+        proto = protocol.WebSocketProtocol(client=True)
+        proto.send_message(b'hello')
+
+        frame = protocol.decode_frame(proto.data_to_send())
+        self.assertTrue(frame.masked)
+        self.assertEqual(frame.payload, b'hello')
+
+    def test_close_by_peer(self):
+        proto = self._server()
+
+        events = proto.feed_data(b'\x88\x87\x00\x00\x00\x00\x03\xe8Bye!!')
+        self.assertIsInstance(events[0], protocol.Close)
+        self.assertEqual(events[0].code, 1000)
+        self.assertEqual(events[0].reason, 'Bye!!')
+
+        # The close is echoed back
+        self.assertTrue(proto.closed)
+        self.assertEqual(proto.data_to_send(), b'\x88\x07\x03\xe8Bye!!')
+
+    def test_close_locally(self):
+        proto = self._server()
+        proto.send_close(1001, "Going away")
+        self.assertEqual(proto.close_code, 1000)
+        self.assertEqual(proto.data_to_send(), b'\x88\x0c\x03\xe9Going away')
+
+        # No further messages are sent
+        proto.send_close()
+        self.assertFalse(proto.has_data_to_send())
+
+        events = proto.feed_data(b'\x88\x82\x00\x00\x00\x00\x03\xe9')
+        self.assertIsInstance(events[0], protocol.Close)
+        self.assertTrue(proto.closed)
+        self.assertFalse(proto.has_data_to_send())
+
+    def test_protocol_error(self):
+        proto = self._server()
+
+        # Unmasked frames are not allowed from clients
+        self.assertEqual(proto.feed_data(b'\x82\x02hi'), [])
+        self.assertTrue(proto.sent_close)
+        self.assertEqual(proto.data_to_send()[2:4], b'\x03\xea')
+
+    def test_eof(self):
+        proto = self._server()
+        proto.receive_eof()
+        self.assertEqual(proto.close_code, 1006)
+        self.assertTrue(proto.closed)
+
+    def test_compressed(self):
+        server = self._server()
+        server.deflate = deflate.PerMessageDeflate(threshold=0)
+        client = protocol.WebSocketProtocol(client=True)
+        client.deflate = deflate.PerMessageDeflate(threshold=0)
+
+        client.send_message(b'Hello' * 10)
+        data = client.data_to_send()
+        self.assertTrue(data[0] & 0x40)
+        self.assertEqual([e.data for e in server.feed_data(data)],
+                         [b'Hello' * 10])
+
+        # Fragmented, with the bit only on the first frame
+        payload, _ = client.deflate.compress(b'Hello' * 10)
+        data = (protocol.encode_frame(0x2, payload[:3], b'abcd', fin=False,
+                                      rsv1=True) +
+                protocol.encode_frame(0x0, payload[3:], b'abcd'))
+        self.assertEqual([e.data for e in server.feed_data(data)],
+                         [b'Hello' * 10])
+
+        # Control frames are never compressed
+        server.send_ping(b'ping ping ping')
+        self.assertEqual(server.data_to_send(), b'\x89\x0eping ping ping')
+
+    def test_unexpected_rsv(self):
+        proto = self._server()
+        self.assertEqual(proto.feed_data(b'\xc2\x80\x00\x00\x00\x00'), [])
+        self.assertEqual(proto.close_code, 1000)
+        self.assertEqual(proto.data_to_send()[2:4], b'\x03\xea')
+
+    def test_invalid_compressed(self):
+        proto = self._server()
+        proto.deflate = deflate.PerMessageDeflate()
+        proto.feed_data(protocol.encode_frame(0x2, b'\xff\xff', b'abcd',
+                                              rsv1=True))
+        self.assertEqual(proto.data_to_send()[2:4], b'\x03\xef')
+
+    def test_too_large_compressed(self):
+        proto = self._server()
+        proto.deflate = deflate.PerMessageDeflate()
+        proto.deflate.MAX_MESSAGE_SIZE = 1000
+        payload, _ = deflate.PerMessageDeflate().compress(bytes(2000))
+        proto.feed_data(protocol.encode_frame(0x2, payload, b'abcd',
+                                              rsv1=True))
+        self.assertEqual(proto.data_to_send()[2:4], b'\x03\xf1')
@@ -2,8 +2,14 @@
 
 """ Unit tests for Token plugins"""
 
+import os
+import shutil
 import sys
+import tempfile
+import threading
+import time
 import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import patch, MagicMock
 from jwcrypto import jwt, jwk
 
@@ -12,7 +18,8 @@ try:
 except ImportError:
     redis = None
 
-from websockify.token_plugins import parse_source_args, ReadOnlyTokenFile, JWTTokenApi, TokenRedis
+from websockify import token_plugins
+from websockify.token_plugins import parse_source_args, ReadOnlyTokenFile, TokenFile, TokenFileName, JSONTokenApi, JWTTokenApi, TokenRedis, TokenCache
 
 
 class ParseSourceArgumentsTestCase(unittest.TestCase):
@@ -113,6 +120,394 @@ class ReadOnlyTokenFileTestCase(unittest.TestCase):
         self.assertEqual(result[0], "remote_host")
         self.assertEqual(result[1], "remote_port")
 
+    def test_target_options(self):
+        mock_source_file = MagicMock()
+        mock_source_file.is_dir.return_value = False
+        mock_source_file.open.return_value.__enter__.return_value.readlines.return_value = [
+            "testhost1: remote_host:remote_port flush=batch:500\n",
+            "testhost2: remote_host:remote_port color=blue\n"]
+
+        with patch("websockify.token_plugins.Path") as mock_path:
+            mock_path.return_value = mock_source_file
+            plugin = ReadOnlyTokenFile('configfile')
+            result1 = plugin.lookup('testhost1')
+            result2 = plugin.lookup('testhost2')
+
+        self.assertEqual(result1, ["remote_host", "remote_port",
+                                   {"flush": "batch:500"}])
+        self.assertIsNone(result2)
+
+
+class TokenDirTestCase(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.mkdtemp('-websockify-tokens')
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.tmpdir = tempfile.mkdtemp('-websockify-tokens')
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        # Old enough timestamps, so changes are noticed from them
+        self.mtime = time.time() - 100
+
+        parse = token_plugins._parse_token_lines
+        self.parse = patch('websockify.token_plugins._parse_token_lines',
+                           side_effect=parse).start()
+        self.addCleanup(patch.stopall)
+
+    def write(self, name, text, rename=False):
+        path = os.path.join(self.tmpdir if rename else self.dir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        self.mtime += 1
+        os.utime(path, (self.mtime, self.mtime))
+        if rename:
+            os.replace(path, os.path.join(self.dir, name))
+
+
+class TokenFileTestCase(TokenDirTestCase):
+    def test_lookup(self):
+        self.write('a', "t1: host1:1\n")
+        self.write('b', "# comment\nt2: host2:2 flush=cork\n")
+        plugin = TokenFile(self.dir)
+
+        self.assertEqual(plugin.lookup('t1'), ['host1', '1'])
+        self.assertEqual(plugin.lookup('t2'),
+                         ['host2', '2', {'flush': 'cork'}])
+        self.assertIsNone(plugin.lookup('t3'))
+        self.assertEqual(self.parse.call_count, 2)
+
+    def test_changes(self):
+        self.write('a', "t1: host1:1\n")
+        self.write('b', "t2: host2:2\n")
+        plugin = TokenFile(self.dir)
+        plugin.lookup('t1')
+        plugin.lookup('t2')
+        self.assertEqual(self.parse.call_count, 2)
+
+        # Only the replaced file is read again
+        self.write('b', "t3: host3:3\n", rename=True)
+        self.assertIsNone(plugin.lookup('t2'))
+        self.assertEqual(plugin.lookup('t3'), ['host3', '3'])
+        self.assertEqual(self.parse.call_count, 3)
+
+        # The file of a token is checked when it is looked up
+        self.write('a', "t1: otherhost:1\n")
+        self.assertEqual(plugin.lookup('t1'), ['otherhost', '1'])
+        self.assertEqual(self.parse.call_count, 4)
+
+        os.remove(os.path.join(self.dir, 'a'))
+        self.assertIsNone(plugin.lookup('t1'))
+
+        # Tokens added to other files in place are found by a check of
+        # all files, at most once a second
+        self.write('b', "t3: host3:3\nt4: host4:4\n")
+        self.assertIsNone(plugin.lookup('t4'))
+        later = time.monotonic() + plugin.CHECK_INTERVAL
+        with patch('time.monotonic', return_value=later):
+            self.assertEqual(plugin.lookup('t4'), ['host4', '4'])
+            self.assertEqual(self.parse.call_count, 5)
+            with patch('os.stat', side_effect=os.stat) as stat:
+                self.assertIsNone(plugin.lookup('t5'))
+                self.assertEqual(stat.call_count, 1)
+
+    def test_duplicate_tokens(self):
+        self.write('a', "t1: host1:1\n")
+        self.write('b', "t1: host2:2\n")
+        plugin = TokenFile(self.dir)
+        self.assertIn(plugin.lookup('t1'), (['host1', '1'], ['host2', '2']))
+
+        os.remove(os.path.join(self.dir, 'a'))
+        self.assertEqual(plugin.lookup('t1'), ['host2', '2'])
+
+    def test_file(self):
+        self.write('a', "t1: host1:1\n")
+        plugin = TokenFile(os.path.join(self.dir, 'a'))
+        self.assertEqual(plugin.lookup('t1'), ['host1', '1'])
+        self.assertEqual(plugin.lookup('t1'), ['host1', '1'])
+        self.assertEqual(self.parse.call_count, 1)
+
+        self.write('a', "t2: host2:2\n", rename=True)
+        self.assertIsNone(plugin.lookup('t1'))
+        self.assertEqual(plugin.lookup('t2'), ['host2', '2'])
+
+        os.remove(os.path.join(self.dir, 'a'))
+        self.assertIsNone(plugin.lookup('t2'))
+
+
+class TokenFileNameTestCase(TokenDirTestCase):
+    def test_lookup(self):
+        self.write('t1', "host1:1\n")
+        plugin = TokenFileName(self.dir)
+
+        self.assertEqual(plugin.lookup('t1'), ['host1', '1'])
+        self.assertEqual(plugin.lookup('../t1'), ['host1', '1'])
+        self.assertIsNone(plugin.lookup('t2'))
+        self.assertIsNone(plugin.lookup('..'))
+
+    def test_cache(self):
+        self.write('t1', "host1:1\n")
+        self.write('t2', "host2:2\n")
+        plugin = TokenFileName(self.dir)
+        plugin.refresh()
+        with patch('websockify.token_plugins.open') as mock_open:
+            self.assertEqual(plugin.lookup('t1'), ['host1', '1'])
+            self.assertEqual(plugin.lookup('t2'), ['host2', '2'])
+            mock_open.assert_not_called()
+
+        # Replaced, modified and removed files are noticed right away
+        self.write('t1', "otherhost:1\n", rename=True)
+        self.write('t2', "otherhost:2\n")
+        self.assertEqual(plugin.lookup('t1'), ['otherhost', '1'])
+        self.assertEqual(plugin.lookup('t2'), ['otherhost', '2'])
+
+        os.remove(os.path.join(self.dir, 't1'))
+        self.assertIsNone(plugin.lookup('t1'))
+
+    def test_scan_size(self):
+        self.write('t1', "host1:1\n")
+        self.write('t2', "host2:2\n")
+        plugin = TokenFileName(self.dir)
+        plugin.SCAN_SIZE = 1
+
+        plugin.refresh()
+        self.assertEqual(len(plugin._targets), 1)
+        plugin.refresh()
+        self.assertEqual(sorted(plugin._targets), ['t1', 't2'])
+
+    def test_negative_cache(self):
+        plugin = TokenFileName(self.dir)
+        plugin.NEGATIVE_SIZE = 2
+        self.assertIsNone(plugin.lookup('t1'))
+
+        self.write('t1', "host1:1\n")
+        self.assertIsNone(plugin.lookup('t1'))
+        plugin.refresh()
+        self.assertEqual(plugin.lookup('t1'), ['host1', '1'])
+
+        for token in ('t2', 't3', 't4'):
+            self.assertIsNone(plugin.lookup(token))
+        self.assertEqual(list(plugin._missing), ['t3', 't4'])
+
+        self.write('t4', "host4:4\n")
+        with patch('time.monotonic', return_value=time.monotonic() + 5):
+            self.assertEqual(plugin.lookup('t4'), ['host4', '4'])
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.plugin = MagicMock()
+        self.plugin.lookup.side_effect = self.lookup
+        self.targets = {'t1': ['host1', '1'], 't2': ['host2', '2'],
+                        't3': ['host3', '3']}
+
+    def lookup(self, token):
+        return self.targets.get(token)
+
+    def test_ttl(self):
+        cache = TokenCache(self.plugin, 10, miss_ttl=1)
+        now = time.monotonic()
+
+        with patch('time.monotonic', return_value=now):
+            self.assertEqual(cache.lookup('t1'), ['host1', '1'])
+            self.assertIsNone(cache.lookup('t4'))
+            self.targets['t4'] = ['host4', '4']
+            self.assertEqual(cache.lookup('t1'), ['host1', '1'])
+            self.assertIsNone(cache.lookup('t4'))
+            self.assertEqual(self.plugin.lookup.call_count, 2)
+
+        with patch('time.monotonic', return_value=now + 1):
+            self.assertEqual(cache.lookup('t1'), ['host1', '1'])
+            self.assertEqual(cache.lookup('t4'), ['host4', '4'])
+            self.assertEqual(self.plugin.lookup.call_count, 3)
+
+        with patch('time.monotonic', return_value=now + 10):
+            cache.lookup('t1')
+            self.assertEqual(self.plugin.lookup.call_count, 4)
+
+    def test_no_miss_ttl(self):
+        cache = TokenCache(self.plugin, 10)
+        self.assertIsNone(cache.lookup('t4'))
+        self.assertIsNone(cache.lookup('t4'))
+        self.assertEqual(self.plugin.lookup.call_count, 2)
+
+    def test_lru(self):
+        cache = TokenCache(self.plugin, 10, size=2)
+        cache.lookup('t1')
+        cache.lookup('t2')
+        cache.lookup('t1')
+        cache.lookup('t3')
+        self.assertEqual(list(cache._entries), ['t1', 't3'])
+
+    def test_coalesced(self):
+        cache = TokenCache(self.plugin, 10)
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_lookup(token):
+            started.set()
+            release.wait()
+            return ['host1', '1']
+        self.plugin.lookup.side_effect = slow_lookup
+
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(cache.lookup('t1')))
+            for _ in range(5)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        while len(cache._pending['t1'].done._cond._waiters) < 4:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [['host1', '1']] * 5)
+        self.assertEqual(self.plugin.lookup.call_count, 1)
+
+    def test_error(self):
+        cache = TokenCache(self.plugin, 10)
+        self.plugin.lookup.side_effect = ValueError("backend failed")
+        self.assertRaises(ValueError, cache.lookup, 't1')
+        self.assertEqual(cache._pending, {})
+        self.assertEqual(len(cache._entries), 0)
+
+    def test_forked(self):
+        cache = TokenCache(self.plugin, 10)
+        cache.refresh()
+        self.plugin.refresh.assert_called_once_with()
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                cache.lookup('t1')
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        # The parent now has it too
+        deadline = time.monotonic() + 5
+        while 't1' not in cache._entries:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        self.assertEqual(cache.lookup('t1'), ['host1', '1'])
+        self.assertEqual(self.plugin.lookup.call_count, 0)
+
+
+class TokenAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, self.client_address))
+        status, delay = server.responses.pop(0) if server.responses else (200, 0)
+        time.sleep(delay)
+        body = b'{"host": "remote_host", "port": "remote_port"}'
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class JSONTokenApiTestCase(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), TokenAPIHandler)
+        self.server.daemon_threads = True
+        # Clients that timed out are gone before the response
+        self.server.handle_error = lambda request, client_address: None
+        self.server.requests = []
+        self.server.responses = []
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.plugin = JSONTokenApi('http://127.0.0.1:%d/token/%%s' %
+                                   self.server.server_address[1])
+        self.plugin.RETRY_DELAY = 0
+        self.addCleanup(lambda: self.plugin._get_session().close())
+
+    def test_keep_alive(self):
+        self.assertEqual(self.plugin.lookup('t1'), ('remote_host', 'remote_port'))
+        self.assertEqual(self.plugin.lookup('t2'), ('remote_host', 'remote_port'))
+
+        (path1, client1), (path2, client2) = self.server.requests
+        self.assertEqual((path1, path2), ('/token/t1', '/token/t2'))
+        self.assertEqual(client1, client2)
+
+    def test_retry(self):
+        self.server.responses = [(503, 0), (200, 0)]
+        self.assertEqual(self.plugin.lookup('t1'), ('remote_host', 'remote_port'))
+        self.assertEqual(len(self.server.requests), 2)
+
+        # Unknown tokens are not worth asking again
+        self.server.responses = [(404, 0)]
+        self.assertIsNone(self.plugin.lookup('t2'))
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_timeout(self):
+        import requests
+
+        self.plugin.timeout = (1, 0.1)
+        self.server.responses = [(200, 0.5)] * 3
+        self.assertRaises(requests.Timeout, self.plugin.lookup, 't1')
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_breaker(self):
+        self.plugin.RETRIES = 0
+        self.plugin.BREAKER_FAILURES = 2
+        self.server.responses = [(500, 0)] * 3
+
+        self.assertIsNone(self.plugin.lookup('t1'))
+        self.assertIsNone(self.plugin.lookup('t1'))
+        self.assertRaises(ConnectionError, self.plugin.lookup, 't1')
+        self.assertEqual(len(self.server.requests), 2)
+
+        # One lookup may try again after a while
+        later = time.monotonic() + self.plugin.BREAKER_SECONDS
+        with patch('time.monotonic', return_value=later):
+            self.assertIsNone(self.plugin.lookup('t1'))
+            self.assertRaises(ConnectionError, self.plugin.lookup, 't1')
+        self.assertEqual(len(self.server.requests), 3)
+
+        later += self.plugin.BREAKER_SECONDS
+        with patch('time.monotonic', return_value=later):
+            self.assertEqual(self.plugin.lookup('t1'),
+                             ('remote_host', 'remote_port'))
+            self.assertEqual(self.plugin.lookup('t1'),
+                             ('remote_host', 'remote_port'))
+
+    def test_subclass(self):
+        class TestPlugin(JSONTokenApi):
+            def __init__(self, src):
+                self.source = src
+
+        plugin = TestPlugin(self.plugin.source)
+        self.assertEqual(plugin.lookup('t1'), ('remote_host', 'remote_port'))
+        plugin._get_session().close()
+
+    def test_breaker_forked(self):
+        self.plugin.RETRIES = 0
+        self.plugin.BREAKER_FAILURES = 1
+        self.server.responses = [(500, 0)]
+        self.plugin.refresh()
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                self.plugin.lookup('t1')
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        self.assertRaises(ConnectionError, self.plugin.lookup, 't1')
+        self.assertEqual(len(self.server.requests), 1)
+
 
 class JWSTokenTestCase(unittest.TestCase):
     def test_asymmetric_jws_token_plugin(self):
@@ -240,6 +635,91 @@ class JWSTokenTestCase(unittest.TestCase):
         self.assertEqual(result[1], "remote_port")
 
 
+class JWTTokenApiCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'key')
+        self.plugin = JWTTokenApi(self.path)
+
+        self.key1 = jwk.JWK.generate(kty='EC', crv='P-256', kid='key1')
+        self.key2 = jwk.JWK.generate(kty='EC', crv='P-256', kid='key2')
+
+    def write(self, data, age=10):
+        with open(self.path, 'w') as f:
+            f.write(data)
+        mtime = time.time() - age
+        os.utime(self.path, (mtime, mtime))
+
+    def make_token(self, key, **claims):
+        claims.update(host='remote_host', port='remote_port')
+        token = jwt.JWT({"alg": "ES256", "kid": key.get("kid")}, claims)
+        token.make_signed_token(key)
+        return token.serialize()
+
+    def test_key_reload(self):
+        self.write(self.key1.export_to_pem().decode())
+        token1 = self.make_token(self.key1)
+        token2 = self.make_token(self.key2)
+
+        with patch.object(self.plugin, '_parse_key',
+                          wraps=self.plugin._parse_key) as parse:
+            self.plugin.refresh()
+            self.assertEqual(self.plugin.lookup(token1),
+                             ('remote_host', 'remote_port'))
+            self.assertIsNone(self.plugin.lookup(token2))
+            self.assertEqual(parse.call_count, 1)
+
+            self.write(self.key2.export_to_pem().decode(), age=5)
+            self.assertIsNone(self.plugin.lookup(token1))
+            self.assertEqual(self.plugin.lookup(token2),
+                             ('remote_host', 'remote_port'))
+            self.assertEqual(parse.call_count, 2)
+
+            # Too new to tell if it changes again
+            self.write(self.key1.export_to_pem().decode(), age=0)
+            self.plugin.lookup(token1)
+            self.plugin.lookup(token1)
+            self.assertEqual(parse.call_count, 4)
+
+    def test_key_set(self):
+        keys = jwk.JWKSet()
+        keys.add(self.key1)
+        keys.add(self.key2)
+        self.write(keys.export(private_keys=False))
+
+        for key in (self.key1, self.key2):
+            self.assertEqual(self.plugin.lookup(self.make_token(key)),
+                             ('remote_host', 'remote_port'))
+
+        self.write(self.key2.export_public())
+        self.assertIsNone(self.plugin.lookup(self.make_token(self.key1)))
+        self.assertEqual(self.plugin.lookup(self.make_token(self.key2)),
+                         ('remote_host', 'remote_port'))
+
+    def test_valid_tokens(self):
+        self.write(self.key1.export_public())
+        now = time.time()
+        token = self.make_token(self.key1, exp=int(now) + 100)
+
+        with patch.object(jwt, 'JWT', wraps=jwt.JWT) as verify:
+            self.assertEqual(self.plugin.lookup(token),
+                             ('remote_host', 'remote_port'))
+            self.assertEqual(self.plugin.lookup(token),
+                             ('remote_host', 'remote_port'))
+            self.assertEqual(verify.call_count, 1)
+
+            with patch('time.time', return_value=now + 200):
+                self.assertIsNone(self.plugin.lookup(token))
+            self.assertEqual(verify.call_count, 2)
+
+            # A new key forgets what was valid for the old one
+            self.write(self.key2.export_public())
+            self.assertIsNone(self.plugin.lookup(token))
+            self.assertEqual(verify.call_count, 3)
+
+
 class TokenRedisTestCase(unittest.TestCase):
     def setUp(self):
         if redis is None:
@@ -273,6 +753,18 @@ class TokenRedisTestCase(unittest.TestCase):
         self.assertEqual(result[0], 'remote_host')
         self.assertEqual(result[1], 'remote_port')
 
+    @patch('redis.Redis')
+    def test_json_token_with_options(self, mock_redis):
+        plugin = TokenRedis('127.0.0.1:1234')
+
+        instance = mock_redis.return_value
+        instance.get.return_value = b'{"host": "remote_host:remote_port", "flush": "cork"}'
+
+        result = plugin.lookup('testhost')
+
+        self.assertEqual(result, ('remote_host', 'remote_port',
+                                  {'flush': 'cork'}))
+
     @patch('redis.Redis')
     def test_json_token_with_spaces(self, mock_redis):
         plugin = TokenRedis('127.0.0.1:1234')
@@ -363,6 +855,62 @@ class TokenRedisTestCase(unittest.TestCase):
         self.assertEqual(result[0], 'remote_host')
         self.assertEqual(result[1], 'remote_port')
 
+    @patch('redis.ConnectionPool')
+    @patch('redis.Redis')
+    def test_connection_pool(self, mock_redis, mock_pool):
+        plugin = TokenRedis('127.0.0.1:1234:2:verysecret')
+
+        instance = mock_redis.return_value
+        instance.get.return_value = b'remote_host:remote_port'
+
+        plugin.lookup('testhost1')
+        plugin.lookup('testhost2')
+
+        mock_pool.assert_called_once_with(
+            host='127.0.0.1', port=1234, db=2, password='verysecret',
+            socket_timeout=TokenRedis.SOCKET_TIMEOUT,
+            socket_connect_timeout=TokenRedis.SOCKET_TIMEOUT,
+            health_check_interval=TokenRedis.HEALTH_CHECK_INTERVAL)
+        mock_redis.assert_called_once_with(
+            connection_pool=mock_pool.return_value)
+        self.assertEqual(instance.get.call_count, 2)
+
+    @patch('redis.ConnectionPool.from_url')
+    @patch('redis.Redis')
+    def test_src_url(self, mock_redis, mock_from_url):
+        plugin = TokenRedis('redis://:verysecret@127.0.0.1:1234/2'
+                            '?namespace=ns&socket_timeout=0.5')
+
+        instance = mock_redis.return_value
+        instance.get.return_value = b'remote_host:remote_port'
+
+        result = plugin.lookup('testhost')
+
+        self.assertEqual(result, ['remote_host', 'remote_port'])
+        instance.get.assert_called_once_with('ns:testhost')
+        url = mock_from_url.call_args[0][0]
+        self.assertEqual(url, 'redis://:verysecret@127.0.0.1:1234/2'
+                         '?socket_timeout=0.5')
+
+    @patch('redis.Redis')
+    def test_cache_ttl(self, mock_redis):
+        plugin = TokenRedis('redis://127.0.0.1?cache_ttl=5')
+
+        instance = mock_redis.return_value
+        instance.get.return_value = b'remote_host:remote_port'
+
+        now = time.monotonic()
+        with patch('time.monotonic', return_value=now):
+            self.assertEqual(plugin.lookup('testhost'),
+                             ['remote_host', 'remote_port'])
+            self.assertEqual(plugin.lookup('testhost'),
+                             ['remote_host', 'remote_port'])
+            self.assertEqual(instance.get.call_count, 1)
+
+        with patch('time.monotonic', return_value=now + 5):
+            plugin.lookup('testhost')
+            self.assertEqual(instance.get.call_count, 2)
+
     def test_src_only_host(self):
         plugin = TokenRedis('127.0.0.1')
 
@@ -16,6 +16,7 @@
 
 """ Unit tests for websocket """
 import unittest
+from websockify import deflate
 from websockify import websocket
 
 
@@ -118,6 +119,30 @@ class AcceptTestCase(unittest.TestCase):
                                  'Sec-WebSocket-Key': 'DKURYVK9cRFul1vOZVA56Q==',
                                  'Sec-WebSocket-Protocol': 'foobar,gazonk'})
 
+    def test_compression(self):
+        class DeflateSocket(websocket.WebSocket):
+            def select_compression(self, offers):
+                return deflate.negotiate(offers)
+
+        ws = DeflateSocket()
+        sock = FakeSocket()
+        ws.accept(sock, {'upgrade': 'websocket',
+                         'Sec-WebSocket-Version': '13',
+                         'Sec-WebSocket-Key': 'DKURYVK9cRFul1vOZVA56Q==',
+                         'Sec-WebSocket-Extensions': 'permessage-deflate; client_max_window_bits'})
+        self.assertTrue(b'\r\nSec-WebSocket-Extensions: permessage-deflate\r\n' in sock.data)
+        self.assertIsNotNone(ws.compression)
+
+    def test_no_compression(self):
+        ws = websocket.WebSocket()
+        sock = FakeSocket()
+        ws.accept(sock, {'upgrade': 'websocket',
+                         'Sec-WebSocket-Version': '13',
+                         'Sec-WebSocket-Key': 'DKURYVK9cRFul1vOZVA56Q==',
+                         'Sec-WebSocket-Extensions': 'permessage-deflate'})
+        self.assertFalse(b'\r\nSec-WebSocket-Extensions:' in sock.data)
+        self.assertIsNone(ws.compression)
+
 
 class PingPongTest(unittest.TestCase):
     def setUp(self):
@@ -152,21 +177,21 @@ class HyBiEncodeDecodeTestCase(unittest.TestCase):
         ws = websocket.WebSocket()
         res = ws._decode_hybi(buf)
 
-        self.assertEqual(res['fin'], 1)
-        self.assertEqual(res['opcode'], 0x1)
-        self.assertEqual(res['masked'], True)
-        self.assertEqual(res['length'], len(buf))
-        self.assertEqual(res['payload'], b'Hello')
+        self.assertEqual(res.fin, 1)
+        self.assertEqual(res.opcode, 0x1)
+        self.assertEqual(res.masked, True)
+        self.assertEqual(res.length, len(buf))
+        self.assertEqual(res.payload, b'Hello')
 
     def test_decode_hybi_binary(self):
         buf = b'\x82\x04\x01\x02\x03\x04'
         ws = websocket.WebSocket()
         res = ws._decode_hybi(buf)
 
-        self.assertEqual(res['fin'], 1)
-        self.assertEqual(res['opcode'], 0x2)
-        self.assertEqual(res['length'], len(buf))
-        self.assertEqual(res['payload'], b'\x01\x02\x03\x04')
+        self.assertEqual(res.fin, 1)
+        self.assertEqual(res.opcode, 0x2)
+        self.assertEqual(res.length, len(buf))
+        self.assertEqual(res.payload, b'\x01\x02\x03\x04')
 
     def test_decode_hybi_extended_16bit_binary(self):
         data = (b'\x01\x02\x03\x04' * 65)  # len > 126 -- len == 260
@@ -174,10 +199,10 @@ class HyBiEncodeDecodeTestCase(unittest.TestCase):
         ws = websocket.WebSocket()
         res = ws._decode_hybi(buf)
 
-        self.assertEqual(res['fin'], 1)
-        self.assertEqual(res['opcode'], 0x2)
-        self.assertEqual(res['length'], len(buf))
-        self.assertEqual(res['payload'], data)
+        self.assertEqual(res.fin, 1)
+        self.assertEqual(res.opcode, 0x2)
+        self.assertEqual(res.length, len(buf))
+        self.assertEqual(res.payload, data)
 
     def test_decode_hybi_extended_64bit_binary(self):
         data = (b'\x01\x02\x03\x04' * 65)  # len > 126 -- len == 260
@@ -185,10 +210,10 @@ class HyBiEncodeDecodeTestCase(unittest.TestCase):
         ws = websocket.WebSocket()
         res = ws._decode_hybi(buf)
 
-        self.assertEqual(res['fin'], 1)
-        self.assertEqual(res['opcode'], 0x2)
-        self.assertEqual(res['length'], len(buf))
-        self.assertEqual(res['payload'], data)
+        self.assertEqual(res.fin, 1)
+        self.assertEqual(res.opcode, 0x2)
+        self.assertEqual(res.length, len(buf))
+        self.assertEqual(res.payload, data)
 
     def test_decode_hybi_multi(self):
         buf1 = b'\x01\x03\x48\x65\x6c'
@@ -197,16 +222,16 @@ class HyBiEncodeDecodeTestCase(unittest.TestCase):
         ws = websocket.WebSocket()
 
         res1 = ws._decode_hybi(buf1)
-        self.assertEqual(res1['fin'], 0)
-        self.assertEqual(res1['opcode'], 0x1)
-        self.assertEqual(res1['length'], len(buf1))
-        self.assertEqual(res1['payload'], b'Hel')
+        self.assertEqual(res1.fin, 0)
+        self.assertEqual(res1.opcode, 0x1)
+        self.assertEqual(res1.length, len(buf1))
+        self.assertEqual(res1.payload, b'Hel')
 
         res2 = ws._decode_hybi(buf2)
-        self.assertEqual(res2['fin'], 1)
-        self.assertEqual(res2['opcode'], 0x0)
-        self.assertEqual(res2['length'], len(buf2))
-        self.assertEqual(res2['payload'], b'lo')
+        self.assertEqual(res2.fin, 1)
+        self.assertEqual(res2.opcode, 0x0)
+        self.assertEqual(res2.length, len(buf2))
+        self.assertEqual(res2.payload, b'lo')
 
     def test_encode_hybi_basic(self):
         ws = websocket.WebSocket()
@@ -214,3 +239,206 @@ class HyBiEncodeDecodeTestCase(unittest.TestCase):
         expected = b'\x81\x05\x48\x65\x6c\x6c\x6f'
 
         self.assertEqual(res, expected)
+
+
+class FakeRecvSocket(FakeSocket):
+    def __init__(self, chunks):
+        super().__init__()
+        self.chunks = list(chunks)
+
+    def recv_into(self, buf, nbytes=0):
+        if not self.chunks:
+            return 0
+        chunk = self.chunks.pop(0)
+        nbytes = min(nbytes or len(buf), len(buf))
+        if len(chunk) > nbytes:
+            self.chunks.insert(0, chunk[nbytes:])
+            chunk = chunk[:nbytes]
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+
+    def close(self):
+        pass
+
+
+class RecvTestCase(unittest.TestCase):
+    def _accept(self, chunks):
+        ws = websocket.WebSocket()
+        sock = FakeRecvSocket(chunks)
+        ws.accept(sock, {'upgrade': 'websocket',
+                         'Sec-WebSocket-Version': '13',
+                         'Sec-WebSocket-Key': 'DKURYVK9cRFul1vOZVA56Q=='})
+        return ws
+
+    def test_many_frames_in_one_read(self):
+        frame = b'\x82\x85\x37\xfa\x21\x3d\x7f\x9f\x4d\x51\x58'
+        ws = self._accept([frame * 100])
+
+        msgs = [ws.recvmsg()]
+        while ws.pending():
+            msgs.append(ws.recvmsg())
+
+        self.assertEqual(msgs, [b'Hello'] * 100)
+        self.assertEqual(ws._protocol._recv_pos, 0)
+        self.assertEqual(ws._protocol._recv_end, 0)
+
+    def test_frame_split_over_reads(self):
+        frame = b'\x82\x85\x37\xfa\x21\x3d\x7f\x9f\x4d\x51\x58'
+        ws = self._accept([frame + frame[:3], frame[3:7], frame[7:]])
+
+        self.assertEqual(ws.recvmsg(), b'Hello')
+        self.assertRaises(websocket.WebSocketWantReadError, ws.recvmsg)
+        self.assertEqual(ws.recvmsg(), b'Hello')
+
+    def test_large_frame(self):
+        data = b'\x01\x02\x03\x04' * 10000
+        ws = self._accept([b'\x82\xff\x00\x00\x00\x00\x00\x00\x9c\x40'
+                           b'\x00\x00\x00\x00' + data])
+
+        while True:
+            try:
+                msg = ws.recvmsg()
+                break
+            except websocket.WebSocketWantReadError:
+                pass
+
+        self.assertEqual(msg, data)
+
+    def test_closed(self):
+        ws = self._accept([])
+
+        self.assertIsNone(ws.recvmsg())
+        self.assertEqual(ws.close_code, 1006)
+
+    def test_fragmented_message(self):
+        ws = self._accept([b'\x02\x83\x00\x00\x00\x00Hel',
+                           b'\x00\x81\x00\x00\x00\x00l',
+                           b'\x80\x81\x00\x00\x00\x00o'])
+
+        msg = None
+        while msg is None:
+            try:
+                msg = ws.recvmsg()
+            except websocket.WebSocketWantReadError:
+                pass
+
+        self.assertEqual(msg, b'Hello')
+
+    def test_trim_after_large_frame(self):
+        data = b'\x01\x02\x03\x04' * 10000
+        ws = self._accept([b'\x82\xff\x00\x00\x00\x00\x00\x00\x9c\x40'
+                           b'\x00\x00\x00\x00' + data])
+
+        while True:
+            try:
+                msg = ws.recvmsg()
+                break
+            except websocket.WebSocketWantReadError:
+                pass
+
+        self.assertEqual(msg, data)
+        self.assertGreater(ws.read_size.size, 4096)
+        self.assertEqual(len(ws._protocol._recv_buffer), ws.read_size.size)
+
+
+class FakeSlowSocket(FakeSocket):
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+        self.calls = 0
+
+    def send(self, buf):
+        self.calls += 1
+        buf = bytes(buf)[:self.limit]
+        self.data += buf
+        return len(buf)
+
+
+class FakeSlowVectoredSocket(FakeSlowSocket):
+    def sendmsg(self, bufs):
+        return self.send(b''.join(bufs))
+
+
+class SendTestCase(unittest.TestCase):
+    def _accept(self, sock):
+        ws = websocket.WebSocket()
+        sock.limit = None
+        ws.accept(sock, {'upgrade': 'websocket',
+                         'Sec-WebSocket-Version': '13',
+                         'Sec-WebSocket-Key': 'DKURYVK9cRFul1vOZVA56Q=='})
+        sock.data = b''
+        sock.calls = 0
+        return ws
+
+    def _send_partial(self, sock):
+        ws = self._accept(sock)
+        msg = b'\x01\x02\x03' * 50000
+
+        sock.limit = 10000
+        self.assertRaises(websocket.WebSocketWantWriteError, ws.sendmsg, msg)
+        while True:
+            try:
+                ws.sendmsg(msg)
+                break
+            except websocket.WebSocketWantWriteError:
+                pass
+
+        self.assertEqual(sock.data, b'\x82\x7f\x00\x00\x00\x00\x00\x02\x49\xf0' + msg)
+
+    def test_send_partial(self):
+        self._send_partial(FakeSlowSocket(None))
+
+    def test_send_partial_vectored(self):
+        self._send_partial(FakeSlowVectoredSocket(None))
+
+    def test_vectored_single_call(self):
+        sock = FakeSlowVectoredSocket(None)
+        ws = self._accept(sock)
+
+        ws.sendmsg(b'\x01' * 100000)
+
+        self.assertEqual(sock.calls, 1)
+        self.assertEqual(len(sock.data), 100010)
+
+    def test_coalesce_small(self):
+        sock = FakeSlowSocket(None)
+        ws = self._accept(sock)
+
+        ws.sendmsg(b'Hello')
+
+        self.assertEqual(sock.calls, 1)
+        self.assertEqual(sock.data, b'\x82\x05Hello')
+
+
+class ReadSizePolicyTestCase(unittest.TestCase):
+    def test_grow(self):
+        policy = websocket.ReadSizePolicy(1024, 8192)
+        for size in [1024, 2048, 4096, 8192, 8192]:
+            self.assertEqual(policy.size, size)
+            policy.update(size)
+        self.assertEqual(policy.size, 8192)
+        self.assertEqual(policy.full_reads, 5)
+        self.assertEqual(policy.peak_size, 8192)
+
+    def test_shrink(self):
+        policy = websocket.ReadSizePolicy(1024, 8192)
+        policy.update(1024)
+        policy.update(2048)
+        self.assertEqual(policy.size, 4096)
+
+        for i in range(policy.SHRINK_AFTER - 1):
+            policy.update(10)
+        self.assertEqual(policy.size, 4096)
+        policy.update(10)
+        self.assertEqual(policy.size, 2048)
+
+        for i in range(policy.SHRINK_AFTER * 4):
+            policy.update(10)
+        self.assertEqual(policy.size, 1024)
+
+    def test_medium_reads_keep_size(self):
+        policy = websocket.ReadSizePolicy(1024, 8192)
+        policy.update(1024)
+        for i in range(policy.SHRINK_AFTER * 2):
+            policy.update(1000)
+        self.assertEqual(policy.size, 2048)
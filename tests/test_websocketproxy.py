@@ -16,6 +16,8 @@
 
 """ Unit tests for websocketproxy """
 
+import selectors
+import time
 import unittest
 import socket
 from io import StringIO
@@ -25,6 +27,7 @@ from unittest.mock import patch, MagicMock
 from websockify import websocketproxy
 from websockify import token_plugins
 from websockify import auth_plugins
+from websockify import metrics
 
 
 class FakeSocket:
@@ -55,6 +58,16 @@ class FakeServer:
         self.wrap_cmd = None
         self.ssl_target = None
         self.unix_target = None
+        self.client_queue_high = 100
+        self.client_queue_low = 50
+        self.target_queue_high = 100
+        self.target_queue_low = 50
+        self.coalesce_size = 0
+        self.coalesce_delay = 0
+        self.flush_policy = "immediate"
+        self.heartbeat = None
+        self.min_read_size = 4096
+        self.max_read_size = 65536
 
 
 class ProxyRequestHandlerTestCase(unittest.TestCase):
@@ -64,12 +77,33 @@ class ProxyRequestHandlerTestCase(unittest.TestCase):
             FakeSocket(), "127.0.0.1", FakeServer())
         self.handler.path = "https://localhost:6080/websockify?token=blah"
         self.handler.headers = {}
+        self.handler.send_parts = []
+        self.handler.client_paused = False
+        self.handler.target_paused = False
+        self.handler.reported_sizes = (0, 0)
+        self.handler.send_blocked = False
+        self.handler.coalesce_deadline = None
+        self.handler.flush_delay = 0
+        self.handler.flush_cork = False
+        self.handler.corked = False
         patch('websockify.websockifyserver.WebSockifyServer.socket').start()
 
     def tearDown(self):
         patch.stopall()
         super().tearDown()
 
+    def test_read_size(self):
+        self.handler.proxy_setup()
+        self.assertEqual(self.handler.target_read_size.max_size, 65536)
+
+        # Handlers that set the old buffer_size still get their way
+        self.handler.server.max_read_size = None
+        self.handler.buffer_size = 2048
+        self.handler.proxy_setup()
+        self.assertEqual(self.handler.target_read_size.max_size, 2048)
+        self.assertEqual(self.handler.request.read_size.max_size, 2048)
+        self.assertEqual(self.handler.target_read_size.min_size, 2048)
+
     def test_get_target(self):
         class TestPlugin(token_plugins.BasePlugin):
             def lookup(self, token):
@@ -81,6 +115,16 @@ class ProxyRequestHandlerTestCase(unittest.TestCase):
         self.assertEqual(host, "some host")
         self.assertEqual(port, "some port")
 
+    def test_get_target_cached(self):
+        class TestPlugin(token_plugins.BasePlugin):
+            def lookup(self, token):
+                return ("some host", "some port")
+
+        plugin = token_plugins.TokenCache(TestPlugin(None), 10)
+        with patch.object(metrics.token_lookup_seconds, 'observe') as observe:
+            self.handler.get_target(plugin)
+        self.assertEqual(observe.call_args[0][1], ('TestPlugin',))
+
     def test_get_target_unix_socket(self):
         class TestPlugin(token_plugins.BasePlugin):
             def lookup(self, token):
@@ -111,6 +155,28 @@ class ProxyRequestHandlerTestCase(unittest.TestCase):
         self.assertEqual(self.handler.server.target_host, "somehost")
         self.assertEqual(self.handler.server.target_port, "blah")
 
+    def test_token_plugin_target_options(self):
+        class TestPlugin(token_plugins.BasePlugin):
+            def lookup(self, token):
+                return ("somehost", "someport", {"flush": self.source})
+
+        self.handler.server.token_plugin = TestPlugin("cork")
+        self.handler.validate_connection()
+        self.assertEqual(self.handler.flush_policy, "cork")
+        self.assertEqual(self.handler.server.flush_policy, "immediate")
+        self.handler.proxy_setup()
+        self.assertTrue(self.handler.flush_cork)
+
+        self.handler.server.token_plugin = TestPlugin("sometimes")
+        self.handler.validate_connection()
+        self.assertEqual(self.handler.flush_policy, "cork")
+
+        # Other connections use the server's policy
+        other = websocketproxy.ProxyRequestHandler(
+            FakeSocket(), "127.0.0.1", self.handler.server)
+        other.proxy_setup()
+        self.assertFalse(other.flush_cork)
+
     @patch('websockify.websocketproxy.ProxyRequestHandler.send_auth_error', MagicMock())
     def test_auth_plugin(self):
         class TestPlugin(auth_plugins.BasePlugin):
@@ -127,3 +193,252 @@ class ProxyRequestHandlerTestCase(unittest.TestCase):
 
         self.handler.server.target_host = "someotherhost"
         self.handler.auth_connection()
+
+    def test_proxy_events(self):
+        self.handler.cqueue = []
+        self.handler.c_pend = False
+        self.handler.tqueue = []
+        self.handler.closing = None
+        self.assertEqual(self.handler.proxy_events(),
+                         (selectors.EVENT_READ, selectors.EVENT_READ))
+
+        self.handler.cqueue = [b'data']
+        self.handler.tqueue = [b'data']
+        both = selectors.EVENT_READ | selectors.EVENT_WRITE
+        self.assertEqual(self.handler.proxy_events(), (both, both))
+
+        self.handler.cqueue = []
+        self.handler.c_pend = True
+        self.assertEqual(self.handler.proxy_events(), (both, both))
+
+        self.handler.closing = (1000, "Target closed")
+        self.assertEqual(self.handler.proxy_events(),
+                         (selectors.EVENT_WRITE, selectors.EVENT_WRITE))
+
+        self.handler.c_pend = False
+        self.assertEqual(self.handler.proxy_events(),
+                         (0, selectors.EVENT_WRITE))
+
+    def test_proxy_backpressure(self):
+        self.handler.cqueue = []
+        self.handler.c_pend = False
+        self.handler.tqueue = []
+        self.handler.closing = None
+        both = selectors.EVENT_READ | selectors.EVENT_WRITE
+
+        # Too much for the client stops reads from the target
+        self.handler.cqueue = [b'x' * 40]
+        self.handler.send_parts = [b'x' * 60]
+        self.handler.c_pend = True
+        self.assertEqual(self.handler.proxy_events(),
+                         (both, 0))
+
+        # ...until enough has been sent
+        self.handler.cqueue = []
+        self.assertEqual(self.handler.proxy_events(),
+                         (both, 0))
+        self.handler.send_parts = [b'x' * 50]
+        self.assertEqual(self.handler.proxy_events(),
+                         (both, selectors.EVENT_READ))
+
+        # And the same the other way
+        self.handler.send_parts = []
+        self.handler.c_pend = False
+        self.handler.tqueue = [b'x' * 100]
+        self.assertEqual(self.handler.proxy_events(),
+                         (0, both))
+        self.handler.tqueue = [b'x' * 10]
+        self.assertEqual(self.handler.proxy_events(),
+                         (selectors.EVENT_READ, both))
+
+        # Zero means no limit
+        self.handler.server.target_queue_high = 0
+        self.handler.tqueue = [b'x' * 1000]
+        self.assertEqual(self.handler.proxy_events(),
+                         (selectors.EVENT_READ, both))
+
+    def test_proxy_timeout(self):
+        self.handler.heartbeat = None
+        self.assertIsNone(self.handler.proxy_timeout())
+
+        self.handler.heartbeat = time.monotonic() + 10
+        self.assertTrue(9 < self.handler.proxy_timeout() <= 10)
+
+        self.handler.heartbeat = time.monotonic() - 10
+        self.assertEqual(self.handler.proxy_timeout(), 0)
+
+        # Held back data that is due sooner
+        self.handler.heartbeat = time.monotonic() + 10
+        self.handler.coalesce_deadline = time.monotonic() + 1
+        self.assertTrue(0 < self.handler.proxy_timeout() <= 1)
+
+        # ...but not once it is being sent
+        self.handler.coalesce_deadline = time.monotonic() - 1
+        self.assertTrue(9 < self.handler.proxy_timeout() <= 10)
+
+    def test_proxy_cork(self):
+        self.handler.request = MagicMock()
+        self.handler.flush_cork = True
+        self.handler.corked = False
+        self.handler.send_frames = MagicMock(return_value=True)
+
+        # Corked while there is more to send...
+        self.handler.cqueue = [b'data']
+        self.handler.proxy_client_writable()
+        self.handler.proxy_client_writable()
+        self.handler.request.setsockopt.assert_called_once_with(
+            socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+
+        # ...and released once it has been written
+        self.handler.send_frames.return_value = False
+        self.handler.proxy_client_writable()
+        self.handler.request.setsockopt.assert_called_with(
+            socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+        self.assertFalse(self.handler.corked)
+
+        # Only TCP sockets can be corked
+        self.handler.request.setsockopt.side_effect = OSError
+        self.handler.proxy_client_writable()
+        self.assertFalse(self.handler.flush_cork)
+
+    def test_queue_parts(self):
+        self.handler.queue_parts([b'a', b'b'])
+        self.assertEqual(self.handler.send_parts, [b'a', b'b'])
+
+        self.handler.send_parts = []
+        self.handler.coalesce_size = 4
+        self.handler.queue_parts([b'ab', b'c', b'de', b'fghij', b'k'])
+        self.assertEqual(self.handler.send_parts, [b'abc', b'de', b'fghij',
+                                                   b'k'])
+
+        self.handler.queue_parts([b'lmn', b'o'])
+        self.assertEqual(self.handler.send_parts, [b'abc', b'de', b'fghij',
+                                                   b'klmn', b'o'])
+
+        # A message that could not be sent is left as it is
+        self.handler.send_parts = [b'a']
+        self.handler.send_blocked = True
+        self.handler.queue_parts([b'b', b'c'])
+        self.assertEqual(self.handler.send_parts, [b'a', b'bc'])
+
+    def test_proxy_coalesce_delay(self):
+        self.handler.c_pend = False
+        self.handler.tqueue = []
+        self.handler.closing = None
+        self.handler.server.coalesce_size = 10
+        self.handler.flush_delay = 1000000
+        target = MagicMock()
+        target.recv.return_value = b'x' * 5
+        target.pending.return_value = False
+        self.handler.target_read_size = MagicMock(size=4096)
+
+        # Target data is held back for a while...
+        self.handler.cqueue = []
+        self.handler.proxy_target_readable(target)
+        self.assertIsNotNone(self.handler.coalesce_deadline)
+        self.assertEqual(self.handler.proxy_events(),
+                         (selectors.EVENT_READ, selectors.EVENT_READ))
+
+        # ...until there is enough of it
+        self.handler.proxy_target_readable(target)
+        self.assertEqual(self.handler.proxy_events(),
+                         (selectors.EVENT_READ | selectors.EVENT_WRITE,
+                          selectors.EVENT_READ))
+
+        # ...or it has waited long enough
+        self.handler.cqueue = [b'x']
+        self.handler.coalesce_deadline = time.monotonic() - 1
+        self.assertEqual(self.handler.proxy_events(),
+                         (selectors.EVENT_READ | selectors.EVENT_WRITE,
+                          selectors.EVENT_READ))
+
+    @patch('websockify.websocketproxy.ProxyRequestHandler.send_ping')
+    def test_proxy_heartbeat(self, send_ping):
+        self.handler.server.heartbeat = 10
+        self.handler.c_pend = False
+        self.handler.heartbeat = time.monotonic() + 10
+        self.handler.proxy_heartbeat()
+        send_ping.assert_not_called()
+
+        self.handler.heartbeat = time.monotonic() - 1
+        self.handler.proxy_heartbeat()
+        send_ping.assert_called_once_with()
+        self.assertTrue(self.handler.heartbeat > time.monotonic() + 9)
+
+        # No ping in the middle of sending a message
+        self.handler.c_pend = True
+        self.handler.heartbeat = time.monotonic() - 1
+        self.handler.proxy_heartbeat()
+        send_ping.assert_called_once_with()
+
+    def test_proxy_client_closed(self):
+        target = MagicMock()
+        target.send.side_effect = lambda data: max(1, len(data) // 2)
+        self.handler.cqueue = [b'for the client']
+        self.handler.c_pend = False
+        self.handler.tqueue = []
+        self.handler.closing = None
+        self.handler.recv_frames = MagicMock(
+            return_value=([b'last words'], {'code': 1000, 'reason': 'bye'}))
+
+        self.handler.proxy_client_readable()
+        self.assertEqual(self.handler.proxy_events(),
+                         (0, selectors.EVENT_WRITE))
+        self.handler.proxy_check_closed()
+
+        self.handler.proxy_target_writable(target)
+        self.handler.proxy_check_closed()
+        while self.handler.tqueue:
+            self.handler.proxy_target_writable(target)
+        target.send.assert_called_with(b's')
+        with self.assertRaises(self.handler.CClose) as cm:
+            self.handler.proxy_check_closed()
+        self.assertEqual(cm.exception.args, (1000, 'bye'))
+
+    def test_proxy_target_closed(self):
+        target = MagicMock()
+        target.recv.return_value = b''
+        self.handler.target_read_size = websocketproxy.ReadSizePolicy()
+        self.handler.cqueue = [b'for the client']
+        self.handler.c_pend = False
+        self.handler.tqueue = [b'for the target']
+        self.handler.closing = None
+
+        self.handler.proxy_target_readable(target)
+        self.assertEqual(self.handler.tqueue, [])
+        self.assertEqual(self.handler.proxy_events(),
+                         (selectors.EVENT_WRITE, 0))
+        self.handler.proxy_check_closed()
+
+        self.handler.cqueue = []
+        with self.assertRaises(self.handler.CClose) as cm:
+            self.handler.proxy_check_closed()
+        self.assertEqual(cm.exception.args, (1000, 'Target closed'))
+
+
+class FlushPolicyTestCase(unittest.TestCase):
+    def test_parse_flush_policy(self):
+        self.assertEqual(websocketproxy.parse_flush_policy("immediate"),
+                         ("immediate", 0))
+        self.assertEqual(websocketproxy.parse_flush_policy("cork"),
+                         ("cork", 0))
+        self.assertEqual(websocketproxy.parse_flush_policy("batch:500"),
+                         ("batch", 500))
+
+        for policy in ("", "batch", "batch:0", "batch:x", "cork:5", "nagle"):
+            with self.assertRaises(ValueError):
+                websocketproxy.parse_flush_policy(policy)
+
+
+class TokenCacheOptionTestCase(unittest.TestCase):
+    def test_parse_token_cache(self):
+        self.assertEqual(websocketproxy.parse_token_cache("5"),
+                         (5, 10000, 0))
+        self.assertEqual(websocketproxy.parse_token_cache("0.5,100"),
+                         (0.5, 100, 0))
+        self.assertEqual(websocketproxy.parse_token_cache("60,100,2"),
+                         (60, 100, 2))
+
+        for value in ("", "0", "5,0", "5,x", "5,10,-1", "5,10,1,1"):
+            with self.assertRaises(ValueError):
+                websocketproxy.parse_token_cache(value)
@@ -15,11 +15,12 @@
 #    under the License.
 
 """ Unit tests for websockifyserver """
+import datetime
 import errno
 import os
 import socket
 import ssl
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 import sys
 import tempfile
 import unittest
@@ -461,3 +462,147 @@ class WebSockifyServerTestCase(unittest.TestCase):
                                             socket.TCP_KEEPIDLE), keepidle)
         self.assertNotEqual(sock.getsockopt(socket.SOL_TCP,
                                             socket.TCP_KEEPINTVL), keepintvl)
+
+    @unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT'), "no SO_REUSEPORT")
+    def test_socket_reuse_port(self):
+        server = self._get_server(daemon=False, ssl_only=0, idle_timeout=1)
+        sock = server.socket('127.0.0.1', 0, reuse_port=True)
+        port = sock.getsockname()[1]
+        self.assertTrue(sock.getsockopt(socket.SOL_SOCKET,
+                                        socket.SO_REUSEPORT))
+
+        # A second socket can listen on the same port
+        other = server.socket('127.0.0.1', port, reuse_port=True)
+        self.assertEqual(other.getsockname()[1], port)
+
+        other.close()
+        sock.close()
+
+    def _get_ssl_server(self, **kwargs):
+        fd, cert = tempfile.mkstemp('.pem')
+        os.close(fd)
+        self.addCleanup(os.remove, cert)
+
+        server = self._get_server(daemon=False, cert=cert, **kwargs)
+        create = patch.object(server, 'create_ssl_context').start()
+        create.side_effect = lambda: object()
+        return server, create
+
+    def _touch(self, path):
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+
+    def test_ssl_context_is_kept(self):
+        server, create = self._get_ssl_server()
+
+        context = server.ssl_context()
+        self.assertIs(server.ssl_context(), context)
+        server.update_ssl_context()
+        self.assertIs(server.ssl_context(), context)
+        self.assertEqual(create.call_count, 1)
+
+        # A new certificate needs a new context
+        self._touch(server.cert)
+        self.assertIs(server.ssl_context(), context)
+        server.update_ssl_context()
+        self.assertIsNot(server.ssl_context(), context)
+        self.assertEqual(create.call_count, 2)
+
+    def test_ssl_context_reload_failed(self):
+        server, create = self._get_ssl_server()
+        warn = patch.object(server, 'warn').start()
+        server.update_ssl_context()
+        context = server.ssl_context()
+
+        create.side_effect = ssl.SSLError("bad key")
+        self._touch(server.cert)
+        server.update_ssl_context()
+        self.assertIs(server.ssl_context(), context)
+        self.assertEqual(warn.call_count, 1)
+
+        # Not tried again until something changes
+        server.update_ssl_context()
+        self.assertEqual(create.call_count, 2)
+
+        create.side_effect = lambda: object()
+        server.request_ssl_reload()
+        server.update_ssl_context()
+        self.assertIsNot(server.ssl_context(), context)
+
+    def test_ssl_context_rotation(self):
+        server, create = self._get_ssl_server(ssl_ticket_rotation=60)
+        monotonic = patch('time.monotonic').start()
+
+        monotonic.return_value = 100
+        server.update_ssl_context()
+        context = server.ssl_context()
+        monotonic.return_value = 159
+        server.update_ssl_context()
+        self.assertIs(server.ssl_context(), context)
+        monotonic.return_value = 160
+        server.update_ssl_context()
+        self.assertIsNot(server.ssl_context(), context)
+
+        server.ssl_ticket_rotation = 0
+        context = server.ssl_context()
+        monotonic.return_value = 10000
+        server.update_ssl_context()
+        self.assertIs(server.ssl_context(), context)
+
+    def test_cert_expiry(self):
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import ec
+        from cryptography.x509.oid import NameOID
+
+        key = ec.generate_private_key(ec.SECP256R1())
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'localhost')])
+        cert = (x509.CertificateBuilder()
+                .subject_name(name).issuer_name(name)
+                .public_key(key.public_key())
+                .serial_number(1)
+                .not_valid_before(datetime.datetime(2020, 1, 1))
+                .not_valid_after(datetime.datetime(2030, 6, 1, 12))
+                .sign(key, hashes.SHA256()))
+
+        fd, path = tempfile.mkstemp('.pem')
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'wb') as f:
+            # Key first, as in a combined file
+            f.write(key.private_bytes(serialization.Encoding.PEM,
+                                      serialization.PrivateFormat.PKCS8,
+                                      serialization.NoEncryption()))
+            f.write(cert.public_bytes(serialization.Encoding.PEM))
+
+        self.assertEqual(websockifyserver.WebSockifyServer.cert_expiry(path),
+                         '2030-06-01 12:00:00 UTC')
+        self.assertIsNone(websockifyserver.WebSockifyServer.cert_expiry(
+            os.path.join(self.tmpdir, 'missing.pem')))
+
+    def test_ktls_offload(self):
+        sock = socket.socket()
+        self.addCleanup(sock.close)
+        self.assertEqual(websockifyserver.ktls_offload(sock), "off")
+
+        def fake_getsockopt(level, opt, size):
+            if opt != websockifyserver.TLS_TX:
+                raise OSError(errno.EBUSY, "Busy")
+            return b'\x03\x03\x33\x00'
+
+        fake = Mock(getsockopt=fake_getsockopt)
+        with patch('sys.platform', 'linux'):
+            self.assertEqual(websockifyserver.ktls_offload(fake), "tx")
+
+    @patch('ssl.OP_ENABLE_KTLS', 0x8, create=True)
+    def test_create_ssl_context_ktls(self):
+        context = Mock(options=0)
+        patch('ssl.create_default_context').start().return_value = context
+
+        server = self._get_server(daemon=False, ssl_options=0x100)
+        server.create_ssl_context()
+        self.assertEqual(context.options, 0x100)
+
+        server = self._get_server(daemon=False, ssl_options=0x100,
+                                  ssl_ktls=True)
+        server.create_ssl_context()
+        self.assertEqual(context.options, 0x108)
@@ -0,0 +1,704 @@
+'''
+A websockify engine that serves every connection from one asyncio event loop
+Licensed under LGPL version 3 (see docs/LICENSE.LGPL-3)
+
+WebSocketProxy forks a process for every connection. AsyncioProxyServer
+instead keeps all connections in a single process, which makes idle
+connections a lot cheaper. The TLS and WebSocket handshakes and the
+relay run on the event loop. The parts that may block, i.e. parsing the
+HTTP request, serving files, the token and auth plugins and connecting
+to the target, run in the loop's default executor.
+
+To make use of more than one CPU core, AsyncioProxyServer can also fork
+a number of worker processes that each run their own event loop. Every
+worker listens on its own SO_REUSEPORT socket, so the kernel spreads
+the connections over them.
+'''
+
+import asyncio
+import copy
+import io
+import multiprocessing
+import multiprocessing.connection
+import os
+import selectors
+import signal
+import socket
+import ssl
+import sys
+import time
+
+from websockify import metrics
+from websockify import websockifyserver
+from websockify.websocket import WebSocketWantWriteError
+from websockify.websocketproxy import ProxyRequestHandler, WebSocketProxy
+
+
+async def _wait(sock, write=False, timeout=None):
+    # Waits until sock is readable, or writable if write is set
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+
+    def wakeup():
+        if not ready.done():
+            ready.set_result(None)
+
+    if write:
+        loop.add_writer(sock, wakeup)
+    else:
+        loop.add_reader(sock, wakeup)
+    try:
+        await asyncio.wait_for(ready, timeout)
+    finally:
+        if write:
+            loop.remove_writer(sock)
+        else:
+            loop.remove_reader(sock)
+
+
+async def _recv(sock, size):
+    # Like sock.recv(), but waits for data without blocking the loop
+    while True:
+        try:
+            return sock.recv(size)
+        except (BlockingIOError, ssl.SSLWantReadError):
+            await _wait(sock)
+        except ssl.SSLWantWriteError:
+            await _wait(sock, write=True)
+
+
+async def _sendall(sock, data):
+    # Like sock.sendall(), but waits for space without blocking the loop
+    view = memoryview(data)
+    while view:
+        try:
+            sent = sock.send(view)
+        except (BlockingIOError, ssl.SSLWantWriteError):
+            await _wait(sock, write=True)
+            continue
+        except ssl.SSLWantReadError:
+            await _wait(sock)
+            continue
+        view = view[sent:]
+
+
+async def _ssl_handshake(sock):
+    # Completes the handshake of a non-blocking SSL socket
+    while True:
+        try:
+            sock.do_handshake()
+            return
+        except ssl.SSLWantReadError:
+            await _wait(sock)
+        except ssl.SSLWantWriteError:
+            await _wait(sock, write=True)
+
+
+class BufferedWebSocket(websockifyserver.CompatibleWebSocket):
+    """
+    WebSocket that keeps any data the socket cannot take right away
+    queued, instead of raising WebSocketWantWriteError. The event loop
+    calls flush() once the socket is writable again.
+    """
+
+    def _flush(self):
+        if self.socket is None:
+            # The connection is gone, so there is nowhere to send it
+            self._protocol.data_to_send()
+            return
+
+        try:
+            super()._flush()
+        except WebSocketWantWriteError:
+            pass
+
+    def flush(self):
+        """Sends as much queued data as possible. Returns True if some
+        of it is still waiting for the socket to become writable."""
+        self._flush()
+        return self.send_pending()
+
+    def send_pending(self):
+        """Returns True if there is queued data that has not been sent."""
+        return self._protocol.has_data_to_send()
+
+    def send_queue_size(self):
+        """Returns the number of bytes queued that have not been sent."""
+        return self._protocol.send_queue_size()
+
+
+class AsyncioProxyRequestHandler(ProxyRequestHandler):
+    """
+    ProxyRequestHandler for AsyncioProxyServer. Creating it only sets
+    it up, the connection is then served by handle_async().
+    """
+
+    SocketClass = BufferedWebSocket
+
+    # Largest request line and headers accepted from a client
+    max_request_size = 65536
+
+    def setup(self):
+        self.connection = self.request
+        self.rfile = io.BytesIO()
+        self.wfile = io.BytesIO()
+        self.upgrade = False
+
+    def handle(self):
+        # Done by handle_async()
+        pass
+
+    def finish(self):
+        # Done by handle_async()
+        pass
+
+    async def handle_async(self):
+        """
+        Serves a single request, which is normally a WebSocket upgrade.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            self.rfile = io.BytesIO(await self.read_request())
+
+            try:
+                # Parsing the request, serving files and running the
+                # token and auth plugins may all block
+                await loop.run_in_executor(None, self.handle_one_request)
+            finally:
+                # Send the response, including any errors
+                await self.flush_wfile()
+
+            if self.upgrade:
+                await self.handle_upgrade_async()
+        finally:
+            super().finish()
+
+    async def read_request(self):
+        """
+        Reads the request line and headers from the client.
+        """
+        data = b''
+        while b'\r\n\r\n' not in data and b'\n\n' not in data:
+            if len(data) >= self.max_request_size:
+                break
+            buf = await _recv(self.connection, 4096)
+            if not buf:
+                break
+            data += buf
+        return data
+
+    async def flush_wfile(self):
+        """
+        Sends everything written to wfile to the client.
+        """
+        data = self.wfile.getvalue()
+        if data:
+            self.wfile.seek(0)
+            self.wfile.truncate()
+            await _sendall(self.connection, data)
+
+    async def flush_websocket(self):
+        """
+        Waits until the WebSocket has sent all queued data.
+        """
+        while self.request.flush():
+            await _wait(self.connection, write=True)
+
+    def handle_upgrade(self):
+        # Called by handle_one_request() in the executor, so only
+        # do the checks that might block here, and leave the rest
+        # to handle_upgrade_async()
+        self.validate_connection()
+        self.auth_connection()
+        self.upgrade = True
+
+    async def handle_upgrade_async(self):
+        websocket = self.SocketClass(self)
+        try:
+            websocket.accept(self.request, self.headers)
+        except Exception:
+            exc = sys.exc_info()[1]
+            self.send_error(400, str(exc))
+            await self.flush_wfile()
+            return
+
+        await self.flush_wfile()
+
+        self.request = websocket
+
+        # Other requests cannot follow Websocket data
+        self.close_connection = True
+
+        self.setup_websocket()
+
+        metrics.sessions.inc()
+        try:
+            await self.new_websocket_client_async()
+        except self.CClose:
+            # Close the client
+            _, exc, _ = sys.exc_info()
+            self.send_close(exc.args[0], exc.args[1])
+        finally:
+            metrics.sessions.dec()
+
+        await self.flush_websocket()
+
+    async def new_websocket_client_async(self):
+        """
+        Same as new_websocket_client(), but without blocking the loop.
+        """
+        loop = asyncio.get_running_loop()
+        tsock = await loop.run_in_executor(None, self.connect_target)
+
+        try:
+            tsock.setblocking(False)
+            await self.do_proxy_async(tsock)
+        finally:
+            self.close_target(tsock)
+
+    async def do_proxy_async(self, target):
+        """
+        Proxy client WebSocket to normal target socket, using the
+        event loop to call the same proxy_*() methods as do_proxy().
+        """
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        client = self.connection
+        callbacks = {
+            client: (self.proxy_client_readable,
+                     self.proxy_client_writable),
+            target: (lambda: self.proxy_target_readable(target),
+                     lambda: self.proxy_target_writable(target)),
+        }
+        watched = {client: 0, target: 0}
+        timer = None
+
+        def run(func):
+            if done.done():
+                return
+            try:
+                func()
+                self.proxy_check_closed()
+                update()
+            except Exception as exc:
+                done.set_exception(exc)
+
+        def update():
+            nonlocal timer
+            for sock, events in zip((client, target), self.proxy_events()):
+                changed = watched[sock] ^ events
+                readable, writable = callbacks[sock]
+                if changed & selectors.EVENT_READ:
+                    if events & selectors.EVENT_READ:
+                        loop.add_reader(sock, run, readable)
+                    else:
+                        loop.remove_reader(sock)
+                if changed & selectors.EVENT_WRITE:
+                    if events & selectors.EVENT_WRITE:
+                        loop.add_writer(sock, run, writable)
+                    else:
+                        loop.remove_writer(sock)
+                watched[sock] = events
+
+            # The loop's clock is time.monotonic(), like the deadline
+            deadline = self.proxy_deadline()
+            if deadline is not None:
+                if timer is None or timer.when() > deadline:
+                    if timer is not None:
+                        timer.cancel()
+                    timer = loop.call_at(deadline, wakeup)
+
+        def wakeup():
+            nonlocal timer
+            timer = None
+            run(self.proxy_heartbeat)
+
+        self.proxy_setup()
+        update()
+
+        try:
+            await done
+        finally:
+            if timer is not None:
+                timer.cancel()
+            for sock, events in watched.items():
+                if events & selectors.EVENT_READ:
+                    loop.remove_reader(sock)
+                if events & selectors.EVENT_WRITE:
+                    loop.remove_writer(sock)
+
+    def proxy_events(self):
+        # The WebSocket can also queue data on its own, e.g. pongs
+        self.c_pend = self.request.send_pending()
+        return super().proxy_events()
+
+    def send_frames(self, bufs=None):
+        super().send_frames(bufs)
+        return self.request.flush()
+
+    def client_queue_size(self):
+        # Messages are queued by the WebSocket rather than send_frames()
+        return super().client_queue_size() + self.request.send_queue_size()
+
+
+class AsyncioProxyServer(WebSocketProxy):
+    """
+    Just like WebSocketProxy, but serves all connections from a single
+    asyncio event loop instead of a process per connection.
+    """
+
+    # A worker that crashes sooner than this many seconds after it was
+    # started is restarted only after this delay
+    worker_restart_delay = 1
+
+    def __init__(self, RequestHandlerClass=AsyncioProxyRequestHandler, *args, **kwargs):
+        self.workers = kwargs.pop('workers', 0)
+
+        self.clients = set()
+        self._stop = None
+        self._refreshing = None
+        # Which worker this is, in a worker process
+        self.worker = None
+        self.handler_id_step = 1
+
+        super().__init__(RequestHandlerClass, *args, **kwargs)
+
+        if self.workers:
+            self.msg("  - %d worker processes", self.workers)
+
+    def start_server(self):
+        """
+        Daemonize if requested, then serve connections until
+        terminated.
+        """
+        if self.workers:
+            self.start_workers()
+            return
+
+        lsock = self.listen_socket()
+
+        if self.daemon:
+            keepfd = self.get_log_fd()
+            keepfd.append(lsock.fileno())
+            self.daemonize(keepfd=keepfd, chdir=self.web)
+
+        self.start_metrics()
+        self.started()  # Some things need to happen after daemonizing
+        self.update_ssl_context()
+
+        try:
+            asyncio.run(self._main(lsock))
+        finally:
+            # Close listen port
+            self.vmsg("Closing socket listening at %s:%s",
+                      self.listen_host, self.listen_port)
+            lsock.close()
+
+    def start_workers(self):
+        """
+        Forks the worker processes and keeps them running until
+        terminated. Workers that crash are restarted.
+        """
+        # Fail early if the port cannot be used. The workers open
+        # their own sockets.
+        self.listen_socket(reuse_port=True).close()
+
+        if self.daemon:
+            self.daemonize(keepfd=self.get_log_fd(), chdir=self.web)
+
+        # The workers report their metrics to this process
+        self.start_metrics()
+        self.started()  # Some things need to happen after daemonizing
+        # A new context would have a new session ticket key, which the
+        # running workers do not know
+        if self.ssl_ticket_rotation:
+            self.warn("Session ticket keys are not rotated with workers, "
+                      "only when the certificate is reloaded")
+            self.ssl_ticket_rotation = 0
+        self.update_ssl_context()
+
+        original_signals = {
+            signal.SIGINT: signal.getsignal(signal.SIGINT),
+            signal.SIGTERM: signal.getsignal(signal.SIGTERM),
+        }
+        signal.signal(signal.SIGINT, self.do_SIGINT)
+        signal.signal(signal.SIGTERM, self.do_SIGTERM)
+
+        workers = {}
+        started = {}
+        restarts = {}
+
+        def do_SIGHUP(sig, stack):
+            # Workers started later get the new context from here
+            self.request_ssl_reload()
+            for proc in workers.values():
+                try:
+                    os.kill(proc.pid, signal.SIGHUP)
+                except OSError:
+                    pass
+
+        if getattr(signal, 'SIGHUP', None) is not None:
+            original_signals[signal.SIGHUP] = signal.getsignal(signal.SIGHUP)
+            signal.signal(signal.SIGHUP, do_SIGHUP)
+
+        try:
+            for index in range(self.workers):
+                workers[index] = self.start_worker(index)
+                started[index] = time.time()
+
+            while workers or restarts:
+                multiprocessing.connection.wait(
+                    [proc.sentinel for proc in workers.values()], 1)
+
+                self.poll()
+                self.update_ssl_context()
+
+                now = time.time()
+                for index, proc in list(workers.items()):
+                    if proc.exitcode is None:
+                        continue
+
+                    del workers[index]
+                    if proc.exitcode == 0:
+                        self.vmsg("Worker %d (pid %d) finished",
+                                  index, proc.pid)
+                        continue
+
+                    self.warn("Worker %d (pid %d) exited with status %d, restarting",
+                              index, proc.pid, proc.exitcode)
+                    if now - started[index] < self.worker_restart_delay:
+                        restarts[index] = now + self.worker_restart_delay
+                    else:
+                        restarts[index] = now
+
+                for index, when in list(restarts.items()):
+                    if now >= when:
+                        del restarts[index]
+                        workers[index] = self.start_worker(index)
+                        started[index] = now
+
+        except (self.Terminate, SystemExit, KeyboardInterrupt):
+            self.msg("In exit")
+        finally:
+            for proc in workers.values():
+                self.msg("Terminating worker %s" % proc.pid)
+                proc.terminate()
+            for proc in workers.values():
+                proc.join()
+
+            # Restore signals
+            for sig, func in original_signals.items():
+                signal.signal(sig, func)
+
+    def start_worker(self, index):
+        """
+        Starts worker process number index.
+        """
+        proc = multiprocessing.Process(target=self.run_worker,
+                                       args=(index,))
+        proc.start()
+        self.vmsg("Started worker %d (pid %d)", index, proc.pid)
+        return proc
+
+    def run_worker(self, index):
+        """
+        Serves connections in a worker process.
+        """
+        # The event loop sets up its own handlers
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        if getattr(signal, 'SIGHUP', None) is not None:
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        self.worker = index
+        # Keep handler ids, and with that recording file names, unique
+        # across the workers
+        self.handler_id = index + 1
+        self.handler_id_step = self.workers
+
+        try:
+            lsock = self.listen_socket(reuse_port=True)
+        except SystemExit:
+            # A failure, so that the worker is started again later
+            sys.exit(1)
+        try:
+            asyncio.run(self._main(lsock))
+        finally:
+            lsock.close()
+
+    async def _main(self, lsock):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+        if getattr(signal, 'SIGHUP', None) is not None:
+            loop.add_signal_handler(signal.SIGHUP, self.request_ssl_reload)
+        await self.serve(lsock)
+
+    def stop(self):
+        """
+        Makes serve() return. Must be called from the event loop.
+        """
+        if self._stop is not None:
+            self._stop.set()
+
+    async def serve(self, lsock):
+        """
+        Accepts and serves connections on lsock until stop() is called
+        or the server times out.
+        """
+        loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        last_active_time = self.launch_time
+
+        lsock.setblocking(False)
+        loop.add_reader(lsock, self._accept, lsock)
+        try:
+            while not self._stop.is_set():
+                try:
+                    await asyncio.wait_for(self._stop.wait(), 1)
+                    break
+                except asyncio.TimeoutError:
+                    pass
+
+                # The parent takes care of this for the workers
+                if self.worker is None:
+                    self.poll()
+                else:
+                    metrics.REGISTRY.flush()
+                    self.refresh_token_plugin()
+                self.update_ssl_context()
+
+                time_elapsed = time.time() - self.launch_time
+                if self.timeout and time_elapsed > self.timeout:
+                    self.msg('listener exit due to --timeout %s'
+                             % self.timeout)
+                    break
+
+                if self.clients:
+                    last_active_time = time.time()
+                elif self.idle_timeout:
+                    idle_time = time.time() - last_active_time
+                    if idle_time > self.idle_timeout:
+                        self.msg('listener exit due to --idle-timeout %s'
+                                 % self.idle_timeout)
+                        break
+        finally:
+            self.msg("In exit")
+            loop.remove_reader(lsock)
+            for task in self.clients:
+                task.cancel()
+            await asyncio.gather(*self.clients, return_exceptions=True)
+
+    def refresh_token_plugin(self):
+        """
+        Refreshes the token plugin in the executor once the event loop
+        runs, as reading token files can take a while. A refresh is
+        skipped while the previous one is still going.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            super().refresh_token_plugin()
+            return
+
+        if self._refreshing is not None and not self._refreshing.done():
+            return
+        self._refreshing = loop.run_in_executor(
+            None, super().refresh_token_plugin)
+
+    def _accept(self, lsock):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                startsock, address = lsock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as exc:
+                self.msg("accept failed: %s", str(exc))
+                return
+
+            # Unix Socket will not report address (empty string), but address[0] is logged a bunch
+            if self.unix_listen is not None:
+                address = [self.unix_listen]
+
+            self.vmsg('%s: new handler task' % address[0])
+            # Each connection gets its own copy of the server, like
+            # the processes that WebSocketProxy forks
+            task = loop.create_task(
+                copy.copy(self).top_new_client_async(startsock, address))
+            self.clients.add(task)
+            task.add_done_callback(self._client_done)
+
+            self.handler_id += self.handler_id_step
+
+    def _client_done(self, task):
+        self.clients.discard(task)
+        if task.cancelled():
+            return
+        if self.run_once and task.result():
+            self.msg('exiting due to --run-once')
+            self.stop()
+
+    async def top_new_client_async(self, startsock, address):
+        """
+        Same as top_new_client(), but for the event loop. Returns True
+        if the connection was a WebSocket connection.
+        """
+        self.accept_time = time.monotonic()
+        metrics.connections.inc()
+        try:
+            startsock.setblocking(False)
+            await self.do_handshake_async(startsock, address)
+        except self.EClose:
+            _, exc, _ = sys.exc_info()
+            # Connection was not a WebSockets connection
+            if exc.args[0]:
+                self.msg("%s: %s" % (address[0], exc.args[0]))
+        except Exception:
+            _, exc, _ = sys.exc_info()
+            self.msg("handler exception: %s" % str(exc))
+            self.vmsg("exception", exc_info=True)
+        finally:
+            startsock.close()
+
+        return self.ws_connection
+
+    async def do_handshake_async(self, sock, address):
+        """
+        Same as do_handshake(), but without blocking the event loop.
+        The connection has been served once this returns.
+        """
+        try:
+            await _wait(sock, timeout=3)
+        except asyncio.TimeoutError:
+            raise self.EClose("")
+        # Peek, but do not read the data so that we have a opportunity
+        # to SSL wrap the socket first
+        handshake = sock.recv(1024, socket.MSG_PEEK)
+
+        if self.is_ssl_handshake(handshake):
+            retsock = self.ssl_context().wrap_socket(
+                sock,
+                server_side=True,
+                do_handshake_on_connect=False)
+        else:
+            retsock = sock
+
+        try:
+            if retsock is not sock:
+                try:
+                    await _ssl_handshake(retsock)
+                except ssl.SSLError:
+                    _, x, _ = sys.exc_info()
+                    self.ssl_error(x)
+
+            # If the address is like (host, port), we are extending it
+            # with a flag indicating SSL. Not many other options
+            # available...
+            if len(address) == 2:
+                address = (address[0], address[1], (retsock is not sock))
+
+            handler = self.RequestHandlerClass(retsock, address, self)
+            await handler.handle_async()
+        finally:
+            retsock.close()
@@ -0,0 +1,199 @@
+'''
+permessage-deflate WebSocket compression (RFC 7692)
+Licensed under LGPL version 3 (see docs/LICENSE.LGPL-3)
+
+negotiate() picks one of the configurations that a client offers in its
+Sec-WebSocket-Extensions header, and returns a PerMessageDeflate object
+that compresses and decompresses messages for that connection.
+
+Compression is skipped for small messages, and for a while after
+messages that hardly compress, like the JPEG or ZRLE encoded rectangles
+that a VNC server often sends. Such data would otherwise cost CPU time
+for no gain in bandwidth.
+'''
+
+import zlib
+
+# Appended to every message by a sync flush, and left out on the wire
+_TAIL = b'\x00\x00\xff\xff'
+
+
+class MessageTooLarge(ValueError):
+    pass
+
+
+class PerMessageDeflate:
+    """Compression state for one connection, for the server side.
+
+    level is the zlib compression level, and messages smaller than
+    threshold bytes are sent uncompressed. window_bits and
+    no_context_takeover are what was agreed on for messages that are
+    sent, and response is the negotiated Sec-WebSocket-Extensions value.
+    """
+
+    # A message is sent compressed only if this makes it smaller than
+    # this fraction of the original
+    MAX_RATIO = 0.9
+
+    # After a message that did not compress well, compression is
+    # skipped for a number of messages that doubles up to this
+    MAX_BACKOFF = 64
+
+    # Largest message accepted after decompression
+    MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, level=6, threshold=128, window_bits=15,
+                 no_context_takeover=False, response='permessage-deflate'):
+        self.level = level
+        self.threshold = threshold
+        self.window_bits = window_bits
+        self.no_context_takeover = no_context_takeover
+        self.response = response
+
+        self._compressor = None
+        self._decompressor = None
+        self._backoff = 0
+        self._skip = 0
+
+        self.messages = 0
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def compress(self, data):
+        """Returns the payload to send for a message, and whether it
+        was compressed"""
+        self.messages += 1
+        self.bytes_in += len(data)
+
+        if len(data) < self.threshold or self._skip:
+            if self._skip:
+                self._skip -= 1
+            self.bytes_out += len(data)
+            return data, False
+
+        if self._compressor is None:
+            self._compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                                -self.window_bits)
+        payload = (self._compressor.compress(data) +
+                   self._compressor.flush(zlib.Z_SYNC_FLUSH))[:-len(_TAIL)]
+
+        if self.no_context_takeover:
+            self._compressor = None
+
+        if len(payload) > len(data) * self.MAX_RATIO:
+            # The peer never sees this data compressed, so later
+            # messages must not refer back to it
+            self._compressor = None
+            self._backoff = min(max(self._backoff * 2, 1), self.MAX_BACKOFF)
+            self._skip = self._backoff
+            self.bytes_out += len(data)
+            return data, False
+
+        self._backoff = 0
+        self.compressed += 1
+        self.bytes_out += len(payload)
+        return payload, True
+
+    def decompress(self, payload):
+        """Returns the original data of a compressed message. Raises
+        ValueError if it is invalid, or MessageTooLarge if it is too
+        large."""
+        if self._decompressor is None:
+            # A larger window than the peer uses works just as well
+            self._decompressor = zlib.decompressobj(-15)
+
+        try:
+            data = self._decompressor.decompress(payload + _TAIL,
+                                                 self.MAX_MESSAGE_SIZE)
+        except zlib.error as e:
+            raise ValueError("Invalid compressed data: %s" % e)
+
+        if self._decompressor.unconsumed_tail:
+            raise MessageTooLarge("Message too large")
+
+        return data
+
+    def stats(self):
+        """Returns a short description of the statistics"""
+        return ("%d of %d messages compressed, %d bytes to %d" %
+                (self.compressed, self.messages,
+                 self.bytes_in, self.bytes_out))
+
+
+def parse_offers(header):
+    """Returns the permessage-deflate offers in a Sec-WebSocket-Extensions
+    header, as lists of (name, value) parameters. value is None for a
+    parameter without a value."""
+    offers = []
+    for extension in header.split(','):
+        parts = [part.strip() for part in extension.split(';')]
+        if parts[0] != 'permessage-deflate':
+            continue
+        params = []
+        for param in parts[1:]:
+            name, sep, value = param.partition('=')
+            value = value.strip().strip('"') if sep else None
+            params.append((name.strip(), value))
+        offers.append(params)
+    return offers
+
+
+def _window_bits(value):
+    if value is None or not value.isdigit() or not 8 <= int(value) <= 15:
+        raise ValueError("Invalid window bits: %s" % value)
+    return int(value)
+
+
+def _accept_offer(params, level, threshold, window_bits,
+                  no_context_takeover):
+    # Returns a PerMessageDeflate for an offer, or raises ValueError
+    names = [name for name, value in params]
+    if len(set(names)) != len(names):
+        raise ValueError("Duplicate parameter")
+
+    response = ['permessage-deflate']
+    for name, value in params:
+        if name == 'server_no_context_takeover':
+            if value is not None:
+                raise ValueError("Unexpected value for %s" % name)
+            no_context_takeover = True
+        elif name == 'client_no_context_takeover':
+            # Only a hint, the client's own context does not matter
+            if value is not None:
+                raise ValueError("Unexpected value for %s" % name)
+        elif name == 'server_max_window_bits':
+            # zlib cannot make raw deflate data with an 8 bit window
+            bits = _window_bits(value)
+            if bits < 9:
+                raise ValueError("Unsupported window bits: %d" % bits)
+            window_bits = min(window_bits, bits)
+            response.append('server_max_window_bits=%d' % window_bits)
+        elif name == 'client_max_window_bits':
+            if value is not None:
+                _window_bits(value)
+        else:
+            raise ValueError("Unknown parameter %s" % name)
+
+    if no_context_takeover:
+        response.insert(1, 'server_no_context_takeover')
+
+    return PerMessageDeflate(level, threshold, window_bits,
+                             no_context_takeover, '; '.join(response))
+
+
+def negotiate(offers, level=6, threshold=128, window_bits=15,
+              no_context_takeover=False):
+    """Returns a PerMessageDeflate for the first acceptable offer from
+    parse_offers(), or None if none of them are.
+
+    window_bits and no_context_takeover are the server's preferences,
+    which a client can only make stricter.
+    """
+    for params in offers:
+        try:
+            return _accept_offer(params, level, threshold, window_bits,
+                                 no_context_takeover)
+        except ValueError:
+            continue
+    return None
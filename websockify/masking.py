@@ -0,0 +1,127 @@
+'''
+WebSocket payload masking
+Licensed under LGPL version 3 (see docs/LICENSE.LGPL-3)
+
+Masking XORs every payload byte with a repeating four byte key. Every
+frame from a client is masked, so this needs to be fast. There are
+several implementations, and the fastest available one is picked
+automatically unless select_backend() is used:
+
+    - python: XOR of the whole buffer as one big integer
+    - numpy: XOR of 32-bit words using numpy
+    - wsaccel: the C implementation from the wsaccel module
+
+All of them work in place on a writable buffer, such as a bytearray
+or a memoryview of one.
+'''
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from wsaccel.xormask import XorMaskerSimple
+except ImportError:
+    XorMaskerSimple = None
+
+
+# Buffers smaller than this are handled better by the backends that
+# have less fixed overhead than numpy
+SMALL_BUFFER = 1024
+
+
+def mask_python(buf, key):
+    """Masks buf in place by treating it as one large integer"""
+    length = len(buf)
+    words, rest = divmod(length, 4)
+    key = key * words + key[:rest]
+    data = int.from_bytes(buf, 'little') ^ int.from_bytes(key, 'little')
+    buf[:] = data.to_bytes(length, 'little')
+
+
+def mask_numpy(buf, key):
+    """Masks buf in place using numpy"""
+    length = len(buf)
+    words = length // 4
+    if words:
+        data = numpy.frombuffer(buf, numpy.uint32, count=words)
+        numpy.bitwise_xor(data, numpy.frombuffer(key, numpy.uint32),
+                          out=data)
+    for i in range(words * 4, length):
+        buf[i] ^= key[i % 4]
+
+
+def mask_wsaccel(buf, key):
+    """Masks buf in place using wsaccel"""
+    buf[:] = XorMaskerSimple(key).process(bytes(buf))
+
+
+backends = {'python': mask_python}
+if numpy:
+    backends['numpy'] = mask_numpy
+if XorMaskerSimple:
+    backends['wsaccel'] = mask_wsaccel
+
+_backend = None
+_mask = None
+
+
+def _auto_backend():
+    # Returns a function that picks the best backend for the size of
+    # each buffer, and a description of what it picked
+    if 'wsaccel' in backends:
+        small = 'wsaccel'
+    else:
+        small = 'python'
+
+    if 'numpy' in backends:
+        large = 'numpy'
+    else:
+        large = small
+
+    if small == large:
+        return backends[small], "auto (%s)" % small
+
+    small_func = backends[small]
+    large_func = backends[large]
+
+    def mask_auto(buf, key):
+        if len(buf) < SMALL_BUFFER:
+            small_func(buf, key)
+        else:
+            large_func(buf, key)
+
+    return mask_auto, "auto (%s/%s)" % (small, large)
+
+
+def select_backend(name='auto'):
+    """Selects which implementation mask() uses.
+
+    name is either one of the keys in backends, or 'auto' to pick
+    the fastest available implementation. Returns a description of
+    the selected backend.
+    """
+    global _backend, _mask
+
+    if name == 'auto':
+        _mask, _backend = _auto_backend()
+    elif name in backends:
+        _mask, _backend = backends[name], name
+    else:
+        raise ValueError("Unknown or unavailable masking backend '%s'" % name)
+
+    return _backend
+
+
+def backend():
+    """Returns a description of the masking backend in use"""
+    return _backend
+
+
+def mask(buf, key):
+    """Masks (or unmasks) buf in place using the four byte key"""
+    _mask(buf, key)
+
+
+select_backend()
@@ -0,0 +1,379 @@
+'''
+Metrics in the Prometheus text format
+Licensed under LGPL version 3 (see docs/LICENSE.LGPL-3)
+
+Counters, gauges and histograms are kept in a Registry, and nothing is
+recorded until the registry has been enabled. Connections are usually
+handled in forked processes, so a forked process only collects changes
+and sends them to the process that enabled the registry, which adds
+them up and serves the totals over HTTP.
+'''
+
+import bisect
+import json
+import os
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Suitable for latencies in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        value = value.replace('\n', '\\n')
+        escaped.append('%s="%s"' % (name, value))
+    return '{%s}' % ','.join(escaped)
+
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return repr(value)
+
+
+class Metric:
+    """
+    Base class for metrics. Values are kept per combination of label
+    values, which are given as a tuple when updating the metric.
+    """
+
+    type = None
+
+    def __init__(self, registry, name, help, labels=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def _apply(self, key, value):
+        # Records an update, with the registry locked
+        self._values[key] = self._values.get(key, 0) + value
+
+    def _merge(self, key, delta):
+        # Adds changes collected by another process
+        self._apply(key, delta)
+
+    def _samples(self):
+        values = self._values
+        if not values and not self.labels:
+            values = {(): 0}
+        for key, value in sorted(values.items()):
+            yield self.name, _format_labels(self.labels, key), value
+
+
+class Counter(Metric):
+    """A value that only goes up"""
+
+    type = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        self.registry._update(self, labels, amount)
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. Changes to an urgent gauge are
+    reported by forked processes right away.
+    """
+
+    type = 'gauge'
+
+    def __init__(self, registry, name, help, labels=(), urgent=True):
+        super().__init__(registry, name, help, labels)
+        self.urgent = urgent
+
+    def inc(self, amount=1, labels=()):
+        self.registry._update(self, labels, amount, urgent=self.urgent)
+
+    def dec(self, amount=1, labels=()):
+        self.registry._update(self, labels, -amount, urgent=self.urgent)
+
+
+class Histogram(Metric):
+    """Counts observed values in buckets"""
+
+    type = 'histogram'
+
+    def __init__(self, registry, name, help, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        self.registry._update(self, labels, value)
+
+    def _state(self, key):
+        # Count per bucket, then the sum and count of all values
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [0] * (len(self.buckets) + 3)
+        return state
+
+    def _apply(self, key, value):
+        state = self._state(key)
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def _merge(self, key, delta):
+        state = self._state(key)
+        for i, value in enumerate(delta):
+            state[i] += value
+
+    def _samples(self):
+        for key, state in sorted(self._values.items()):
+            total = 0
+            bounds = [_format_value(b) for b in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, state):
+                total += count
+                yield (self.name + '_bucket',
+                       _format_labels(self.labels, key, [('le', bound)]),
+                       total)
+            yield (self.name + '_sum',
+                   _format_labels(self.labels, key), state[-2])
+            yield (self.name + '_count',
+                   _format_labels(self.labels, key), state[-1])
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Serves the metrics of server.registry on any path"""
+
+    def do_GET(self):
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Registry:
+    """
+    A set of metrics. Updates are thread safe, and forked processes
+    send what they collect to the process that called enable().
+    """
+
+    # Most seconds that a forked process keeps changes to itself,
+    # unless nothing more happens
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self):
+        self.enabled = False
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+        # Sockets for passing changes from forked processes
+        self._collect_sock = None
+        self._report_sock = None
+        # Set in forked processes, which report their changes
+        self._reporting = False
+        self._last_flush = 0
+
+        self._server = None
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(self, name, help, labels))
+
+    def gauge(self, name, help, labels=(), urgent=True):
+        return self._add(Gauge(self, name, help, labels, urgent))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(self, name, help, labels, buckets))
+
+    def _add(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def enable(self):
+        """
+        Starts recording metrics. Processes forked after this report
+        back to this process.
+        """
+        if self.enabled:
+            return
+        self.enabled = True
+
+        self._collect_sock, self._report_sock = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_DGRAM)
+        threading.Thread(target=self._collect, daemon=True).start()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def start_server(self, host, port):
+        """
+        Enables the registry and serves the metrics over HTTP from a
+        background thread. Returns the address being listened on.
+        """
+        self.enable()
+        self._server = ThreadingHTTPServer((host, port),
+                                           MetricsRequestHandler)
+        self._server.daemon_threads = True
+        self._server.registry = self
+        threading.Thread(target=self._server.serve_forever,
+                         daemon=True).start()
+        return self._server.server_address
+
+    def render(self):
+        """Returns all metrics in the Prometheus text format"""
+        lines = []
+        with self._lock:
+            for metric in self._metrics.values():
+                lines.append('# HELP %s %s' % (metric.name, metric.help))
+                lines.append('# TYPE %s %s' % (metric.name, metric.type))
+                for name, labels, value in metric._samples():
+                    lines.append('%s%s %s' % (name, labels,
+                                              _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        """
+        Sends changes collected in a forked process to the parent.
+        Does nothing in the process that enabled the registry.
+        """
+        if not self._reporting:
+            return
+
+        with self._lock:
+            changes = {}
+            for metric in self._metrics.values():
+                if metric._values:
+                    changes[metric.name] = [[list(key), value] for key, value
+                                            in metric._values.items()]
+                    metric._values = {}
+            self._last_flush = time.monotonic()
+
+        if not changes:
+            return
+
+        try:
+            self._report_sock.send(json.dumps(changes).encode('utf-8'),
+                                   socket.MSG_DONTWAIT)
+        except OSError:
+            # Metrics are not worth stalling a connection for, so the
+            # changes are kept for the next flush instead
+            with self._lock:
+                for name, values in changes.items():
+                    metric = self._metrics[name]
+                    for key, delta in values:
+                        metric._merge(tuple(key), delta)
+
+    def _update(self, metric, labels, value, urgent=False):
+        if not self.enabled:
+            return
+
+        key = tuple(str(label) for label in labels)
+        with self._lock:
+            metric._apply(key, value)
+
+        if self._reporting:
+            if urgent or time.monotonic() - self._last_flush >= self.FLUSH_INTERVAL:
+                self.flush()
+
+    def _after_fork(self):
+        # From now on only changes are kept, to be sent to the parent
+        self._lock = threading.Lock()
+        self._reporting = True
+        self._last_flush = time.monotonic()
+        for metric in self._metrics.values():
+            metric._values = {}
+
+        self._collect_sock.close()
+        if self._server is not None:
+            self._server.socket.close()
+
+    def _collect(self):
+        # Adds up changes sent by forked processes
+        while True:
+            try:
+                data = self._collect_sock.recv(1 << 20)
+                changes = json.loads(data)
+            except OSError:
+                return
+            except ValueError:
+                continue
+
+            with self._lock:
+                for name, values in changes.items():
+                    metric = self._metrics.get(name)
+                    if metric is None:
+                        continue
+                    for key, delta in values:
+                        metric._merge(tuple(key), delta)
+
+
+REGISTRY = Registry()
+
+connections = REGISTRY.counter(
+    'websockify_connections_total',
+    'Connections accepted')
+handshakes = REGISTRY.counter(
+    'websockify_handshakes_total',
+    'WebSocket handshakes completed')
+handshake_seconds = REGISTRY.histogram(
+    'websockify_handshake_seconds',
+    'Time from accepting a connection until the WebSocket handshake '
+    'is completed')
+sessions = REGISTRY.gauge(
+    'websockify_sessions_active',
+    'WebSocket sessions being served')
+token_lookup_seconds = REGISTRY.histogram(
+    'websockify_token_lookup_seconds',
+    'Time taken by token plugin lookups',
+    ('plugin',))
+token_cache = REGISTRY.counter(
+    'websockify_token_cache_lookups_total',
+    'Token lookups answered from the token cache (hit), by the token '
+    'plugin (miss), or by waiting for another lookup (coalesced)',
+    ('result',))
+token_api_request_seconds = REGISTRY.histogram(
+    'websockify_token_api_request_seconds',
+    'Time taken by requests to the token API, by HTTP status code, or '
+    'timeout or error',
+    ('result',))
+token_api_rejected = REGISTRY.counter(
+    'websockify_token_api_rejected_total',
+    'Token lookups failed without asking the token API, because it '
+    'failed too often')
+tls_sessions = REGISTRY.counter(
+    'websockify_tls_sessions_total',
+    'WebSocket sessions over SSL/TLS, by the directions in which kernel '
+    'TLS offload is used',
+    ('ktls',))
+messages = REGISTRY.counter(
+    'websockify_messages_total',
+    'WebSocket messages received from and sent to clients',
+    ('direction',))
+message_bytes = REGISTRY.counter(
+    'websockify_message_bytes_total',
+    'Payload bytes of WebSocket messages received from and sent to clients',
+    ('direction',))
+send_queue_depth = REGISTRY.histogram(
+    'websockify_send_queue_depth',
+    'Messages waiting to be sent to a client when more are queued',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+queued_bytes = REGISTRY.gauge(
+    'websockify_queued_bytes',
+    'Bytes waiting to be sent to clients or targets',
+    ('direction',), urgent=False)
+backpressure_pauses = REGISTRY.counter(
+    'websockify_backpressure_pauses_total',
+    'Times reading was paused because too much data was waiting to be '
+    'sent in the other direction',
+    ('direction',))
+closes = REGISTRY.counter(
+    'websockify_closes_total',
+    'WebSocket connections closed by websockify, by close code',
+    ('code',))
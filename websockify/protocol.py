@@ -0,0 +1,597 @@
+'''
+WebSocket protocol without I/O
+Copyright 2011 Joel Martin
+Copyright 2016 Pierre Ossman
+Licensed under LGPL version 3 (see docs/LICENSE.LGPL-3)
+
+WebSocketProtocol handles the framing and the message level rules of
+the WebSocket protocol, but leaves reading and writing the data to the
+caller. Received data is handed to it, and it produces events in
+return. Data that should be sent is collected in a queue that the
+caller drains in whatever way suits its transport.
+
+Supports following protocol versions:
+    - http://tools.ietf.org/html/draft-ietf-hybi-thewebsocketprotocol-07
+    - http://tools.ietf.org/html/draft-ietf-hybi-thewebsocketprotocol-10
+    - http://tools.ietf.org/html/rfc6455
+'''
+
+import collections
+import random
+import struct
+
+from websockify import deflate, masking
+
+
+class Frame:
+    """A decoded WebSocket frame.
+
+    One of these is created for every received frame, so it is kept
+    as small as possible. length is the encoded size of the frame,
+    including the header, and rsv holds the reserved bits of the first
+    byte, as they are in it.
+    """
+
+    __slots__ = ('fin', 'opcode', 'masked', 'length', 'payload', 'rsv')
+
+    def __init__(self, fin, opcode, masked, length, payload, rsv=0):
+        self.fin = fin
+        self.opcode = opcode
+        self.masked = masked
+        self.length = length
+        self.payload = payload
+        self.rsv = rsv
+
+
+class Message:
+    """A complete binary message from the peer"""
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+
+class Ping:
+    """A ping from the peer"""
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+
+class Pong:
+    """A pong from the peer"""
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+
+class Close:
+    """The peer has closed the connection.
+
+    code and reason are the same as close_code and close_reason on
+    the WebSocketProtocol object.
+    """
+
+    __slots__ = ('code', 'reason')
+
+    def __init__(self, code, reason):
+        self.code = code
+        self.reason = reason
+
+
+def mask(buf, mask_key):
+    """Returns a masked copy of buf"""
+    data = bytearray(buf)
+    masking.mask(data, mask_key)
+    return data
+
+
+def encode_frame_header(opcode, length, mask_key=None, fin=True,
+                        rsv1=False):
+    """ Encode the header of a HyBi style WebSocket frame, with a
+    payload of the given length. The mask key, if any, is included
+    but the payload must be masked separately. rsv1 marks a
+    compressed message.
+    """
+
+    b1 = opcode & 0x0f
+    if fin:
+        b1 |= 0x80
+    if rsv1:
+        b1 |= 0x40
+
+    mask_bit = 0
+    if mask_key is not None:
+        mask_bit = 0x80
+
+    if length <= 125:
+        header = struct.pack('>BB', b1, length | mask_bit)
+    elif length > 125 and length < 65536:
+        header = struct.pack('>BBH', b1, 126 | mask_bit, length)
+    elif length >= 65536:
+        header = struct.pack('>BBQ', b1, 127 | mask_bit, length)
+
+    if mask_key is not None:
+        return header + mask_key
+    else:
+        return header
+
+
+def encode_frame(opcode, buf, mask_key=None, fin=True, rsv1=False):
+    """ Encode a HyBi style WebSocket frame.
+    Optional opcode:
+        0x0 - continuation
+        0x1 - text frame
+        0x2 - binary frame
+        0x8 - connection close
+        0x9 - ping
+        0xA - pong
+    """
+
+    if mask_key is not None:
+        buf = mask(buf, mask_key)
+
+    return encode_frame_header(opcode, len(buf), mask_key, fin, rsv1) + buf
+
+
+def decode_frame(buf):
+    """ Decode HyBi style WebSocket packets.
+    The buffer may be any bytes-like object, including a memoryview
+    of a larger buffer. The payload is always returned as a copy,
+    but a masked payload is unmasked in place if buf is writable.
+    Returns a Frame, or None if buf does not hold a complete frame.
+    """
+
+    blen = len(buf)
+    hlen = 2
+
+    if blen < hlen:
+        return None
+
+    b1, b2 = struct.unpack_from(">BB", buf)
+    masked = b2 & 0x80
+
+    if masked:
+        hlen += 4
+        if blen < hlen:
+            return None
+
+    length = b2 & 0x7f
+
+    if length == 126:
+        hlen += 2
+        if blen < hlen:
+            return None
+        length, = struct.unpack_from('>H', buf, 2)
+    elif length == 127:
+        hlen += 8
+        if blen < hlen:
+            return None
+        length, = struct.unpack_from('>Q', buf, 2)
+
+    if blen < hlen + length:
+        return None
+
+    if masked:
+        # unmask payload
+        mask_key = bytes(buf[hlen - 4:hlen])
+        payload = memoryview(buf)[hlen:(hlen + length)]
+        if payload.readonly:
+            payload = bytes(mask(payload, mask_key))
+        else:
+            # Unmask directly in the receive buffer, so the only
+            # copy is the one we hand out
+            masking.mask(payload, mask_key)
+            payload = bytes(payload)
+    else:
+        payload = bytes(buf[hlen:(hlen + length)])
+
+    return Frame(bool(b1 & 0x80), b1 & 0x0f, bool(masked),
+                 hlen + length, payload, b1 & 0x70)
+
+
+class WebSocketProtocol:
+    """WebSocket protocol state for a single connection.
+
+    Nothing in here touches a socket. Received data is either copied
+    in with feed_data(), or written directly in to the receive buffer
+    by getting space with get_buffer() and then reporting how much was
+    written with buffer_updated(). Frames are only decoded once open()
+    has been called, so that any HTTP handshake can be read first
+    using read_until().
+
+    Events are fetched one at a time using next_event(), which returns
+    Message, Ping, Pong or Close objects. Protocol errors are handled
+    internally by starting a close of the connection.
+
+    Data to send is generated by send_message(), send_ping(),
+    send_pong() and send_close(). The caller fetches it either with
+    data_to_send(), or with buffers_to_send() followed by data_sent()
+    to avoid copying.
+
+    Messages are compressed and decompressed by deflate, if it has
+    been set to a deflate.PerMessageDeflate object.
+    """
+
+    # Most buffers that buffers_to_send() returns at once
+    MAX_SEND_BUFFERS = 1024
+
+    # Size that buffers_to_send() merges small buffers up to
+    COALESCE_SIZE = 16384
+
+    def __init__(self, client=False):
+        self.client = client
+
+        self._open = False
+
+        self._partial_msg = []
+        self._partial_compressed = False
+
+        self.deflate = None
+
+        # Received data lives in _recv_buffer between _recv_pos and
+        # _recv_end. The space after _recv_end is given out by
+        # get_buffer().
+        self._recv_buffer = bytearray()
+        self._recv_pos = 0
+        self._recv_end = 0
+        self._recv_size = 0
+        self._recv_queue = collections.deque()
+
+        # Data to send is kept as a queue of buffers, with _send_offset
+        # bytes of the first one already sent
+        self._send_queue = collections.deque()
+        self._send_offset = 0
+        self._send_size = 0
+
+        self.sent_close = False
+        self.received_close = False
+
+        self.close_code = None
+        self.close_reason = None
+
+    @property
+    def closed(self):
+        """True once close messages have gone both ways"""
+        return self.sent_close and self.received_close
+
+    def open(self):
+        """Starts decoding frames, including any data already received"""
+        self._open = True
+        self._decode_frames()
+
+    def get_buffer(self, size):
+        """Returns space for size more bytes of received data.
+
+        The returned memoryview is meant for recv_into() and must be
+        released before any other method is called. buffer_updated()
+        is then used to report how much of it was filled.
+        """
+        if len(self._recv_buffer) - self._recv_end < size:
+            # Move the unprocessed data to the start first, as that
+            # space is no longer needed. This only happens when the
+            # buffer is full, so it is cheap compared to doing it for
+            # every frame.
+            if self._recv_pos > 0:
+                used = self._recv_end - self._recv_pos
+                self._recv_buffer[:used] = self._recv_buffer[self._recv_pos:self._recv_end]
+                self._recv_pos = 0
+                self._recv_end = used
+
+            missing = size - (len(self._recv_buffer) - self._recv_end)
+            if missing > 0:
+                self._recv_buffer.extend(bytes(missing))
+
+        self._recv_size = size
+
+        return memoryview(self._recv_buffer)[self._recv_end:self._recv_end + size]
+
+    def buffer_updated(self, nbytes):
+        """Reports that nbytes were written to the last get_buffer()"""
+        self._recv_end += nbytes
+        self._decode_frames()
+
+    def feed_data(self, data):
+        """Adds received data and returns the resulting events"""
+        with self.get_buffer(len(data)) as view:
+            view[:] = data
+        self.buffer_updated(len(data))
+
+        events = []
+        while True:
+            event = self.next_event()
+            if event is None:
+                return events
+            events.append(event)
+
+    def receive_eof(self):
+        """Reports that the peer has closed the connection"""
+        if self.close_code is None:
+            self.close_code = 1006
+            self.close_reason = "Connection closed abnormally"
+            self.sent_close = self.received_close = True
+
+    def read_until(self, separator):
+        """Removes and returns received data up to separator.
+
+        The separator is removed as well, but is not included in the
+        returned data. None is returned if the separator has not been
+        received yet.
+        """
+        end = self._recv_buffer.find(separator,
+                                     self._recv_pos, self._recv_end)
+        if end == -1:
+            return None
+
+        data = bytes(self._recv_buffer[self._recv_pos:end])
+        self._recv_pos = end + len(separator)
+        return data
+
+    def pending(self):
+        """True if there are received frames that are not processed"""
+        return len(self._recv_queue) > 0
+
+    def next_event(self):
+        """Processes received frames until there is an event for the
+        caller, and returns it. None is returned if more data is needed.
+        """
+        while self._recv_queue:
+            frame = self._recv_queue.popleft()
+
+            if not self.client and not frame.masked:
+                self.send_close(1002, "Procotol error: Frame not masked")
+                continue
+            if self.client and frame.masked:
+                self.send_close(1002, "Procotol error: Frame masked")
+                continue
+
+            # Only the first frame of a compressed message has a
+            # reserved bit set
+            if frame.rsv and (frame.rsv != 0x40 or frame.opcode != 0x2 or
+                              self.deflate is None):
+                self.send_close(1002, "Procotol error: Unexpected reserved bits")
+                continue
+
+            if frame.opcode == 0x0:
+                if not self._partial_msg:
+                    self.send_close(1002, "Procotol error: Unexpected continuation frame")
+                    continue
+
+                self._partial_msg.append(frame.payload)
+
+                if frame.fin:
+                    msg = b''.join(self._partial_msg)
+                    self._partial_msg = []
+                    if self._partial_compressed:
+                        msg = self._decompress(msg)
+                        if msg is None:
+                            continue
+                    return Message(msg)
+            elif frame.opcode == 0x1:
+                self.send_close(1003, "Unsupported: Text frames are not supported")
+            elif frame.opcode == 0x2:
+                if self._partial_msg:
+                    self.send_close(1002, "Procotol error: Unexpected new frame")
+                    continue
+
+                if frame.fin:
+                    msg = frame.payload
+                    if frame.rsv:
+                        msg = self._decompress(msg)
+                        if msg is None:
+                            continue
+                    return Message(msg)
+                else:
+                    self._partial_msg = [frame.payload]
+                    self._partial_compressed = bool(frame.rsv)
+            elif frame.opcode == 0x8:
+                if self.received_close:
+                    continue
+
+                self.received_close = True
+
+                if self.sent_close:
+                    return Close(self.close_code, self.close_reason)
+
+                if not frame.fin:
+                    self.send_close(1003, "Unsupported: Fragmented close")
+                    continue
+
+                code = None
+                reason = None
+                if len(frame.payload) >= 2:
+                    code = struct.unpack(">H", frame.payload[:2])[0]
+                    if len(frame.payload) > 2:
+                        reason = frame.payload[2:]
+                        try:
+                            reason = reason.decode("UTF-8")
+                        except UnicodeDecodeError:
+                            self.send_close(1002, "Procotol error: Invalid UTF-8 in close")
+                            continue
+
+                if code is None:
+                    self.close_code = 1005
+                    self.close_reason = "No close status code specified by peer"
+                else:
+                    self.close_code = code
+                    if reason is not None:
+                        self.close_reason = reason
+
+                self.send_close(code, reason)
+                return Close(self.close_code, self.close_reason)
+            elif frame.opcode == 0x9:
+                if not frame.fin:
+                    self.send_close(1003, "Unsupported: Fragmented ping")
+                    continue
+
+                return Ping(frame.payload)
+            elif frame.opcode == 0xA:
+                if not frame.fin:
+                    self.send_close(1003, "Unsupported: Fragmented pong")
+                    continue
+
+                return Pong(frame.payload)
+            else:
+                self.send_close(1003, "Unsupported: Unknown opcode 0x%02x" % frame.opcode)
+
+        return None
+
+    def _decompress(self, payload):
+        # Returns None if the connection is being closed instead
+        try:
+            return self.deflate.decompress(payload)
+        except deflate.MessageTooLarge as e:
+            self.send_close(1009, str(e))
+            return None
+        except ValueError as e:
+            self.send_close(1007, str(e))
+            return None
+
+    def send_message(self, data):
+        """Queues a binary message"""
+        self.send_frame(0x2, data)
+
+    def send_ping(self, data=b''):
+        """Queues a ping message"""
+        self.send_frame(0x9, data)
+
+    def send_pong(self, data=b''):
+        """Queues a pong message"""
+        self.send_frame(0xA, data)
+
+    def send_close(self, code=1000, reason=None):
+        """Queues a close message, unless one has already been sent"""
+        if self.sent_close:
+            return
+
+        # Special code to indicate that we closed the connection
+        if not self.received_close:
+            self.close_code = 1000
+            self.close_reason = "Locally initiated close"
+
+        self.sent_close = True
+
+        msg = b''
+        if code is not None:
+            msg += struct.pack(">H", code)
+            if reason is not None:
+                msg += reason.encode("UTF-8")
+
+        self.send_frame(0x8, msg)
+
+    def send_frame(self, opcode, data):
+        """Queues a single frame with the given opcode. It is
+        compressed if it is a message and deflate is set."""
+        compressed = False
+        if self.deflate is not None and opcode in (0x1, 0x2):
+            data, compressed = self.deflate.compress(data)
+
+        if self.client:
+            mask_key = b''
+            for i in range(4):
+                mask_key += random.randrange(256).to_bytes()
+            data = mask(data, mask_key)
+            header = encode_frame_header(opcode, len(data), mask_key,
+                                         rsv1=compressed)
+        else:
+            header = encode_frame_header(opcode, len(data),
+                                         rsv1=compressed)
+
+        # The header and payload are kept as separate buffers so that
+        # the payload never has to be copied
+        self.send_raw(header)
+        self.send_raw(data)
+
+    def send_raw(self, data):
+        """Queues data that is not part of a frame, e.g. HTTP headers"""
+        if data:
+            self._send_queue.append(data)
+            self._send_size += len(data)
+
+    def has_data_to_send(self):
+        """True if there is queued data to send"""
+        return len(self._send_queue) > 0
+
+    def send_queue_size(self):
+        """Returns the number of bytes queued to send"""
+        return self._send_size
+
+    def data_to_send(self):
+        """Removes and returns all queued data to send"""
+        bufs = list(self._send_queue)
+        if bufs and self._send_offset:
+            bufs[0] = memoryview(bufs[0])[self._send_offset:]
+        self._send_queue.clear()
+        self._send_offset = 0
+        self._send_size = 0
+        return b''.join(bufs)
+
+    def buffers_to_send(self, coalesce=False):
+        """Returns a list of queued buffers to send in one go.
+
+        The buffers stay queued until data_sent() is called. A transport
+        without vectored writes should set coalesce, which limits how
+        much has to be joined together, to about one TLS record. A large
+        payload is then returned on its own.
+        """
+        bufs = []
+        size = 0
+        for buf in self._send_queue:
+            if not bufs and self._send_offset:
+                buf = memoryview(buf)[self._send_offset:]
+
+            if coalesce:
+                if size + len(buf) > self.COALESCE_SIZE:
+                    if not bufs:
+                        bufs.append(buf)
+                    elif size < self.COALESCE_SIZE // 2:
+                        # Top up with the start of the next buffer
+                        bufs.append(memoryview(buf)[:self.COALESCE_SIZE - size])
+                    break
+
+            bufs.append(buf)
+            size += len(buf)
+
+            if len(bufs) >= self.MAX_SEND_BUFFERS:
+                break
+
+        return bufs
+
+    def data_sent(self, nbytes):
+        """Drops nbytes of sent data from the send queue"""
+        self._send_size -= nbytes
+        while nbytes:
+            remaining = len(self._send_queue[0]) - self._send_offset
+            if nbytes < remaining:
+                self._send_offset += nbytes
+                break
+            nbytes -= remaining
+            self._send_queue.popleft()
+            self._send_offset = 0
+
+    def _decode_frames(self):
+        # Moves complete frames from the receive buffer to the queue
+        if not self._open:
+            return
+
+        with memoryview(self._recv_buffer) as view:
+            while True:
+                frame = decode_frame(view[self._recv_pos:self._recv_end])
+                if frame is None:
+                    break
+                self._recv_pos += frame.length
+                self._recv_queue.append(frame)
+
+        if self._recv_pos == self._recv_end:
+            # Everything has been consumed, so start over from the
+            # beginning of the buffer
+            self._recv_pos = self._recv_end = 0
+
+            # Give back memory from any earlier large frames or reads
+            if len(self._recv_buffer) > self._recv_size:
+                del self._recv_buffer[self._recv_size:]
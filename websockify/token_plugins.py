@@ -1,8 +1,17 @@
+import hashlib
 import logging
 import sys
 import time
 import re
 import json
+import multiprocessing
+import os
+import random
+import socket
+import stat
+import threading
+from collections import OrderedDict
+import urllib.parse
 from pathlib import Path
 
 try:
@@ -10,6 +19,8 @@ try:
 except ImportError:
     redis = None
 
+from websockify import metrics
+
 logger = logging.getLogger(__name__)
 
 _SOURCE_SPLIT_REGEX = re.compile(
@@ -20,6 +31,42 @@ _SOURCE_SPLIT_REGEX = re.compile(
 )
 
 
+# Settings that a plugin can return along with a target, as a dict
+# after the host and port, to override the server's for that target
+TARGET_OPTIONS = ('flush',)
+
+_TARGET_OPTION_REGEX = re.compile(r'\s+(\w+)=(\S*)$')
+
+
+def split_target_options(target):
+    """Splits trailing name=value words off a target, like in
+
+    host:port flush=cork -> ('host:port', {'flush': 'cork'})
+
+    Raises ValueError for unknown options.
+    """
+    target = target.strip()
+    options = {}
+    match = _TARGET_OPTION_REGEX.search(target)
+    while match:
+        name, value = match.groups()
+        if name not in TARGET_OPTIONS:
+            raise ValueError("Unknown target option: %s" % name)
+        options[name] = value
+        target = target[:match.start()]
+        match = _TARGET_OPTION_REGEX.search(target)
+    return target, options
+
+
+def _with_options(target, values):
+    # Adds the target options found in a JSON object, if there are any
+    options = {name: str(values[name]) for name in TARGET_OPTIONS
+               if name in values}
+    if options:
+        return tuple(target) + (options,)
+    return target
+
+
 def parse_source_args(src):
     """It works like src.split(":") but with the ability to use a colon
     if you wrap the word in quotation marks.
@@ -31,18 +78,57 @@ def parse_source_args(src):
     return [m[0] or m[1] or m[2] or m[3] for m in matches]
 
 
+def _parse_token_lines(lines, name):
+    # Returns the targets in the lines of a token file
+    targets = {}
+    for index, line in enumerate(lines, 1):
+        if line and not line.startswith('#'):
+            try:
+                tok, target = re.split(r':\s', line)
+                target, options = split_target_options(target)
+                targets[tok] = target.rsplit(':', 1)
+                if options:
+                    targets[tok].append(options)
+            except ValueError:
+                logger.error("Syntax error in %s on line %d" % (name, index))
+    return targets
+
+
+def _file_stamp(st, racy_seconds=1):
+    # Identifies a version of a file from its stat result, or returns
+    # None while it is too new to tell: a change this soon after the
+    # file was modified might not change its timestamp, so the file
+    # must be read again until then
+    if time.time() - st.st_mtime < racy_seconds:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
 class BasePlugin():
     def __init__(self, src):
         self.source = src
 
+    @property
+    def metric_name(self):
+        # Label of the token lookup metrics for this plugin
+        return type(self).__name__
+
     def lookup(self, token):
         return None
 
+    def refresh(self):
+        # Called about once a second by the process that accepts
+        # connections, so that cached data can be kept up to date
+        # there, and processes forked for connections inherit it
+        pass
+
 
 class ReadOnlyTokenFile(BasePlugin):
     # source is a token file with lines like
     #   token: host:port
-    # or a directory of such files
+    # or a directory of such files. Options for the target can follow
+    # the port, like
+    #   token: host:port flush=cork
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._targets = None
@@ -55,17 +141,9 @@ class ReadOnlyTokenFile(BasePlugin):
             cfg_files = [source]
 
         self._targets = {}
-        index = 1
         for f in cfg_files:
             with f.open() as file:
-                for line in file.readlines():
-                    if line and not line.startswith('#'):
-                        try:
-                            tok, target = re.split(r':\s', line)
-                            self._targets[tok] = target.strip().rsplit(':', 1)
-                        except ValueError:
-                            logger.error("Syntax error in %s on line %d" % (self.source, index))
-                    index += 1
+                self._targets.update(_parse_token_lines(file.readlines(), f))
 
     def lookup(self, token):
         if self._targets is None:
@@ -76,39 +154,289 @@ class ReadOnlyTokenFile(BasePlugin):
         else:
             return None
 
+    def refresh(self):
+        # Load the files once, instead of in every forked process
+        if self._targets is None:
+            try:
+                self._load_targets()
+            except OSError:
+                # Reported again by lookup()
+                self._targets = None
+
 
-# the above one is probably more efficient, but this one is
-# more backwards compatible (although in most cases
-# ReadOnlyTokenFile should suffice)
 class TokenFile(ReadOnlyTokenFile):
     # source is a token file with lines like
     #   token: host:port
     # or a directory of such files
+    #
+    # Unlike ReadOnlyTokenFile, changes to the files are picked up. All
+    # tokens are kept in an index, and only the files that have been
+    # added, replaced or modified are read again. A lookup checks the
+    # directory and the file that the token is in, which finds new,
+    # removed and replaced files. A token that is not found might have
+    # been added to a file in place, so then all files are checked, at
+    # most once every CHECK_INTERVAL seconds.
+    # refresh() also checks SWEEP_SIZE files at a time, to keep the
+    # index up to date for processes forked later.
+
+    SWEEP_SIZE = 1000
+
+    # Least seconds between checks of all files for unknown tokens
+    CHECK_INTERVAL = 1
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._source_stamp = None
+        self._source_error = None
+        # Path -> (stamp, targets)
+        self._files = {}
+        # Token -> paths of the files it is in, the last one counts
+        self._paths = {}
+        self._sweep = []
+        self._next_check = 0
+
     def lookup(self, token):
-        self._load_targets()
+        with self._lock:
+            self._check_source()
+            paths = self._paths.get(token)
+            if paths:
+                self._check_file(paths[-1])
+                paths = self._paths.get(token)
+            if paths:
+                return self._files[paths[-1]][1][token]
+
+            now = time.monotonic()
+            if now < self._next_check:
+                return None
+            self._next_check = now + self.CHECK_INTERVAL
+            files = list(self._files)
 
-        return super().lookup(token)
+        self._check_files(files)
+        with self._lock:
+            paths = self._paths.get(token)
+            if not paths:
+                return None
+            return self._files[paths[-1]][1][token]
+
+    def refresh(self):
+        with self._lock:
+            self._check_source()
+            if not self._sweep:
+                self._sweep = list(self._files)
+            files = self._sweep[-self.SWEEP_SIZE:]
+            del self._sweep[-self.SWEEP_SIZE:]
+        self._check_files(files)
+
+    def _check_files(self, paths):
+        # Reads the files that have changed again. The stat() of each
+        # file is done without the lock, as that is most of the work.
+        changed = []
+        for path in paths:
+            old = self._files.get(path)
+            if old is None:
+                continue
+            try:
+                stamp = _file_stamp(os.stat(path))
+            except OSError:
+                stamp = None
+            if stamp is None or stamp != old[0]:
+                changed.append(path)
+
+        with self._lock:
+            for path in changed:
+                if path in self._files:
+                    self._check_file(path)
+
+    def _check_source(self):
+        try:
+            st = os.stat(self.source)
+        except OSError as e:
+            if self._source_error is None:
+                logger.error("Cannot read token source %s: %s",
+                             self.source, e)
+            self._source_error = e
+            for path in list(self._files):
+                self._set_file(path, None, {})
+            return
+        self._source_error = None
+
+        if not stat.S_ISDIR(st.st_mode):
+            self._check_file(self.source, st)
+            return
+
+        stamp = _file_stamp(st)
+        if stamp is not None and stamp == self._source_stamp:
+            return
+        self._source_stamp = stamp
+
+        # A file that is replaced by renaming another one over it gets
+        # a new inode, which is known without a stat() per file
+        inodes = {}
+        with os.scandir(self.source) as it:
+            for entry in it:
+                if entry.is_file():
+                    inodes[entry.path] = entry.inode()
+        for path in list(self._files):
+            if path not in inodes:
+                self._set_file(path, None, {})
+        for path, inode in inodes.items():
+            old = self._files.get(path)
+            if old is None or old[0] is None or old[0][0] != inode:
+                self._check_file(path)
+
+    def _check_file(self, path, st=None):
+        try:
+            if st is None:
+                st = os.stat(path)
+            stamp = _file_stamp(st)
+            old = self._files.get(path)
+            if stamp is not None and old is not None and old[0] == stamp:
+                return
+            with open(path) as f:
+                targets = _parse_token_lines(f.readlines(), path)
+        except OSError:
+            # Removed, which the next directory check notices too
+            stamp, targets = None, {}
+        self._set_file(path, stamp, targets)
+
+    def _set_file(self, path, stamp, targets):
+        # Replaces the tokens of a file in the index
+        old = self._files.get(path, (None, {}))[1]
+        for token in old.keys() - targets.keys():
+            paths = self._paths[token]
+            paths.remove(path)
+            if not paths:
+                del self._paths[token]
+        for token in targets.keys() - old.keys():
+            self._paths.setdefault(token, []).append(path)
+
+        if targets or stamp is not None:
+            self._files[path] = (stamp, targets)
+        else:
+            self._files.pop(path, None)
 
 
 class TokenFileName(BasePlugin):
     # source is a directory
     # token is filename
     # contents of file is host:port
+    #
+    # The targets are kept in memory, and the file of a token is only
+    # checked with a stat() when it is looked up, and read again if it
+    # has changed. refresh() forgets the files that have been removed
+    # or replaced when the directory changes, and reads new files
+    # SCAN_SIZE at a time, so that they are cached in processes forked
+    # later. Tokens that are not found are remembered for NEGATIVE_TTL
+    # seconds, up to NEGATIVE_SIZE of them, or until refresh() sees a
+    # file for them.
+
+    NEGATIVE_TTL = 5
+    NEGATIVE_SIZE = 10000
+
+    # Most files that one refresh() reads
+    SCAN_SIZE = 1000
+
     def __init__(self, src):
         super().__init__(src)
         if not Path(src).is_dir():
             raise Exception("TokenFileName plugin requires a directory")
+        self._lock = threading.Lock()
+        # Token -> (stamp, target)
+        self._targets = {}
+        # Token -> when to look for it again, oldest first
+        self._missing = {}
+        self._source_stamp = None
+        # Tokens of files that refresh() has yet to read
+        self._unread = []
 
     def lookup(self, token):
         token = Path(token).name
-        path = Path(self.source) / token
-        if path.exists():
-            with path.open() as f:
-                text = f.read().strip().split(':')
-            return text
-        else:
+        if token in ('', '.', '..'):
             return None
 
+        with self._lock:
+            cached = self._targets.get(token)
+            if cached is None and self._missing.get(token, 0) > time.monotonic():
+                return None
+
+        # Without the lock, as this can be slow on network filesystems
+        if cached is not None:
+            try:
+                st = os.stat(os.path.join(self.source, token))
+            except OSError:
+                st = None
+            if st is not None and _file_stamp(st) == cached[0]:
+                return cached[1]
+        stamp, target = self._read(token)
+
+        with self._lock:
+            self._targets.pop(token, None)
+            if target is None:
+                self._missing.pop(token, None)
+                if len(self._missing) >= self.NEGATIVE_SIZE:
+                    del self._missing[next(iter(self._missing))]
+                self._missing[token] = time.monotonic() + self.NEGATIVE_TTL
+            elif stamp is not None:
+                self._targets[token] = (stamp, target)
+        return target
+
+    def refresh(self):
+        # The files are read without the lock, and only SCAN_SIZE of
+        # them at a time, as this can be slow on network filesystems
+        stamp = _file_stamp(os.stat(self.source))
+        if stamp is None or stamp != self._source_stamp:
+            inodes = self._scan()
+            with self._lock:
+                self._source_stamp = stamp
+                self._forget(inodes)
+
+        with self._lock:
+            tokens = []
+            while self._unread and len(tokens) < self.SCAN_SIZE:
+                token = self._unread.pop()
+                if token not in self._targets:
+                    tokens.append(token)
+
+        for token in tokens:
+            try:
+                stamp, target = self._read(token)
+            except OSError:
+                continue
+            if target is not None and stamp is not None:
+                with self._lock:
+                    self._targets.setdefault(token, (stamp, target))
+
+    def _read(self, token):
+        # Returns the stamp and target of a token's file
+        try:
+            with open(os.path.join(self.source, token)) as f:
+                stamp = _file_stamp(os.fstat(f.fileno()))
+                return stamp, f.read().strip().split(':')
+        except FileNotFoundError:
+            return None, None
+
+    def _scan(self):
+        # Returns the inodes of the files, which show files that have
+        # been added, removed or replaced without a stat() per file
+        inodes = {}
+        with os.scandir(self.source) as it:
+            for entry in it:
+                if entry.is_file():
+                    inodes[entry.name] = entry.inode()
+        return inodes
+
+    def _forget(self, inodes):
+        # Drops what is known about files that are gone or replaced, and
+        # queues the files that are not cached to be read, with the lock
+        # held
+        for token in [token for token in self._missing if token in inodes]:
+            del self._missing[token]
+        for token, (stamp, target) in list(self._targets.items()):
+            if inodes.get(token) != stamp[0]:
+                del self._targets[token]
+        self._unread = list(inodes.keys() - self._targets.keys())
+
 
 class BaseTokenAPI(BasePlugin):
     # source is a url with a '%s' in it where the token
@@ -117,6 +445,44 @@ class BaseTokenAPI(BasePlugin):
     # we import things on demand so that other plugins
     # in this file can be used w/o unnecessary dependencies
 
+    # Seconds to wait for a connection to the API, and for its response
+    timeout = (3, 5)
+
+    # Times a request that failed is tried again, after about
+    # RETRY_DELAY seconds, doubled for each retry
+    RETRIES = 2
+    RETRY_DELAY = 0.1
+
+    # After this many lookups in a row failed, lookups fail right away
+    # for BREAKER_SECONDS, and then one is let through to try again
+    BREAKER_FAILURES = 5
+    BREAKER_SECONDS = 30
+
+    # Most connections to the API kept open in a process
+    POOL_SIZE = 10
+
+    _setup_lock = threading.Lock()
+
+    def refresh(self):
+        # So that the processes forked for connections share the state
+        self._setup()
+
+    def _setup(self):
+        # Done on first use rather than in __init__(), which subclasses
+        # may override without calling it
+        if getattr(self, '_breaker', None) is not None:
+            return
+        with self._setup_lock:
+            if getattr(self, '_breaker', None) is not None:
+                return
+            self._lock = threading.Lock()
+            self._session = None
+            self._session_pid = None
+            # Failures in a row, and until when lookups are not tried.
+            # This is shared with the processes forked for connections.
+            self._breaker_lock = multiprocessing.Lock()
+            self._breaker = multiprocessing.RawArray('d', 2)
+
     def process_result(self, resp):
         host, port = resp.text.split(':')
         port = port.encode('ascii', 'ignore')
@@ -125,13 +491,90 @@ class BaseTokenAPI(BasePlugin):
     def lookup(self, token):
         import requests
 
-        resp = requests.get(self.source % token)
+        self._setup()
+        if not self._allow():
+            metrics.token_api_rejected.inc()
+            raise ConnectionError("Token API failed %d times in a row, "
+                                  "not trying it for now" %
+                                  self._breaker[0])
+
+        url = self.source % token
+        for attempt in range(self.RETRIES + 1):
+            if attempt:
+                time.sleep(self.RETRY_DELAY * 2 ** (attempt - 1) *
+                           random.uniform(0.5, 1.5))
+
+            start = time.monotonic()
+            error = None
+            try:
+                resp = self._get_session().get(url, timeout=self.timeout)
+                result = str(resp.status_code)
+            except requests.Timeout as e:
+                error, result = e, 'timeout'
+            except requests.RequestException as e:
+                error, result = e, 'error'
+            metrics.token_api_request_seconds.observe(
+                time.monotonic() - start, (result,))
+
+            if error is None and resp.status_code < 500:
+                self._succeeded()
+                break
+            logger.warning("Token API request failed (attempt %d of %d): %s" %
+                           (attempt + 1, self.RETRIES + 1,
+                            error or "HTTP status %d" % resp.status_code))
+        else:
+            self._failed()
+            if error is not None:
+                raise error
 
         if resp.ok:
             return self.process_result(resp)
         else:
             return None
 
+    def _get_session(self):
+        # Keeps connections to the API open for later lookups. Processes
+        # forked for connections start a session of their own.
+        import requests
+
+        self._setup()
+        with self._lock:
+            if self._session is None or self._session_pid != os.getpid():
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_maxsize=self.POOL_SIZE)
+                self._session = requests.Session()
+                self._session.mount('http://', adapter)
+                self._session.mount('https://', adapter)
+                self._session_pid = os.getpid()
+            return self._session
+
+    def _allow(self):
+        with self._breaker_lock:
+            failures, until = self._breaker
+            if failures < self.BREAKER_FAILURES:
+                return True
+            now = time.monotonic()
+            if now < until:
+                return False
+            # Let this one try, the others wait for how it goes
+            self._breaker[1] = now + self.BREAKER_SECONDS
+            return True
+
+    def _succeeded(self):
+        with self._breaker_lock:
+            self._breaker[0] = 0
+            self._breaker[1] = 0
+
+    def _failed(self):
+        with self._breaker_lock:
+            self._breaker[0] += 1
+            if self._breaker[0] >= self.BREAKER_FAILURES:
+                if self._breaker[0] == self.BREAKER_FAILURES:
+                    logger.warning("Token API failed %d times in a row, "
+                                   "not trying it for %d seconds" %
+                                   (self._breaker[0], self.BREAKER_SECONDS))
+                self._breaker[1] = time.monotonic() + self.BREAKER_SECONDS
+
 
 class JSONTokenApi(BaseTokenAPI):
     # source is a url with a '%s' in it where the token
@@ -139,35 +582,52 @@ class JSONTokenApi(BaseTokenAPI):
 
     def process_result(self, resp):
         resp_json = resp.json()
-        return (resp_json['host'], resp_json['port'])
+        return _with_options((resp_json['host'], resp_json['port']),
+                             resp_json)
 
 
 class JWTTokenApi(BasePlugin):
     # source is a JWT-token, with hostname and port included
     # Both JWS as JWE tokens are accepted. With regards to JWE tokens, the key is re-used for both validation and decryption.
+    # The key file holds a PEM key, a secret, or a JWK or JWK Set in JSON.
+    # With a JWK Set, the key is chosen by the 'kid' in the token header.
+
+    # Most tokens kept that were found valid, so that they are not
+    # verified again until they expire or the key changes
+    CACHE_SIZE = 10000
+
+    def __init__(self, src):
+        super().__init__(src)
+        self._lock = threading.Lock()
+        self._key_stamp = None
+        self._key = None
+        self._key_error = None
+        # Digests of valid tokens -> (expiry, target), for self._key
+        self._valid = OrderedDict()
+
+    def refresh(self):
+        # Processes forked for connections get the key already parsed
+        try:
+            self._get_key()
+        except ImportError:
+            pass
 
     def lookup(self, token):
         try:
-            from jwcrypto import jwt, jwk
+            from jwcrypto import jwt
             import json
 
-            key = jwk.JWK()
-
-            try:
-                with open(self.source, 'rb') as key_file:
-                    key_data = key_file.read()
-            except Exception as e:
-                logger.error("Error loading key file: %s" % str(e))
+            key, valid = self._get_key()
+            if key is None:
                 return None
 
-            try:
-                key.import_from_pem(key_data)
-            except Exception:
-                try:
-                    key.import_key(k=key_data.decode('utf-8'), kty='oct')
-                except Exception:
-                    logger.error('Failed to correctly parse key data!')
-                    return None
+            digest = hashlib.sha256(token.encode('utf-8')).digest()
+            with self._lock:
+                cached = valid.get(digest)
+                if cached is not None:
+                    valid.move_to_end(digest)
+            if cached is not None and time.time() <= cached[0]:
+                return cached[1]
 
             try:
                 token = jwt.JWT(key=key, jwt=token)
@@ -191,14 +651,83 @@ class JWTTokenApi(BasePlugin):
                         logger.warning('Token has expired!')
                         return None
 
-                return (parsed['host'], parsed['port'])
+                target = _with_options((parsed['host'], parsed['port']),
+                                       parsed)
             except Exception as e:
                 logger.error("Failed to parse token: %s" % str(e))
                 return None
+
+            if self.CACHE_SIZE:
+                with self._lock:
+                    if len(valid) >= self.CACHE_SIZE:
+                        valid.popitem(last=False)
+                    valid[digest] = (parsed.get('exp', float('inf')), target)
+            return target
         except ImportError:
             logger.error("package jwcrypto not found, are you sure you've installed it correctly?")
             return None
 
+    def _get_key(self):
+        # Returns the key and the valid tokens cached for it. The key
+        # file is only parsed again when it has changed.
+        try:
+            st = os.stat(self.source)
+        except OSError as e:
+            return self._failed("Error loading key file: %s" % str(e))
+        stamp = _file_stamp(st)
+        with self._lock:
+            if stamp is not None and stamp == self._key_stamp:
+                return self._key, self._valid
+
+        try:
+            with open(self.source, 'rb') as key_file:
+                stamp = _file_stamp(os.fstat(key_file.fileno()))
+                key_data = key_file.read()
+        except Exception as e:
+            return self._failed("Error loading key file: %s" % str(e))
+
+        key = self._parse_key(key_data)
+        if key is None:
+            return self._failed('Failed to correctly parse key data!')
+
+        with self._lock:
+            self._key_stamp = stamp
+            self._key = key
+            self._key_error = None
+            self._valid = OrderedDict()
+            return self._key, self._valid
+
+    def _parse_key(self, key_data):
+        from jwcrypto import jwk
+
+        if key_data.lstrip().startswith(b'{'):
+            try:
+                if 'keys' in json.loads(key_data):
+                    return jwk.JWKSet.from_json(key_data)
+                return jwk.JWK.from_json(key_data)
+            except Exception:
+                pass
+
+        key = jwk.JWK()
+        try:
+            key.import_from_pem(key_data)
+        except Exception:
+            try:
+                key.import_key(k=key_data.decode('utf-8'), kty='oct')
+            except Exception:
+                return None
+        return key
+
+    def _failed(self, error):
+        # Logs an error once, until the key can be loaded again
+        with self._lock:
+            if error != self._key_error:
+                logger.error(error)
+            self._key_error = error
+            self._key_stamp = None
+            self._key = None
+        return None, None
+
 
 class TokenRedis(BasePlugin):
     """Token plugin based on the Redis in-memory data store.
@@ -239,6 +768,10 @@ class TokenRedis(BasePlugin):
 
         {"host": "target-host:target-port"}
 
+      which can also hold options for the target, e.g.
+
+        {"host": "target-host:target-port", "flush": "cork"}
+
     - Plain text
 
         target-host:target-port
@@ -255,11 +788,29 @@ class TokenRedis(BasePlugin):
 
         nc -l 5000 -v
 
+    The token source can also be a redis:// (or rediss:// or unix://) URL,
+    which allows setting connection options like socket_timeout and
+    health_check_interval, and two options of this plugin: namespace,
+    and cache_ttl to keep resolved targets for that many seconds, e.g.
+
+        redis://:verysecretpass@my-redis-host:6380/1?namespace=my-app&cache_ttl=5
+
+    Connections to Redis are kept in a pool, and reused by lookups in
+    the same process.
+
     Note: This Token Plugin depends on the 'redis' module, so you have
     to install it before using this plugin:
 
           pip install redis
     """
+
+    # Defaults for the connections to Redis, in seconds
+    SOCKET_TIMEOUT = 5
+    HEALTH_CHECK_INTERVAL = 30
+
+    # Most targets kept if cache_ttl is set
+    CACHE_SIZE = 10000
+
     def __init__(self, src):
         if redis is None:
             logger.error("Unable to load redis module")
@@ -269,6 +820,18 @@ class TokenRedis(BasePlugin):
         self._db = 0
         self._password = None
         self._namespace = ""
+        self._url = None
+        self._cache_ttl = 0
+
+        self._lock = threading.Lock()
+        self._client = None
+        # Token -> (expiry, target)
+        self._cache = {}
+
+        if '://' in src:
+            self._parse_url(src)
+            return
+
         try:
             fields = parse_source_args(src)
             if len(fields) == 1:
@@ -316,15 +879,74 @@ class TokenRedis(BasePlugin):
                          src)
             sys.exit()
 
+    def _parse_url(self, src):
+        try:
+            url = urllib.parse.urlsplit(src)
+            query = urllib.parse.parse_qs(url.query)
+            self._namespace = query.pop('namespace', [''])[-1]
+            self._cache_ttl = float(query.pop('cache_ttl', ['0'])[-1])
+            # The rest is up to redis
+            self._url = src.split('?', 1)[0]
+            if query:
+                self._url += '?' + urllib.parse.urlencode(query, doseq=True)
+            self._server = url.hostname or url.path
+            self._port = url.port or 6379
+        except ValueError:
+            logger.error("The provided --token-source='%s' is not a valid "
+                         "URL" % src)
+            sys.exit()
+        if self._namespace:
+            self._namespace += ":"
+
+        logger.info("TokenRedis backend initialized (%s:%s)" %
+                    (self._server, self._port))
+
+    def _get_client(self):
+        # One client, and with that one connection pool, per plugin.
+        # The pool starts over in forked processes.
+        with self._lock:
+            if self._client is None:
+                options = {
+                    'socket_timeout': self.SOCKET_TIMEOUT,
+                    'socket_connect_timeout': self.SOCKET_TIMEOUT,
+                    'health_check_interval': self.HEALTH_CHECK_INTERVAL,
+                }
+                if self._url:
+                    pool = redis.ConnectionPool.from_url(self._url, **options)
+                else:
+                    pool = redis.ConnectionPool(host=self._server,
+                                                port=self._port,
+                                                db=self._db,
+                                                password=self._password,
+                                                **options)
+                self._client = redis.Redis(connection_pool=pool)
+            return self._client
+
     def lookup(self, token):
         if redis is None:
             logger.error("package redis not found, are you sure you've installed them correctly?")
             sys.exit()
 
+        if self._cache_ttl:
+            with self._lock:
+                cached = self._cache.get(token)
+            if cached is not None and cached[0] > time.monotonic():
+                return cached[1]
+
+        target = self._resolve(token)
+
+        if self._cache_ttl and target is not None:
+            with self._lock:
+                self._cache.pop(token, None)
+                if len(self._cache) >= self.CACHE_SIZE:
+                    del self._cache[next(iter(self._cache))]
+                self._cache[token] = (time.monotonic() + self._cache_ttl,
+                                      target)
+        return target
+
+    def _resolve(self, token):
         logger.info("resolving token '%s'" % token)
-        client = redis.Redis(host=self._server, port=self._port,
-                             db=self._db, password=self._password)
-        stuff = client.get(self._namespace + token)
+        stuff = self._get_client().get(self._namespace + token)
         if stuff is None:
             return None
         else:
@@ -348,6 +970,8 @@ class TokenRedis(BasePlugin):
                 logger.error("Unable to parse token: %s" % responseStr)
                 return None
             logger.debug("host: %s, port: %s" % (host, port))
+            if responseStr.startswith("{"):
+                return _with_options([host, port], combo)
             return [host, port]
 
 
@@ -378,3 +1002,142 @@ class UnixDomainSocketDirectory(BasePlugin):
         except Exception as e:
             logger.error("Error finding unix domain socket: %s" % str(e))
             return None
+
+
+class _PendingLookup():
+    # A lookup that other threads can wait for
+    def __init__(self):
+        self.done = threading.Event()
+        self.target = None
+        self.error = None
+
+
+class TokenCache(BasePlugin):
+    """Caches the results of another token plugin.
+
+    Targets are kept for ttl seconds, and tokens that were not found
+    for miss_ttl seconds, for up to size tokens. The least recently used
+    ones are dropped first. Threads that look up the same token at the
+    same time wait for a single lookup by the plugin.
+
+    Once refresh() has been called, processes that are forked after it
+    send what they look up to this process, so that processes forked
+    later start out with it.
+    """
+
+    def __init__(self, plugin, ttl, size=10000, miss_ttl=0):
+        super().__init__(getattr(plugin, 'source', None))
+        self.plugin = plugin
+        self.ttl = ttl
+        self.size = size
+        self.miss_ttl = miss_ttl
+
+        self._lock = threading.Lock()
+        # Token -> (expiry, target), least recently used first
+        self._entries = OrderedDict()
+        # Token -> _PendingLookup
+        self._pending = {}
+
+        # Sockets for passing lookups from forked processes
+        self._collect_sock = None
+        self._report_sock = None
+        self._reporting = False
+
+        logger.info("Caching token lookups for %g seconds (%g seconds if "
+                    "not found), up to %d tokens", ttl, miss_ttl, size)
+
+    @property
+    def metric_name(self):
+        # Lookups are timed under the name of the plugin that is cached
+        return getattr(self.plugin, 'metric_name',
+                       type(self.plugin).__name__)
+
+    def lookup(self, token):
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(token)
+                metrics.token_cache.inc(labels=('hit',))
+                return entry[1]
+
+            pending = self._pending.get(token)
+            if pending is None:
+                pending = self._pending[token] = _PendingLookup()
+                waiting = False
+            else:
+                waiting = True
+
+        if waiting:
+            metrics.token_cache.inc(labels=('coalesced',))
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.target
+
+        metrics.token_cache.inc(labels=('miss',))
+        try:
+            pending.target = self.plugin.lookup(token)
+        except Exception as e:
+            pending.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._pending[token]
+                if pending.error is None:
+                    self._store(token, pending.target)
+            pending.done.set()
+        return pending.target
+
+    def refresh(self):
+        if self._collect_sock is None and not self._reporting:
+            self._collect_sock, self._report_sock = socket.socketpair(
+                socket.AF_UNIX, socket.SOCK_DGRAM)
+            threading.Thread(target=self._collect, daemon=True).start()
+            os.register_at_fork(after_in_child=self._after_fork)
+
+        refresh = getattr(self.plugin, 'refresh', None)
+        if refresh is not None:
+            refresh()
+
+    def _store(self, token, target):
+        # Adds a lookup to the cache, with the lock held
+        ttl = self.ttl if target is not None else self.miss_ttl
+        if ttl <= 0:
+            return
+        expiry = time.monotonic() + ttl
+        self._insert(token, expiry, target)
+
+        if self._reporting:
+            try:
+                data = json.dumps([token, expiry, target]).encode('utf-8')
+                self._report_sock.send(data, socket.MSG_DONTWAIT)
+            except (OSError, TypeError, ValueError):
+                # Only a missed chance to cache it
+                pass
+
+    def _insert(self, token, expiry, target):
+        self._entries[token] = (expiry, target)
+        self._entries.move_to_end(token)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def _after_fork(self):
+        # From now on lookups are also sent to the parent
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._reporting = True
+        self._collect_sock.close()
+
+    def _collect(self):
+        # Adds the lookups sent by forked processes
+        while True:
+            try:
+                data = self._collect_sock.recv(1 << 20)
+            except OSError:
+                return
+            try:
+                token, expiry, target = json.loads(data)
+            except ValueError:
+                continue
+            with self._lock:
+                self._insert(token, expiry, target)
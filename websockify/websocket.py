@@ -12,24 +12,18 @@ Supports following protocol versions:
     - http://tools.ietf.org/html/rfc6455
 '''
 
-import sys
-import array
 import email
 import errno
 import random
 import socket
 import ssl
-import struct
 from base64 import b64encode
 from hashlib import sha1
 from urllib.parse import urlparse
 
-try:
-    import numpy
-except ImportError:
-    import warnings
-    warnings.warn("no 'numpy' module, HyBi protocol will be slower")
-    numpy = None
+from websockify import deflate
+from websockify.protocol import (WebSocketProtocol, Message, Ping, Pong,
+                                 Close, encode_frame, decode_frame)
 
 
 class WebSocketWantReadError(ssl.SSLWantReadError):
@@ -40,6 +34,59 @@ class WebSocketWantWriteError(ssl.SSLWantWriteError):
     pass
 
 
+class ReadSizePolicy:
+    """Adaptive size for reads from a socket.
+
+    Small reads keep memory use down for idle connections, but bulk
+    transfers need large reads to avoid a system call for every few
+    kilobytes. The size doubles whenever a read fills it completely,
+    as more data is then likely to be waiting, and halves again after
+    a number of reads in a row that used less than a quarter of it.
+
+    Some statistics are also kept so that the sizes can be tuned.
+    """
+
+    # Number of small reads in a row before the size is reduced
+    SHRINK_AFTER = 8
+
+    def __init__(self, min_size=4096, max_size=65536):
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self.size = self.min_size
+
+        self.reads = 0
+        self.bytes = 0
+        self.full_reads = 0
+        self.peak_size = self.size
+
+        self._small_reads = 0
+
+    def update(self, count):
+        """Adjusts the size after a read that returned count bytes"""
+        self.reads += 1
+        self.bytes += count
+
+        if count >= self.size:
+            self.full_reads += 1
+            self._small_reads = 0
+            if self.size < self.max_size:
+                self.size = min(self.size * 2, self.max_size)
+                self.peak_size = max(self.peak_size, self.size)
+        elif count < self.size // 4:
+            self._small_reads += 1
+            if self._small_reads >= self.SHRINK_AFTER:
+                self._small_reads = 0
+                self.size = max(self.size // 2, self.min_size)
+        else:
+            self._small_reads = 0
+
+    def stats(self):
+        """Returns a short description of the statistics"""
+        return ("%d reads, %d bytes, %d full, size %d (peak %d)" %
+                (self.reads, self.bytes, self.full_reads,
+                 self.size, self.peak_size))
+
+
 class WebSocket:
     """WebSocket protocol socket like class.
 
@@ -68,6 +115,9 @@ class WebSocket:
         - getsockopt, setsockopt
         - gettimeout, settimeout
         - setblocking
+
+    The protocol itself is handled by a WebSocketProtocol object, and
+    this class only moves data between it and the socket.
     """
 
     GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
@@ -77,21 +127,34 @@ class WebSocket:
 
         self._state = "new"
 
-        self._partial_msg = b''
+        self._protocol = WebSocketProtocol()
 
-        self._recv_buffer = b''
-        self._recv_queue = []
-        self._send_buffer = b''
+        self.read_size = ReadSizePolicy()
 
         self._previous_sendmsg = None
 
-        self._sent_close = False
-        self._received_close = False
+        self.socket = None
 
-        self.close_code = None
-        self.close_reason = None
+    @property
+    def client(self):
+        return self._protocol.client
 
-        self.socket = None
+    @client.setter
+    def client(self, value):
+        self._protocol.client = value
+
+    @property
+    def compression(self):
+        """The negotiated deflate.PerMessageDeflate object, or None"""
+        return self._protocol.deflate
+
+    @property
+    def close_code(self):
+        return self._protocol.close_code
+
+    @property
+    def close_reason(self):
+        return self._protocol.close_reason
 
     def __getattr__(self, name):
         # These methods are just redirected to the underlying socket
@@ -188,10 +251,11 @@ class WebSocket:
             if not self._recv():
                 raise Exception("Socket closed unexpectedly")
 
-            if self._recv_buffer.find(b'\r\n\r\n') == -1:
+            response = self._protocol.read_until(b'\r\n\r\n')
+            if response is None:
                 raise WebSocketWantReadError
 
-            (request, self._recv_buffer) = self._recv_buffer.split(b'\r\n', 1)
+            (request, _, headers) = response.partition(b'\r\n')
             request = request.decode("latin-1")
 
             words = request.split()
@@ -200,7 +264,6 @@ class WebSocket:
             if words[1] != "101":
                 raise Exception("WebSocket request denied: %s" % " ".join(words[1:]))
 
-            (headers, self._recv_buffer) = self._recv_buffer.split(b'\r\n\r\n', 1)
             headers = headers.decode('latin-1') + '\r\n'
             headers = email.message_from_string(headers)
 
@@ -228,6 +291,9 @@ class WebSocket:
                 if self.protocol not in protocols:
                     raise Exception("Invalid protocol chosen by server")
 
+            # Anything after the response is WebSocket frames
+            self._protocol.open()
+
             self._state = "done"
 
             return
@@ -289,6 +355,12 @@ class WebSocket:
                 if self.protocol not in protocols:
                     raise Exception('Invalid protocol selected')
 
+            compression = None
+            offers = deflate.parse_offers(
+                headers.get('Sec-WebSocket-Extensions', ''))
+            if offers:
+                compression = self.select_compression(offers)
+
             self.send_response(101, "Switching Protocols")
             self.send_header("Upgrade", "websocket")
             self.send_header("Connection", "Upgrade")
@@ -297,8 +369,15 @@ class WebSocket:
             if self.protocol:
                 self.send_header("Sec-WebSocket-Protocol", self.protocol)
 
+            if compression is not None:
+                self.send_header("Sec-WebSocket-Extensions",
+                                 compression.response)
+                self._protocol.deflate = compression
+
             self.end_headers()
 
+            self._protocol.open()
+
             self._state = "flush"
 
         if self._state == "flush":
@@ -319,6 +398,18 @@ class WebSocket:
         """
         return ""
 
+    def select_compression(self, offers):
+        """Returns how messages should be compressed.
+
+        offers are the client's permessage-deflate offers, as returned
+        by deflate.parse_offers(). This method does not compress by
+        default and is meant to be overridden by an implementation that
+        wishes to, usually by returning the result of
+        deflate.negotiate(). It will be called during handling of
+        accept().
+        """
+        return None
+
     def handle_ping(self, data):
         """Called when a WebSocket ping message is received.
 
@@ -369,7 +460,7 @@ class WebSocket:
         raised when calling recvmsg().
         """
         # May have been called to flush out a close
-        if self._received_close:
+        if self._protocol.received_close:
             self._flush()
             return None
 
@@ -401,7 +492,7 @@ class WebSocket:
         frames pending. Those frames may not contain any application
         data.
         """
-        return len(self._recv_queue) > 0
+        return self._protocol.pending()
 
     def send(self, bytes):
         """Write data to the WebSocket
@@ -433,7 +524,7 @@ class WebSocket:
         if not isinstance(msg, bytes):
             raise TypeError
 
-        if self._sent_close:
+        if self._protocol.sent_close:
             return 0
 
         if self._previous_sendmsg is not None:
@@ -533,24 +624,12 @@ class WebSocket:
         """
 
         # Already closing?
-        if self._sent_close:
+        if self._protocol.sent_close:
             self._flush()
             return
 
-        # Special code to indicate that we closed the connection
-        if not self._received_close:
-            self.close_code = 1000
-            self.close_reason = "Locally initiated close"
-
-        self._sent_close = True
-
-        msg = b''
-        if code is not None:
-            msg += struct.pack(">H", code)
-            if reason is not None:
-                msg += reason.encode("UTF-8")
-
-        self._sendmsg(0x8, msg)
+        self._protocol.send_close(code, reason)
+        self._flush()
 
     def close(self, code=1000, reason=None):
         """Terminate the WebSocket connection immediately.
@@ -571,17 +650,25 @@ class WebSocket:
         assert self.socket is not None
 
         while True:
+            size = self.read_size.size
+
             try:
-                data = self.socket.recv(4096)
+                with self._protocol.get_buffer(size) as view:
+                    count = self.socket.recv_into(view, size)
+            except ssl.SSLWantReadError:
+                raise WebSocketWantReadError
+            except ssl.SSLWantWriteError:
+                raise WebSocketWantWriteError
             except OSError as exc:
                 if exc.errno == errno.EWOULDBLOCK:
                     raise WebSocketWantReadError
                 raise
 
-            if len(data) == 0:
+            if count == 0:
                 return False
 
-            self._recv_buffer += data
+            self._protocol.buffer_updated(count)
+            self.read_size.update(count)
 
             # Support for SSLSocket like objects
             if hasattr(self.socket, "pending"):
@@ -595,282 +682,96 @@ class WebSocket:
     def _recv_frames(self):
         # Fetches more data and decodes the frames
         if not self._recv():
-            if self.close_code is None:
-                self.close_code = 1006
-                self.close_reason = "Connection closed abnormally"
-                self._sent_close = self._received_close = True
+            self._protocol.receive_eof()
             self._close()
             return False
 
-        while True:
-            frame = self._decode_hybi(self._recv_buffer)
-            if frame is None:
-                break
-            self._recv_buffer = self._recv_buffer[frame['length']:]
-            self._recv_queue.append(frame)
-
         return True
 
     def _recvmsg(self):
         # Process pending frames and returns any application data
-        while self._recv_queue:
-            frame = self._recv_queue.pop(0)
-
-            if not self.client and not frame['masked']:
-                self.shutdown(socket.SHUT_RDWR, 1002, "Procotol error: Frame not masked")
-                continue
-            if self.client and frame['masked']:
-                self.shutdown(socket.SHUT_RDWR, 1002, "Procotol error: Frame masked")
-                continue
-
-            if frame["opcode"] == 0x0:
-                if not self._partial_msg:
-                    self.shutdown(socket.SHUT_RDWR, 1002, "Procotol error: Unexpected continuation frame")
-                    continue
-
-                self._partial_msg += frame["payload"]
-
-                if frame["fin"]:
-                    msg = self._partial_msg
-                    self._partial_msg = b''
-                    return msg
-            elif frame["opcode"] == 0x1:
-                self.shutdown(socket.SHUT_RDWR, 1003, "Unsupported: Text frames are not supported")
-            elif frame["opcode"] == 0x2:
-                if self._partial_msg:
-                    self.shutdown(socket.SHUT_RDWR, 1002, "Procotol error: Unexpected new frame")
-                    continue
-
-                if frame["fin"]:
-                    return frame["payload"]
-                else:
-                    self._partial_msg = frame["payload"]
-            elif frame["opcode"] == 0x8:
-                if self._received_close:
-                    continue
-
-                self._received_close = True
-
-                if self._sent_close:
-                    self._close()
-                    return None
-
-                if not frame["fin"]:
-                    self.shutdown(socket.SHUT_RDWR, 1003, "Unsupported: Fragmented close")
-                    continue
-
-                code = None
-                reason = None
-                if len(frame["payload"]) >= 2:
-                    code = struct.unpack(">H", frame["payload"][:2])[0]
-                    if len(frame["payload"]) > 2:
-                        reason = frame["payload"][2:]
-                        try:
-                            reason = reason.decode("UTF-8")
-                        except UnicodeDecodeError:
-                            self.shutdown(socket.SHUT_RDWR, 1002, "Procotol error: Invalid UTF-8 in close")
-                            continue
-
-                if code is None:
-                    self.close_code = 1005
-                    self.close_reason = "No close status code specified by peer"
-                else:
-                    self.close_code = code
-                    if reason is not None:
-                        self.close_reason = reason
-
-                self.shutdown(None, code, reason)
+        while True:
+            event = self._protocol.next_event()
+            if event is None:
+                break
+
+            if isinstance(event, Message):
+                return event.data
+            elif isinstance(event, Ping):
+                self.handle_ping(event.data)
+            elif isinstance(event, Pong):
+                self.handle_pong(event.data)
+            elif isinstance(event, Close):
+                # Sends our reply, if needed, and closes the socket
+                self._flush()
                 return None
-            elif frame["opcode"] == 0x9:
-                if not frame["fin"]:
-                    self.shutdown(socket.SHUT_RDWR, 1003, "Unsupported: Fragmented ping")
-                    continue
-
-                self.handle_ping(frame["payload"])
-            elif frame["opcode"] == 0xA:
-                if not frame["fin"]:
-                    self.shutdown(socket.SHUT_RDWR, 1003, "Unsupported: Fragmented pong")
-                    continue
-
-                self.handle_pong(frame["payload"])
-            else:
-                self.shutdown(socket.SHUT_RDWR, 1003, "Unsupported: Unknown opcode 0x%02x" % frame["opcode"])
+
+        # Protocol errors result in a close message that should go
+        # out right away
+        self._flush()
 
         raise WebSocketWantReadError
 
     def _flush(self):
         # Writes pending data to the socket
-        if not self._send_buffer:
-            return
-
-        assert self.socket is not None
+        if self._protocol.has_data_to_send():
+            assert self.socket is not None
 
-        try:
-            sent = self.socket.send(self._send_buffer)
-        except OSError as exc:
-            if exc.errno == errno.EWOULDBLOCK:
-                raise WebSocketWantWriteError
-            raise
+            # SSLSocket has sendmsg(), but refuses to use it
+            vectored = (hasattr(self.socket, "sendmsg") and
+                        not isinstance(self.socket, ssl.SSLSocket))
+
+            while self._protocol.has_data_to_send():
+                bufs = self._protocol.buffers_to_send(coalesce=not vectored)
+                try:
+                    if len(bufs) == 1:
+                        sent = self.socket.send(bufs[0])
+                    elif vectored:
+                        sent = self.socket.sendmsg(bufs)
+                    else:
+                        sent = self.socket.send(b''.join(bufs))
+                except ssl.SSLWantWriteError:
+                    raise WebSocketWantWriteError
+                except ssl.SSLWantReadError:
+                    raise WebSocketWantReadError
+                except OSError as exc:
+                    if exc.errno == errno.EWOULDBLOCK:
+                        raise WebSocketWantWriteError
+                    raise
 
-        self._send_buffer = self._send_buffer[sent:]
+                self._protocol.data_sent(sent)
 
-        if self._send_buffer:
-            raise WebSocketWantWriteError
+                if sent < sum(len(buf) for buf in bufs):
+                    raise WebSocketWantWriteError
 
         # We had a pending close and we've flushed the buffer,
         # time to end things
-        if self._received_close and self._sent_close:
+        if self._protocol.closed and self.socket is not None:
             self._close()
 
-    def _send(self, data):
-        # Queues data and attempts to send it
-        self._send_buffer += data
-        self._flush()
-
     def _queue_str(self, string):
         # Queue some data to be sent later.
         # Only used by the connecting methods.
-        self._send_buffer += string.encode("latin-1")
+        self._protocol.send_raw(string.encode("latin-1"))
 
     def _sendmsg(self, opcode, msg):
         # Sends a standard data message
-        if self.client:
-            mask = b''
-            for i in range(4):
-                mask += random.randrange(256).to_bytes()
-            frame = self._encode_hybi(opcode, msg, mask)
-        else:
-            frame = self._encode_hybi(opcode, msg)
-
-        return self._send(frame)
+        self._protocol.send_frame(opcode, msg)
+        self._flush()
 
     def _close(self):
         # Close the underlying socket
         self.socket.close()
         self.socket = None
 
-    def _mask(self, buf, mask):
-        # Mask a frame
-        return self._unmask(buf, mask)
-
-    def _unmask(self, buf, mask):
-        # Unmask a frame
-        if numpy:
-            plen = len(buf)
-            b = c = b''
-            if plen >= 4:
-                dtype = numpy.dtype('<u4')
-                if sys.byteorder == 'big':
-                    dtype = dtype.newbyteorder('>')
-                mask = numpy.frombuffer(mask, dtype, count=1)
-                data = numpy.frombuffer(buf, dtype, count=int(plen / 4))
-                b = numpy.bitwise_xor(data, mask).tobytes()
-
-            if plen % 4:
-                dtype = numpy.dtype('B')
-                if sys.byteorder == 'big':
-                    dtype = dtype.newbyteorder('>')
-                mask = numpy.frombuffer(mask, dtype, count=(plen % 4))
-                data = numpy.frombuffer(buf, dtype,
-                                        offset=plen - (plen % 4), count=(plen % 4))
-                c = numpy.bitwise_xor(data, mask).tobytes()
-            return b + c
-        else:
-            # Slower fallback
-            data = array.array('B')
-            data.frombytes(buf)
-            for i in range(len(data)):
-                data[i] ^= mask[i % 4]
-            return data.tobytes()
-
     def _encode_hybi(self, opcode, buf, mask_key=None, fin=True):
         """ Encode a HyBi style WebSocket frame.
-        Optional opcode:
-            0x0 - continuation
-            0x1 - text frame
-            0x2 - binary frame
-            0x8 - connection close
-            0x9 - ping
-            0xA - pong
+        See protocol.encode_frame().
         """
-
-        b1 = opcode & 0x0f
-        if fin:
-            b1 |= 0x80
-
-        mask_bit = 0
-        if mask_key is not None:
-            mask_bit = 0x80
-            buf = self._mask(buf, mask_key)
-
-        payload_len = len(buf)
-        if payload_len <= 125:
-            header = struct.pack('>BB', b1, payload_len | mask_bit)
-        elif payload_len > 125 and payload_len < 65536:
-            header = struct.pack('>BBH', b1, 126 | mask_bit, payload_len)
-        elif payload_len >= 65536:
-            header = struct.pack('>BBQ', b1, 127 | mask_bit, payload_len)
-
-        if mask_key is not None:
-            return header + mask_key + buf
-        else:
-            return header + buf
+        return encode_frame(opcode, buf, mask_key, fin)
 
     def _decode_hybi(self, buf):
         """ Decode HyBi style WebSocket packets.
-        Returns:
-            {'fin'          : boolean,
-             'opcode'       : number,
-             'masked'       : boolean,
-             'length'       : encoded_length,
-             'payload'      : decoded_buffer}
+        See protocol.decode_frame().
         """
-
-        f = {'fin': 0,
-             'opcode': 0,
-             'masked': False,
-             'length': 0,
-             'payload': None}
-
-        blen = len(buf)
-        hlen = 2
-
-        if blen < hlen:
-            return None
-
-        b1, b2 = struct.unpack(">BB", buf[:2])
-        f['opcode'] = b1 & 0x0f
-        f['fin'] = not not (b1 & 0x80)
-        f['masked'] = not not (b2 & 0x80)
-
-        if f['masked']:
-            hlen += 4
-            if blen < hlen:
-                return None
-
-        length = b2 & 0x7f
-
-        if length == 126:
-            hlen += 2
-            if blen < hlen:
-                return None
-            length, = struct.unpack('>H', buf[2:4])
-        elif length == 127:
-            hlen += 8
-            if blen < hlen:
-                return None
-            length, = struct.unpack('>Q', buf[2:10])
-
-        f['length'] = hlen + length
-
-        if blen < f['length']:
-            return None
-
-        if f['masked']:
-            # unmask payload
-            mask_key = buf[hlen - 4:hlen]
-            f['payload'] = self._unmask(buf[hlen:(hlen + length)], mask_key)
-        else:
-            f['payload'] = buf[hlen:(hlen + length)]
-
-        return f
+        return decode_frame(buf)
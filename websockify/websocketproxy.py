@@ -11,12 +11,11 @@ as taken from http://docs.python.org/dev/library/ssl.html#certificates
 
 '''
 
-import errno
 from http.server import HTTPServer
 import logging
 import optparse
 import os
-import select
+import selectors
 import signal
 import socket
 from socketserver import ThreadingMixIn
@@ -30,12 +29,19 @@ from urllib.parse import urlparse
 
 from websockify import websockifyserver
 from websockify import auth_plugins as auth
+from websockify import masking
+from websockify import metrics
+from websockify.websocket import ReadSizePolicy
 
 
 class ProxyRequestHandler(websockifyserver.WebSockifyRequestHandler):
 
+    # Largest read from a socket, unless the server sets max_read_size
     buffer_size = 65536
 
+    # Set for a target that has a flush policy of its own
+    flush_policy = None
+
     traffic_legend = """
 Traffic Legend:
     }  - Client receive
@@ -60,7 +66,11 @@ Traffic Legend:
         if not self.server.token_plugin:
             return
 
-        host, port = self.get_target(self.server.token_plugin)
+        target = self.get_target(self.server.token_plugin)
+        host, port = target[0], target[1]
+        if len(target) > 2:
+            self.apply_target_options(target[2])
+
         if host == 'unix_socket':
             self.server.unix_target = port
 
@@ -68,6 +78,20 @@ Traffic Legend:
             self.server.target_host = host
             self.server.target_port = port
 
+    def apply_target_options(self, options):
+        """
+        Applies the settings that a token plugin returned along with
+        the target, overriding the server's.
+        """
+        if 'flush' in options:
+            try:
+                parse_flush_policy(options['flush'])
+            except ValueError:
+                self.log_message("Ignoring invalid flush policy for target: %s",
+                                 options['flush'])
+            else:
+                self.flush_policy = options['flush']
+
     def auth_connection(self):
         if not self.server.auth_plugin:
             return
@@ -106,7 +130,18 @@ Traffic Legend:
         """
         # Checking for a token is done in validate_connection()
 
-        # Connect to the target
+        tsock = self.connect_target()
+
+        # Start proxying
+        try:
+            self.do_proxy(tsock)
+        finally:
+            self.close_target(tsock)
+
+    def connect_target(self):
+        """
+        Connects to the target and returns the socket.
+        """
         if self.server.wrap_cmd:
             msg = "connecting to command: '%s' (port %s)" % (" ".join(self.server.wrap_cmd), self.server.target_port)
         elif self.server.unix_target:
@@ -136,18 +171,26 @@ Traffic Legend:
         if not self.server.wrap_cmd and not self.server.unix_target:
             tsock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
 
-        self.print_traffic(self.traffic_legend)
+        return tsock
 
-        # Start proxying
-        try:
-            self.do_proxy(tsock)
-        finally:
-            if tsock:
-                tsock.shutdown(socket.SHUT_RDWR)
-                tsock.close()
-                if self.verbose:
-                    self.log_message("%s:%s: Closed target",
-                                     self.server.target_host, self.server.target_port)
+    def close_target(self, tsock):
+        """
+        Closes the target socket once proxying has stopped.
+        """
+        if tsock:
+            tsock.shutdown(socket.SHUT_RDWR)
+            tsock.close()
+            self._report_queue_sizes(0, 0)
+            if self.verbose:
+                self.log_message("%s:%s: Closed target",
+                                 self.server.target_host, self.server.target_port)
+                self.log_message("Client reads: %s",
+                                 self.request.read_size.stats())
+                self.log_message("Target reads: %s",
+                                 self.target_read_size.stats())
+                if self.request.compression is not None:
+                    self.log_message("Compression: %s",
+                                     self.request.compression.stats())
 
     def get_target(self, target_plugin):
         """
@@ -181,7 +224,14 @@ Traffic Legend:
         if token is None:
             raise self.server.EClose("Token not present")
 
-        result_pair = target_plugin.lookup(token)
+        name = getattr(target_plugin, 'metric_name',
+                       type(target_plugin).__name__)
+        start = time.monotonic()
+        try:
+            result_pair = target_plugin.lookup(token)
+        finally:
+            metrics.token_lookup_seconds.observe(
+                time.monotonic() - start, (name,))
 
         if result_pair is not None:
             return result_pair
@@ -191,110 +241,310 @@ Traffic Legend:
     def do_proxy(self, target):
         """
         Proxy client WebSocket to normal target socket.
+
+        Interest in each socket is only updated when it changes, and the
+        selector only wakes up without traffic when a heartbeat is due.
+        """
+        self.proxy_setup()
+
+        with selectors.DefaultSelector() as sel:
+            registered = {}
+
+            while True:
+                cevents, tevents = self.proxy_events()
+                self._update_interest(sel, registered, self.request, cevents)
+                self._update_interest(sel, registered, target, tevents)
+
+                for key, events in sel.select(self.proxy_timeout()):
+                    if key.fileobj is self.request:
+                        if events & selectors.EVENT_WRITE:
+                            self.proxy_client_writable()
+                        if events & selectors.EVENT_READ:
+                            self.proxy_client_readable()
+                    else:
+                        if events & selectors.EVENT_WRITE:
+                            self.proxy_target_writable(target)
+                        if events & selectors.EVENT_READ:
+                            self.proxy_target_readable(target)
+
+                self.proxy_check_closed()
+                self.proxy_heartbeat()
+
+    @staticmethod
+    def _update_interest(sel, registered, sock, events):
+        old = registered.get(sock, 0)
+        if events == old:
+            return
+        if not events:
+            sel.unregister(sock)
+        elif not old:
+            sel.register(sock, events)
+        else:
+            sel.modify(sock, events)
+        registered[sock] = events
+
+    def proxy_setup(self):
+        """
+        Prepares the per connection state used by the proxy_*() methods,
+        which any event loop can call to move data between the client
+        and the target.
         """
-        cqueue = []
-        c_pend = 0
-        tqueue = []
-        rlist = [self.request, target]
+        self.cqueue = []
+        self.c_pend = False
+        self.tqueue = []
+        # (code, reason) once either side has closed the connection
+        self.closing = None
+
+        # Reading from a side stops while the other side has too much
+        # of its data queued
+        self.client_paused = False
+        self.target_paused = False
+        self.reported_sizes = (0, 0)
+
+        # Target data is held back until this time, to be sent in
+        # fewer and larger messages
+        self.coalesce_deadline = None
+
+        policy, delay = parse_flush_policy(self.flush_policy or
+                                           self.server.flush_policy)
+        self.flush_delay = max(delay, self.server.coalesce_delay)
+        # The client socket is corked while messages are written to it
+        self.flush_cork = policy != "immediate"
+        self.corked = False
+
+        # Each direction adapts its read size to the traffic
+        max_read_size = self.server.max_read_size or self.buffer_size
+        min_read_size = min(self.server.min_read_size, max_read_size)
+        self.request.read_size = ReadSizePolicy(min_read_size, max_read_size)
+        self.target_read_size = ReadSizePolicy(min_read_size, max_read_size)
 
         if self.server.heartbeat:
-            now = time.time()
-            self.heartbeat = now + self.server.heartbeat
+            self.heartbeat = time.monotonic() + self.server.heartbeat
         else:
             self.heartbeat = None
 
-        while True:
-            wlist = []
+        self.print_traffic(self.traffic_legend)
 
-            if self.heartbeat is not None:
-                now = time.time()
-                if now > self.heartbeat:
-                    self.heartbeat = now + self.server.heartbeat
-                    self.send_ping()
-
-            if tqueue:
-                wlist.append(target)
-            if cqueue or c_pend:
-                wlist.append(self.request)
-            try:
-                ins, outs, excepts = select.select(rlist, wlist, [], 1)
-            except OSError:
-                exc = sys.exc_info()[1]
-                if hasattr(exc, 'errno'):
-                    err = exc.errno
-                else:
-                    err = exc[0]
+    def proxy_events(self):
+        """
+        Returns the selector events that the client and the target
+        socket are currently waiting for.
+        """
+        self.proxy_backpressure()
 
-                if err != errno.EINTR:
-                    raise
-                else:
-                    continue
-
-            if excepts:
-                raise Exception("Socket exception")
-
-            if self.request in outs:
-                # Send queued target data to the client
-                c_pend = self.send_frames(cqueue)
-
-                cqueue = []
-
-            if self.request in ins:
-                # Receive client data, decode it, and queue for target
-                bufs, closed = self.recv_frames()
-                tqueue.extend(bufs)
-
-                if closed:
-
-                    while (len(tqueue) != 0):
-                        # Send queued client data to the target
-                        dat = tqueue.pop(0)
-                        sent = target.send(dat)
-                        if sent == len(dat):
-                            self.print_traffic(">")
-                        else:
-                            # requeue the remaining data
-                            tqueue.insert(0, dat[sent:])
-                            self.print_traffic(".>")
-
-                    # TODO: What about blocking on client socket?
-                    if self.verbose:
-                        self.log_message("%s:%s: Client closed connection",
-                                         self.server.target_host, self.server.target_port)
-                    raise self.CClose(closed['code'], closed['reason'])
-
-            if target in outs:
-                # Send queued client data to the target
-                dat = tqueue.pop(0)
-                sent = target.send(dat)
-                if sent == len(dat):
-                    self.print_traffic(">")
-                else:
-                    # requeue the remaining data
-                    tqueue.insert(0, dat[sent:])
-                    self.print_traffic(".>")
+        if self.closing:
+            # Only the data still on its way matters now
+            cevents = tevents = 0
+        else:
+            cevents = tevents = selectors.EVENT_READ
+            if self.client_paused:
+                cevents = 0
+            if self.target_paused:
+                tevents = 0
 
-            if target in ins:
-                # Receive target data, encode it and queue for client
-                buf = target.recv(self.buffer_size)
-                if len(buf) == 0:
+        if self.c_pend or (self.cqueue and self.proxy_coalesced()):
+            cevents |= selectors.EVENT_WRITE
+        if self.tqueue:
+            tevents |= selectors.EVENT_WRITE
 
-                    # Target socket closed, flushing queues and closing client-side websocket
-                    # Send queued target data to the client
-                    if len(cqueue) != 0:
-                        c_pend = True
-                        while (c_pend):
-                            c_pend = self.send_frames(cqueue)
+        return cevents, tevents
 
-                        cqueue = []
+    def proxy_deadline(self):
+        """
+        Returns the time.monotonic() time when the next heartbeat is due
+        or held back target data has to be sent, or None if there is
+        nothing to wait for.
+        """
+        deadlines = [self.heartbeat]
+        # Once passed, the client is already waited on instead
+        if (self.coalesce_deadline is not None and
+                self.coalesce_deadline > time.monotonic()):
+            deadlines.append(self.coalesce_deadline)
+        return min((d for d in deadlines if d is not None), default=None)
+
+    def proxy_timeout(self):
+        """
+        Returns how long to wait for socket events before the next
+        deadline, or None if there is none.
+        """
+        deadline = self.proxy_deadline()
+        if deadline is None:
+            return None
+        return max(0, deadline - time.monotonic())
 
-                    if self.verbose:
-                        self.log_message("%s:%s: Target closed connection",
-                                         self.server.target_host, self.server.target_port)
-                    raise self.CClose(1000, "Target closed")
+    def proxy_coalesced(self):
+        """
+        Returns True once the target data in cqueue should be sent to
+        the client, rather than held back for more to arrive.
+        """
+        if self.coalesce_deadline is None or self.closing:
+            return True
+        # Without a message size, a full read is worth sending
+        size = self.server.coalesce_size or self.target_read_size.max_size
+        if sum(len(buf) for buf in self.cqueue) >= size:
+            return True
+        return time.monotonic() >= self.coalesce_deadline
+
+    def proxy_cork(self, cork):
+        """
+        Sets TCP_CORK on the client socket, so that the messages written
+        while it is set go out in full TCP segments.
+        """
+        if cork == self.corked:
+            return
+        try:
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK,
+                                    int(cork))
+        except (AttributeError, OSError):
+            # Not a TCP socket, e.g. with --unix-listen, or no TCP_CORK
+            self.flush_cork = False
+            return
+        self.corked = cork
+
+    def client_queue_size(self):
+        """
+        Returns the number of bytes waiting to be sent to the client.
+        """
+        return (sum(len(buf) for buf in self.cqueue) +
+                sum(len(buf) for buf in self.send_parts))
+
+    def target_queue_size(self):
+        """
+        Returns the number of bytes waiting to be sent to the target.
+        """
+        return sum(len(buf) for buf in self.tqueue)
+
+    def proxy_backpressure(self):
+        """
+        Pauses reading from a side while too much of its data is waiting
+        to be sent to the other side, and resumes once the queue has gone
+        down to the low watermark.
+        """
+        csize = self.client_queue_size()
+        tsize = self.target_queue_size()
+
+        self.target_paused = self._paused(self.target_paused, csize,
+                                          self.server.client_queue_high,
+                                          self.server.client_queue_low,
+                                          "to_client")
+        self.client_paused = self._paused(self.client_paused, tsize,
+                                          self.server.target_queue_high,
+                                          self.server.target_queue_low,
+                                          "to_target")
+
+        self._report_queue_sizes(csize, tsize)
+
+    @staticmethod
+    def _paused(paused, size, high, low, direction):
+        if paused:
+            return size > low
+        if high and size >= high:
+            metrics.backpressure_pauses.inc(labels=(direction,))
+            return True
+        return False
+
+    def _report_queue_sizes(self, csize, tsize):
+        # Keeps the totals over all connections up to date
+        if csize != self.reported_sizes[0]:
+            metrics.queued_bytes.inc(csize - self.reported_sizes[0],
+                                     ("to_client",))
+        if tsize != self.reported_sizes[1]:
+            metrics.queued_bytes.inc(tsize - self.reported_sizes[1],
+                                     ("to_target",))
+        self.reported_sizes = (csize, tsize)
+
+    def proxy_heartbeat(self):
+        """
+        Sends a ping to the client if a heartbeat is due.
+        """
+        if self.heartbeat is None:
+            return
+        now = time.monotonic()
+        if now < self.heartbeat:
+            return
+        self.heartbeat = now + self.server.heartbeat
+        # A ping cannot be sent in the middle of a message, and the
+        # connection is obviously alive if data is still being sent
+        if not self.c_pend:
+            self.send_ping()
+
+    def proxy_check_closed(self):
+        """
+        Raises CClose once a side has closed and everything it sent has
+        been passed on.
+        """
+        if self.closing and not (self.cqueue or self.c_pend or self.tqueue):
+            raise self.CClose(*self.closing)
+
+    def proxy_client_writable(self):
+        # Send queued target data to the client
+        if self.flush_cork:
+            self.proxy_cork(True)
+        self.c_pend = self.send_frames(self.cqueue)
+        self.cqueue = []
+        self.coalesce_deadline = None
+        # Whatever is left in the socket goes out once all is written
+        if self.corked and not self.c_pend:
+            self.proxy_cork(False)
+
+    def proxy_client_readable(self):
+        # Receive client data, decode it, and queue for target
+        bufs, closed = self.recv_frames()
+        self.tqueue.extend(bufs)
+
+        if closed:
+            if self.verbose:
+                self.log_message("%s:%s: Client closed connection",
+                                 self.server.target_host, self.server.target_port)
+            # Pass on what is left for the target, but nothing more
+            # can be sent to the client
+            self.cqueue = []
+            self.c_pend = False
+            self.closing = (closed['code'], closed['reason'])
+
+    def proxy_target_writable(self, target):
+        # Send queued client data to the target
+        dat = self.tqueue.pop(0)
+        try:
+            sent = target.send(dat)
+        except (BlockingIOError, ssl.SSLWantWriteError):
+            sent = 0
+        if sent == len(dat):
+            self.print_traffic(">")
+        else:
+            # requeue the remaining data
+            self.tqueue.insert(0, dat[sent:])
+            self.print_traffic(".>")
+
+    def proxy_target_readable(self, target):
+        # Receive target data, encode it and queue for client
+        while True:
+            try:
+                buf = target.recv(self.target_read_size.size)
+            except (BlockingIOError, ssl.SSLWantReadError):
+                return
+            self.target_read_size.update(len(buf))
+            if len(buf) == 0:
+                if self.verbose:
+                    self.log_message("%s:%s: Target closed connection",
+                                     self.server.target_host, self.server.target_port)
+                # Flush the queued target data to the client before
+                # closing the client-side websocket
+                self.tqueue = []
+                self.closing = (1000, "Target closed")
+                return
+
+            self.cqueue.append(buf)
+            self.print_traffic("{")
 
-                cqueue.append(buf)
-                self.print_traffic("{")
+            if self.coalesce_deadline is None and self.flush_delay:
+                self.coalesce_deadline = (time.monotonic() +
+                                          self.flush_delay / 1e6)
+
+            # Data that SSL has already decrypted will not wake up
+            # the selector again
+            if not (hasattr(target, "pending") and target.pending()):
+                return
 
 
 class WebSocketProxy(websockifyserver.WebSockifyServer):
@@ -314,6 +564,15 @@ class WebSocketProxy(websockifyserver.WebSockifyServer):
         self.unix_target = kwargs.pop('unix_target', None)
         self.ssl_target = kwargs.pop('ssl_target', None)
         self.heartbeat = kwargs.pop('heartbeat', None)
+        self.min_read_size = kwargs.pop('min_read_size', 4096)
+        self.max_read_size = kwargs.pop('max_read_size', None)
+        self.client_queue_high = kwargs.pop('client_queue_high', 4194304)
+        self.client_queue_low = kwargs.pop('client_queue_low', 1048576)
+        self.target_queue_high = kwargs.pop('target_queue_high', 4194304)
+        self.target_queue_low = kwargs.pop('target_queue_low', 1048576)
+        self.coalesce_size = kwargs.pop('coalesce_size', 0)
+        self.coalesce_delay = kwargs.pop('coalesce_delay', 0)
+        self.flush_policy = kwargs.pop('flush_policy', 'immediate')
 
         self.token_plugin = kwargs.pop('token_plugin', None)
         self.host_token = kwargs.pop('host_token', None)
@@ -398,7 +657,23 @@ class WebSocketProxy(websockifyserver.WebSockifyServer):
         if self.wrap_cmd:
             self.run_wrap_cmd()
 
+        # Before any processes are forked
+        self.refresh_token_plugin()
+
+    def refresh_token_plugin(self):
+        # Lets the token plugin update what it caches between lookups
+        refresh = getattr(self.token_plugin, 'refresh', None)
+        if refresh is None:
+            return
+        try:
+            refresh()
+        except Exception as e:
+            self.warn("Refreshing token plugin failed: %s", e)
+            self.vmsg("exception", exc_info=True)
+
     def poll(self):
+        self.refresh_token_plugin()
+
         # If we are wrapping a command, check it's status
 
         if self.wrap_cmd and self.cmd:
@@ -460,6 +735,34 @@ def select_ssl_version(version):
         return SSL_OPTIONS[fallback]
 
 
+def parse_flush_policy(policy):
+    """Returns the name of a flush policy and how many microseconds
+    data is held back by it. Raises ValueError if it is invalid."""
+    name, _, delay = policy.partition(':')
+    if name in ("immediate", "cork") and not delay:
+        return name, 0
+    if name == "batch" and delay:
+        delay = int(delay)
+        if delay > 0:
+            return name, delay
+    raise ValueError("Invalid flush policy: %s" % policy)
+
+
+def parse_token_cache(value):
+    """Returns the seconds to keep targets, the most tokens to keep and
+    the seconds to keep tokens that were not found, from a value like
+    TTL[,SIZE[,MISS_TTL]]. Raises ValueError if it is invalid."""
+    fields = value.split(',')
+    if len(fields) > 3:
+        raise ValueError("Invalid token cache: %s" % value)
+    ttl = float(fields[0])
+    size = int(fields[1]) if len(fields) > 1 else 10000
+    miss_ttl = float(fields[2]) if len(fields) > 2 else 0
+    if ttl <= 0 or size <= 0 or miss_ttl < 0:
+        raise ValueError("Invalid token cache: %s" % value)
+    return ttl, size, miss_ttl
+
+
 def websockify_init():
     # Setup basic logging to stderr.
     stderr_handler = logging.StreamHandler()
@@ -519,6 +822,15 @@ def websockify_init():
     parser.add_option("--ssl-ciphers", action="store",
                       help="list of ciphers allowed for connection. For a list of "
                       "supported ciphers run `openssl ciphers`")
+    parser.add_option("--ssl-ticket-rotation", type=int, default=None,
+                      metavar="SECONDS",
+                      help="replace the key that encrypts TLS session tickets "
+                      "every SECONDS, 0 to keep it until the certificate "
+                      "changes (default 3600, or 0 with --workers)")
+    parser.add_option("--ssl-ktls", action="store_true",
+                      help="let the kernel encrypt and decrypt SSL client "
+                      "connections where possible (needs Linux, Python 3.12 "
+                      "or newer and OpenSSL with kTLS support)")
     parser.add_option("--unix-listen",
                       help="listen to unix socket", metavar="FILE", default=None)
     parser.add_option("--unix-listen-mode", default=None,
@@ -540,6 +852,14 @@ def websockify_init():
                       help="prefer IPv6 when resolving source_addr")
     parser.add_option("--libserver", action="store_true",
                       help="use Python library SocketServer engine")
+    parser.add_option("--engine", default="fork", metavar="ENGINE",
+                      choices=["fork", "asyncio"],
+                      help="how connections are served: fork (default), a "
+                      "process per connection, or asyncio, all connections "
+                      "from a single event loop")
+    parser.add_option("--workers", type=int, default=0, metavar="N",
+                      help="with --engine asyncio, serve connections from N "
+                      "worker processes that share the listening port")
     parser.add_option("--target-config", metavar="FILE",
                       dest="target_cfg",
                       help="Configuration file containing valid targets "
@@ -553,6 +873,17 @@ def websockify_init():
     parser.add_option("--token-source", default=None, metavar="ARG",
                       help="an argument to be passed to the token plugin "
                            "on instantiation")
+    parser.add_option("--token-cache", default=None,
+                      metavar="TTL[,SIZE[,MISS_TTL]]",
+                      help="keep targets found by the token plugin for TTL "
+                      "seconds, for up to SIZE tokens (default 10000), and "
+                      "tokens that were not found for MISS_TTL seconds "
+                      "(default 0)")
+    parser.add_option("--token-api-timeout", default=None,
+                      metavar="CONNECT[,READ]",
+                      help="seconds to wait for a connection to the API of "
+                      "JSONTokenApi and similar token plugins, and for its "
+                      "response (default 3,5)")
     parser.add_option("--host-token", action="store_true",
                       help="use the host HTTP header as token instead of the "
                            "token URL query parameter")
@@ -564,6 +895,67 @@ def websockify_init():
                            "on instantiation")
     parser.add_option("--heartbeat", type=int, default=0, metavar="INTERVAL",
                       help="send a ping to the client every INTERVAL seconds")
+    parser.add_option("--min-read-size", type=int, default=4096, metavar="BYTES",
+                      help="smallest amount of data to read from a socket at "
+                      "a time (default 4096)")
+    parser.add_option("--max-read-size", type=int, default=None, metavar="BYTES",
+                      help="largest amount of data to read from a socket at "
+                      "a time, used while there is a lot of traffic "
+                      "(default 65536)")
+    parser.add_option("--client-queue-high", type=int, default=4194304,
+                      metavar="BYTES",
+                      help="stop reading from the target while this much "
+                      "data is waiting to be sent to the client, 0 for no "
+                      "limit (default 4194304)")
+    parser.add_option("--client-queue-low", type=int, default=1048576,
+                      metavar="BYTES",
+                      help="resume reading from the target once the data "
+                      "waiting for the client is down to this (default "
+                      "1048576)")
+    parser.add_option("--target-queue-high", type=int, default=4194304,
+                      metavar="BYTES",
+                      help="stop reading from the client while this much "
+                      "data is waiting to be sent to the target, 0 for no "
+                      "limit (default 4194304)")
+    parser.add_option("--target-queue-low", type=int, default=1048576,
+                      metavar="BYTES",
+                      help="resume reading from the client once the data "
+                      "waiting for the target is down to this (default "
+                      "1048576)")
+    parser.add_option("--coalesce-size", type=int, default=0,
+                      metavar="BYTES",
+                      help="merge data from the target into WebSocket "
+                      "messages of up to BYTES, 0 to send it as it is read "
+                      "(default 0)")
+    parser.add_option("--coalesce-delay", type=int, default=0,
+                      metavar="USEC",
+                      help="with --coalesce-size, hold data from the target "
+                      "back for up to USEC microseconds while more arrives "
+                      "(default 0)")
+    parser.add_option("--flush-policy", default="immediate", metavar="POLICY",
+                      help="how data is written to the client: immediate "
+                      "(default), as soon as it is read, cork, in full TCP "
+                      "segments using TCP_CORK, or batch:USEC, corked and "
+                      "held back for up to USEC microseconds. Token plugins "
+                      "can override this per target")
+    parser.add_option("--compression-level", type=int, default=0,
+                      metavar="LEVEL",
+                      help="compress messages with permessage-deflate for "
+                      "clients that support it, at zlib LEVEL 1-9, or 0 "
+                      "not to (default 0)")
+    parser.add_option("--compression-threshold", type=int, default=128,
+                      metavar="BYTES",
+                      help="send messages smaller than BYTES uncompressed "
+                      "(default 128)")
+    parser.add_option("--compression-window-bits", type=int, default=15,
+                      metavar="BITS",
+                      help="largest compression window to use, 9-15, "
+                      "where smaller windows use less memory (default 15)")
+    parser.add_option("--compression-no-context-takeover",
+                      action="store_true",
+                      help="compress every message on its own, which "
+                      "compresses less but keeps no compressor state between "
+                      "messages")
     parser.add_option("--log-file", metavar="FILE",
                       dest="log_file",
                       help="File where logs will be saved")
@@ -575,6 +967,13 @@ def websockify_init():
                            "Use this if the messages produced by websockify seem abnormal.")
     parser.add_option("--file-only", action="store_true",
                       help="use this to disable directory listings in web server.")
+    parser.add_option("--metrics-listen", default=None, metavar="[HOST:]PORT",
+                      help="serve metrics in the Prometheus text format on "
+                      "PORT (HOST defaults to localhost)")
+    parser.add_option("--mask-backend", default="auto", metavar="NAME",
+                      choices=["auto"] + list(masking.backends),
+                      help="implementation used for WebSocket masking: auto "
+                      "(default), %s" % ", ".join(masking.backends))
 
     (opts, args) = parser.parse_args()
 
@@ -594,12 +993,91 @@ def websockify_init():
     if opts.web_auth and not opts.web:
         parser.error("You must use --web to use --web-auth")
 
+    if opts.libserver and opts.engine != "fork":
+        parser.error("--libserver cannot be combined with --engine")
+
+    if opts.workers:
+        if opts.engine != "asyncio":
+            parser.error("You must use --engine asyncio to use --workers")
+        if opts.workers < 0:
+            parser.error("--workers must not be negative")
+        if opts.inetd or opts.unix_listen:
+            parser.error("--workers requires listening on a TCP port")
+        if opts.run_once:
+            parser.error("--run-once cannot be combined with --workers")
+        if not hasattr(socket, "SO_REUSEPORT"):
+            parser.error("--workers requires SO_REUSEPORT support")
+
     if opts.legacy_syslog and not opts.syslog:
         parser.error("You must use --syslog to use --legacy-syslog")
 
+    if opts.min_read_size <= 0 or (opts.max_read_size is not None and
+                                   opts.max_read_size < opts.min_read_size):
+        parser.error("--max-read-size must be at least --min-read-size, "
+                     "which must be positive")
+
+    for side in ("client", "target"):
+        high = getattr(opts, "%s_queue_high" % side)
+        low = getattr(opts, "%s_queue_low" % side)
+        if high < 0 or low < 0 or (high and low >= high):
+            parser.error("--%s-queue-low must be less than --%s-queue-high, "
+                         "and neither can be negative" % (side, side))
+
+    if opts.coalesce_size < 0 or opts.coalesce_delay < 0:
+        parser.error("--coalesce-size and --coalesce-delay cannot be "
+                     "negative")
+
+    if opts.coalesce_delay and not opts.coalesce_size:
+        parser.error("You must use --coalesce-size to use --coalesce-delay")
+
+    if not 0 <= opts.compression_level <= 9:
+        parser.error("--compression-level must be between 0 and 9")
+
+    if not 9 <= opts.compression_window_bits <= 15:
+        parser.error("--compression-window-bits must be between 9 and 15")
+
+    if opts.compression_threshold < 0:
+        parser.error("--compression-threshold cannot be negative")
+
+    if opts.ssl_ticket_rotation is None:
+        opts.ssl_ticket_rotation = 0 if opts.workers else 3600
+    elif opts.ssl_ticket_rotation < 0:
+        parser.error("--ssl-ticket-rotation cannot be negative")
+    elif opts.ssl_ticket_rotation and opts.workers:
+        # Each worker would get a key of its own, so clients could
+        # not resume their sessions with the other workers
+        parser.error("--ssl-ticket-rotation cannot be combined with "
+                     "--workers")
+
+    try:
+        parse_flush_policy(opts.flush_policy)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if opts.flush_policy != "immediate" and not hasattr(socket, "TCP_CORK"):
+        parser.error("--flush-policy %s requires TCP_CORK support"
+                     % opts.flush_policy)
+
     opts.ssl_options = select_ssl_version(opts.ssl_version)
     del opts.ssl_version
 
+    masking.select_backend(opts.mask_backend)
+    del opts.mask_backend
+
+    if opts.metrics_listen:
+        if opts.libserver:
+            parser.error("--metrics-listen cannot be combined with --libserver")
+        if opts.metrics_listen.count(':') > 0:
+            metrics_host, metrics_port = opts.metrics_listen.rsplit(':', 1)
+            metrics_host = metrics_host.strip('[]')
+        else:
+            metrics_host, metrics_port = 'localhost', opts.metrics_listen
+        try:
+            metrics_port = int(metrics_port)
+        except ValueError:
+            parser.error("Error parsing metrics port")
+        opts.metrics_listen = (metrics_host, metrics_port)
+
     if opts.log_file:
         # Setup logging to user-specified file.
         opts.log_file = os.path.abspath(opts.log_file)
@@ -734,7 +1212,35 @@ def websockify_init():
 
         opts.token_plugin = token_plugin_cls(opts.token_source)
 
+        if opts.token_api_timeout:
+            if not hasattr(opts.token_plugin, 'timeout'):
+                parser.error("--token-api-timeout only works with token "
+                             "plugins that use an HTTP API")
+            try:
+                timeout = [float(t) for t in opts.token_api_timeout.split(',')]
+                if len(timeout) > 2 or min(timeout) <= 0:
+                    raise ValueError
+            except ValueError:
+                parser.error("--token-api-timeout must be CONNECT[,READ] "
+                             "with positive values")
+            opts.token_plugin.timeout = (timeout[0], timeout[-1])
+
+        if opts.token_cache:
+            from websockify.token_plugins import TokenCache
+            try:
+                cache = parse_token_cache(opts.token_cache)
+            except ValueError:
+                parser.error("--token-cache must be TTL[,SIZE[,MISS_TTL]] "
+                             "with a positive TTL and SIZE")
+            opts.token_plugin = TokenCache(opts.token_plugin, *cache)
+    elif opts.token_cache:
+        parser.error("You must use --token-plugin to use --token-cache")
+    elif opts.token_api_timeout:
+        parser.error("You must use --token-plugin to use --token-api-timeout")
+
     del opts.token_source
+    del opts.token_cache
+    del opts.token_api_timeout
 
     if opts.auth_plugin is not None:
         if '.' not in opts.auth_plugin:
@@ -752,10 +1258,19 @@ def websockify_init():
     # Create and start the WebSockets proxy
     libserver = opts.libserver
     del opts.libserver
+    engine = opts.engine
+    del opts.engine
+    if engine != "asyncio":
+        del opts.workers
     if libserver:
         # Use standard Python SocketServer framework
         server = LibProxyServer(**opts.__dict__)
         server.serve_forever()
+    elif engine == "asyncio":
+        # Serve all connections from one event loop
+        from websockify.asyncioproxy import AsyncioProxyServer
+        server = AsyncioProxyServer(**opts.__dict__)
+        server.start_server()
     else:
         # Use internal service framework
         server = WebSocketProxy(**opts.__dict__)
@@ -779,6 +1294,15 @@ class LibProxyServer(ThreadingMixIn, HTTPServer):
         self.token_plugin = kwargs.pop('token_plugin', None)
         self.auth_plugin = kwargs.pop('auth_plugin', None)
         self.heartbeat = kwargs.pop('heartbeat', None)
+        self.min_read_size = kwargs.pop('min_read_size', 4096)
+        self.max_read_size = kwargs.pop('max_read_size', None)
+        self.client_queue_high = kwargs.pop('client_queue_high', 4194304)
+        self.client_queue_low = kwargs.pop('client_queue_low', 1048576)
+        self.target_queue_high = kwargs.pop('target_queue_high', 4194304)
+        self.target_queue_low = kwargs.pop('target_queue_low', 1048576)
+        self.coalesce_size = kwargs.pop('coalesce_size', 0)
+        self.coalesce_delay = kwargs.pop('coalesce_delay', 0)
+        self.flush_policy = kwargs.pop('flush_policy', 'immediate')
 
         self.token_plugin = None
         self.auth_plugin = None
@@ -796,6 +1320,11 @@ class LibProxyServer(ThreadingMixIn, HTTPServer):
         if record:
             self.record = os.path.abspath(record)
         self.run_once = kwargs.pop('run_once', False)
+        self.compression_level = kwargs.pop('compression_level', 0)
+        self.compression_threshold = kwargs.pop('compression_threshold', 128)
+        self.compression_window_bits = kwargs.pop('compression_window_bits', 15)
+        self.compression_no_context_takeover = kwargs.pop(
+            'compression_no_context_takeover', False)
         self.handler_id = 0
 
         for arg in kwargs.keys():
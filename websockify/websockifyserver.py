@@ -40,9 +40,35 @@ if sys.platform == 'win32':
     # make sockets pickle-able/inheritable
     import multiprocessing.reduction
 
+from websockify import deflate
+from websockify import masking
+from websockify import metrics
 from websockify.websocket import WebSocketWantReadError, WebSocketWantWriteError
 from websockify.websocketserver import WebSocketRequestHandlerMixIn
 
+# Linux kernel TLS socket options, which older Pythons do not have
+SOL_TLS = getattr(socket, 'SOL_TLS', 282)
+TLS_TX = getattr(socket, 'TLS_TX', 1)
+TLS_RX = getattr(socket, 'TLS_RX', 2)
+
+
+def ktls_offload(sock):
+    """
+    Returns in which directions the kernel does the TLS encryption for
+    a socket: "tx+rx", "tx", "rx" or "off".
+    """
+    if not sys.platform.startswith('linux'):
+        return "off"
+    directions = []
+    for name, opt in (("tx", TLS_TX), ("rx", TLS_RX)):
+        try:
+            # Fails unless the keys have been handed to the kernel
+            sock.getsockopt(SOL_TLS, opt, 4)
+        except OSError:
+            continue
+        directions.append(name)
+    return "+".join(directions) or "off"
+
 
 class CompatibleWebSocket(WebSocketRequestHandlerMixIn.SocketClass):
     def select_subprotocol(self, protocols):
@@ -52,6 +78,18 @@ class CompatibleWebSocket(WebSocketRequestHandlerMixIn.SocketClass):
         else:
             return ''
 
+    def select_compression(self, offers):
+        server = self.request_handler.server
+        level = getattr(server, "compression_level", 0)
+        if not level:
+            return None
+        return deflate.negotiate(
+            offers, level,
+            threshold=getattr(server, "compression_threshold", 128),
+            window_bits=getattr(server, "compression_window_bits", 15),
+            no_context_takeover=getattr(
+                server, "compression_no_context_takeover", False))
+
 
 # HTTP handler with WebSocket upgrade support
 class WebSockifyRequestHandler(WebSocketRequestHandlerMixIn, SimpleHTTPRequestHandler):
@@ -68,6 +106,9 @@ class WebSockifyRequestHandler(WebSocketRequestHandlerMixIn, SimpleHTTPRequestHa
     * record: Record raw frame data as JavaScript array into specified filename
     * run_once: Handle a single request
     * handler_id: A sequence number for this connection, appended to record filename
+    * coalesce_size: If set, data queued by send_frames() is a byte stream
+      and is merged into messages of up to this many bytes
+    * ssl_ktls: If true, report whether kernel TLS is used for SSL clients
     """
     server_version = "WebSockify"
 
@@ -92,6 +133,8 @@ class WebSockifyRequestHandler(WebSocketRequestHandlerMixIn, SimpleHTTPRequestHa
         self.traffic = getattr(server, "traffic", False)
         self.web_auth = getattr(server, "web_auth", False)
         self.host_token = getattr(server, "host_token", False)
+        self.coalesce_size = getattr(server, "coalesce_size", 0)
+        self.ssl_ktls = getattr(server, "ssl_ktls", False)
 
         self.logger = getattr(server, "logger", None)
         if self.logger is None:
@@ -145,19 +188,55 @@ class WebSockifyRequestHandler(WebSocketRequestHandlerMixIn, SimpleHTTPRequestHa
                     # Python 3 compatible conversion
                     bufstr = buf.decode('latin1').encode('unicode_escape').decode('ascii').replace("'", "\\'")
                     self.rec.write("'{{{0}{{{1}',\n".format(tdelta, bufstr))
-                self.send_parts.append(buf)
+            self.queue_parts(bufs)
+            metrics.send_queue_depth.observe(len(self.send_parts))
 
+        sent = []
         while self.send_parts:
             # Send pending frames
             try:
                 self.request.sendmsg(self.send_parts[0])
             except WebSocketWantWriteError:
+                self.send_blocked = True
                 self.print_traffic("<.")
-                return True
-            self.send_parts.pop(0)
+                break
+            self.send_blocked = False
+            sent.append(self.send_parts.pop(0))
             self.print_traffic("<")
 
-        return False
+        if sent:
+            metrics.messages.inc(len(sent), ("sent",))
+            metrics.message_bytes.inc(sum(len(buf) for buf in sent),
+                                      ("sent",))
+
+        return len(self.send_parts) > 0
+
+    def queue_parts(self, bufs):
+        """ Queue data for send_frames(). With coalesce_size set the
+        data is merged into as few messages as possible. """
+
+        if not self.coalesce_size:
+            self.send_parts.extend(bufs)
+            return
+
+        merged = []
+        size = 0
+        # A message that could not be sent must be sent again as it
+        # was, but anything queued after it can still grow
+        if len(self.send_parts) > (1 if self.send_blocked else 0):
+            merged.append(self.send_parts.pop())
+            size = len(merged[0])
+
+        for buf in bufs:
+            if merged and size + len(buf) > self.coalesce_size:
+                self.send_parts.append(b''.join(merged))
+                merged = []
+                size = 0
+            merged.append(buf)
+            size += len(buf)
+
+        if merged:
+            self.send_parts.append(b''.join(merged))
 
     def recv_frames(self):
         """ Receive and decode WebSocket frames.
@@ -194,10 +273,16 @@ class WebSockifyRequestHandler(WebSocketRequestHandlerMixIn, SimpleHTTPRequestHa
             if not self.request.pending():
                 break
 
+        if bufs:
+            metrics.messages.inc(len(bufs), ("received",))
+            metrics.message_bytes.inc(sum(len(buf) for buf in bufs),
+                                      ("received",))
+
         return bufs, closed
 
     def send_close(self, code=1000, reason=''):
         """ Send a WebSocket orderly close frame. """
+        metrics.closes.inc(labels=(code,))
         self.request.shutdown(socket.SHUT_RDWR, code, reason)
 
     def send_pong(self, data=b''):
@@ -216,10 +301,30 @@ class WebSockifyRequestHandler(WebSocketRequestHandlerMixIn, SimpleHTTPRequestHa
         super().handle_upgrade()
 
     def handle_websocket(self):
+        self.setup_websocket()
+
+        metrics.sessions.inc()
+        try:
+            self.new_websocket_client()
+        except self.CClose:
+            # Close the client
+            _, exc, _ = sys.exc_info()
+            self.send_close(exc.args[0], exc.args[1])
+        finally:
+            metrics.sessions.dec()
+
+    def setup_websocket(self):
         # Indicate to server that a Websocket upgrade was done
         self.server.ws_connection = True
+
+        metrics.handshakes.inc()
+        accept_time = getattr(self.server, 'accept_time', None)
+        if accept_time is not None:
+            metrics.handshake_seconds.observe(time.monotonic() - accept_time)
+
         # Initialize per client settings
         self.send_parts = []
+        self.send_blocked = False
         self.recv_part = None
         self.start_time = int(time.time() * 1000)
 
@@ -233,7 +338,12 @@ class WebSockifyRequestHandler(WebSocketRequestHandlerMixIn, SimpleHTTPRequestHa
             pass
 
         if is_ssl:
-            self.stype = "SSL/TLS (wss://)"
+            offload = ktls_offload(self.request) if self.ssl_ktls else "off"
+            metrics.tls_sessions.inc(labels=(offload,))
+            if self.ssl_ktls:
+                self.stype = "SSL/TLS (wss://, kernel TLS %s)" % offload
+            else:
+                self.stype = "SSL/TLS (wss://)"
         else:
             self.stype = "Plain non-SSL (ws://)"
 
@@ -250,13 +360,6 @@ class WebSockifyRequestHandler(WebSocketRequestHandlerMixIn, SimpleHTTPRequestHa
             self.rec = open(fname, 'w+')
             self.rec.write("var VNC_frame_data = [\n")
 
-        try:
-            self.new_websocket_client()
-        except self.CClose:
-            # Close the client
-            _, exc, _ = sys.exc_info()
-            self.send_close(exc.args[0], exc.args[1])
-
     def do_GET(self):
         if self.web_auth:
             # ensure connection is authorized, this seems to apply to list_directory() as well
@@ -354,7 +457,11 @@ class WebSockifyServer():
                  run_once=False, timeout=0, idle_timeout=0, traffic=False,
                  tcp_keepalive=True, tcp_keepcnt=None, tcp_keepidle=None,
                  tcp_keepintvl=None, ssl_ciphers=None, ssl_options=0,
-                 unix_listen=None, unix_listen_mode=None):
+                 unix_listen=None, unix_listen_mode=None,
+                 metrics_listen=None, compression_level=0,
+                 compression_threshold=128, compression_window_bits=15,
+                 compression_no_context_takeover=False,
+                 ssl_ticket_rotation=3600, ssl_ktls=False):
 
         # settings
         self.RequestHandlerClass = RequestHandlerClass
@@ -368,6 +475,8 @@ class WebSockifyServer():
         self.ssl_only = ssl_only
         self.ssl_ciphers = ssl_ciphers
         self.ssl_options = ssl_options
+        self.ssl_ticket_rotation = ssl_ticket_rotation
+        self.ssl_ktls = ssl_ktls
         self.verify_client = verify_client
         self.daemon = daemon
         self.run_once = run_once
@@ -376,12 +485,25 @@ class WebSockifyServer():
         self.traffic = traffic
         self.file_only = file_only
         self.web_auth = web_auth
+        self.metrics_listen = metrics_listen
+        self.compression_level = compression_level
+        self.compression_threshold = compression_threshold
+        self.compression_window_bits = compression_window_bits
+        self.compression_no_context_takeover = compression_no_context_takeover
 
         self.launch_time = time.time()
         self.ws_connection = False
         self.handler_id = 1
+        # When the connection being handled was accepted
+        self.accept_time = None
         self.terminating = False
 
+        # Kept between connections, see ssl_context()
+        self._ssl_context = None
+        self._ssl_context_files = None
+        self._ssl_context_time = None
+        self._ssl_reload = False
+
         self.logger = self.get_logger()
         self.tcp_keepalive = tcp_keepalive
         self.tcp_keepcnt = tcp_keepcnt
@@ -433,14 +555,25 @@ class WebSockifyServer():
                 self.msg("  - SSL/TLS support")
                 if self.ssl_only:
                     self.msg("  - Deny non-SSL/TLS connections")
+                if self.ssl_ktls:
+                    if hasattr(ssl, 'OP_ENABLE_KTLS'):
+                        self.msg("  - Kernel TLS offload, where supported")
+                    else:
+                        self.msg("  - No kernel TLS offload (needs Python 3.12 or newer)")
             else:
                 self.msg("  - No SSL/TLS support (no cert file)")
         else:
             self.msg("  - No SSL/TLS support (no 'ssl' module)")
+        self.msg("  - WebSocket masking: %s", masking.backend())
+        if self.compression_level:
+            self.msg("  - Compression: permessage-deflate level %d",
+                     self.compression_level)
         if self.daemon:
             self.msg("  - Backgrounding (daemon)")
         if self.record:
             self.msg("  - Recording to '%s.*'", self.record)
+        if self.metrics_listen:
+            self.msg("  - Metrics on %s:%s", *self.metrics_listen)
 
     #
     # WebSockifyServer static methods
@@ -452,14 +585,40 @@ class WebSockifyServer():
             WebSockifyServer.log_prefix,
             WebSockifyServer.__class__.__name__))
 
+    @staticmethod
+    def cert_expiry(path):
+        """ Returns when the first certificate in a PEM file expires,
+        or None if that cannot be determined. """
+        # The ssl module cannot read a certificate, but the cryptography
+        # package usually comes along with jwcrypto
+        try:
+            from cryptography import x509
+
+            with open(path) as f:
+                data = f.read()
+            start = data.index('-----BEGIN CERTIFICATE-----')
+            end = data.index('-----END CERTIFICATE-----', start)
+            der = ssl.PEM_cert_to_DER_cert(
+                data[start:end + len('-----END CERTIFICATE-----')])
+            cert = x509.load_der_x509_certificate(der)
+            expiry = getattr(cert, 'not_valid_after_utc', None)
+            if expiry is None:
+                expiry = cert.not_valid_after
+        except Exception:
+            return None
+        return expiry.strftime('%Y-%m-%d %H:%M:%S UTC')
+
     @staticmethod
     def socket(host, port=None, connect=False, prefer_ipv6=False,
                unix_socket=None, unix_socket_mode=None, unix_socket_listen=False,
                use_ssl=False, tcp_keepalive=True, tcp_keepcnt=None,
-               tcp_keepidle=None, tcp_keepintvl=None):
+               tcp_keepidle=None, tcp_keepintvl=None, reuse_port=False):
         """ Resolve a host (and optional port) to an IPv4 or IPv6
         address. Create a socket. Bind to it if listen is set,
         otherwise connect to it. Return the socket.
+
+        If reuse_port is set, several processes can listen on the same
+        port at once and the kernel spreads the connections over them.
         """
         flags = 0
         if host == '':
@@ -502,6 +661,8 @@ class WebSockifyServer():
                     sock = context.wrap_socket(sock, server_hostname=host)
             else:
                 sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if reuse_port:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
                 sock.bind(addrs[0][4])
                 sock.listen(100)
         else:
@@ -590,46 +751,15 @@ class WebSockifyServer():
         # to SSL wrap the socket first
         handshake = sock.recv(1024, socket.MSG_PEEK)
 
-        if not handshake:
-            raise self.EClose("")
-
-        elif handshake[0] in (22, 128):
-            # SSL wrap the connection
-            if not ssl:
-                raise self.EClose("SSL connection but no 'ssl' module")
-            if not os.path.exists(self.cert):
-                raise self.EClose("SSL connection but '%s' not found"
-                                  % self.cert)
+        if self.is_ssl_handshake(handshake):
             retsock = None
             try:
-                # create new-style SSL wrapping for extended features
-                context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-                if self.ssl_ciphers is not None:
-                    context.set_ciphers(self.ssl_ciphers)
-                context.options = self.ssl_options
-                context.load_cert_chain(certfile=self.cert, keyfile=self.key, password=self.key_password)
-                if self.verify_client:
-                    context.verify_mode = ssl.CERT_REQUIRED
-                    if self.cafile:
-                        context.load_verify_locations(cafile=self.cafile)
-                    else:
-                        context.set_default_verify_paths()
-                retsock = context.wrap_socket(
+                retsock = self.ssl_context().wrap_socket(
                     sock,
                     server_side=True)
             except ssl.SSLError:
                 _, x, _ = sys.exc_info()
-                if x.args[0] == ssl.SSL_ERROR_EOF:
-                    if len(x.args) > 1:
-                        raise self.EClose(x.args[1])
-                    else:
-                        raise self.EClose("Got SSL_ERROR_EOF")
-                else:
-                    raise
-
-        elif self.ssl_only:
-            raise self.EClose("non-SSL connection received but disallowed")
-
+                self.ssl_error(x)
         else:
             retsock = sock
 
@@ -644,6 +774,131 @@ class WebSockifyServer():
         # Return the WebSockets socket which may be SSL wrapped
         return retsock
 
+    def is_ssl_handshake(self, data):
+        """
+        Looks at the first bytes received from a client and returns
+        True if they start an SSL/TLS handshake. Raises EClose if the
+        connection cannot be accepted.
+        """
+        if not data:
+            raise self.EClose("")
+
+        if data[0] in (22, 128):
+            if not ssl:
+                raise self.EClose("SSL connection but no 'ssl' module")
+            if not os.path.exists(self.cert):
+                raise self.EClose("SSL connection but '%s' not found"
+                                  % self.cert)
+            return True
+
+        if self.ssl_only:
+            raise self.EClose("non-SSL connection received but disallowed")
+
+        return False
+
+    def create_ssl_context(self):
+        """ Returns the SSL context used to wrap client connections. """
+        # create new-style SSL wrapping for extended features
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        if self.ssl_ciphers is not None:
+            context.set_ciphers(self.ssl_ciphers)
+        context.options = self.ssl_options
+        if self.ssl_ktls and hasattr(ssl, 'OP_ENABLE_KTLS'):
+            # OpenSSL falls back to doing the encryption itself if the
+            # kernel or the cipher does not support it
+            context.options |= ssl.OP_ENABLE_KTLS
+        context.load_cert_chain(certfile=self.cert, keyfile=self.key, password=self.key_password)
+        if self.verify_client:
+            context.verify_mode = ssl.CERT_REQUIRED
+            if self.cafile:
+                context.load_verify_locations(cafile=self.cafile)
+            else:
+                context.set_default_verify_paths()
+        return context
+
+    def ssl_context(self):
+        """
+        Returns the SSL context used to wrap client connections. It is
+        created by create_ssl_context() on first use, and then kept up
+        to date by update_ssl_context().
+
+        The context holds the key that encrypts TLS session tickets, so
+        clients can resume their sessions with any process that is
+        forked after it was created.
+        """
+        if self._ssl_context is None:
+            self._ssl_context = self.create_ssl_context()
+            self._ssl_context_files = self._ssl_files()
+            self._ssl_context_time = time.monotonic()
+        return self._ssl_context
+
+    def _ssl_files(self):
+        # Identifies the versions of the files the context is made from
+        stamps = []
+        for path in (self.cert, self.key, self.cafile):
+            try:
+                st = os.stat(path) if path else None
+            except OSError:
+                st = None
+            stamps.append(st and (st.st_ino, st.st_size, st.st_mtime_ns))
+        return stamps
+
+    def update_ssl_context(self):
+        """
+        Run periodically while waiting for connections. Replaces the SSL
+        context when the certificate, key or CA file has changed, when
+        a reload was requested with request_ssl_reload(), or when it is
+        older than ssl_ticket_rotation seconds. If the files cannot be
+        loaded, the old context stays in use.
+        """
+        if not ssl or not os.path.isfile(self.cert):
+            return
+
+        files = self._ssl_files()
+        now = time.monotonic()
+        changed = self._ssl_reload or files != self._ssl_context_files
+        expired = (self._ssl_context is not None and
+                   self.ssl_ticket_rotation and
+                   now - self._ssl_context_time >= self.ssl_ticket_rotation)
+        if not changed and not expired:
+            return
+
+        self._ssl_reload = False
+        self._ssl_context_files = files
+        self._ssl_context_time = now
+        try:
+            context = self.create_ssl_context()
+        except (OSError, ssl.SSLError) as e:
+            # Tried again when the files change
+            self.warn("Loading SSL certificate '%s' failed: %s",
+                      self.cert, e)
+            return
+
+        if not changed:
+            self.vmsg("Replaced SSL session ticket key")
+        else:
+            self.msg("%s SSL certificate '%s', expires %s",
+                     "Loaded" if self._ssl_context is None else "Reloaded",
+                     self.cert, self.cert_expiry(self.cert) or "unknown")
+        self._ssl_context = context
+
+    def request_ssl_reload(self):
+        """
+        Makes the next update_ssl_context() load the certificate again,
+        even if the files seem unchanged.
+        """
+        self._ssl_reload = True
+
+    def ssl_error(self, exc):
+        """ Turns an SSL error during the handshake into EClose, if it
+        is just the client going away. Other errors are raised again. """
+        if exc.args[0] == ssl.SSL_ERROR_EOF:
+            if len(exc.args) > 1:
+                raise self.EClose(exc.args[1])
+            else:
+                raise self.EClose("Got SSL_ERROR_EOF")
+        raise exc
+
     #
     # WebSockifyServer logging/output functions
     #
@@ -704,10 +959,14 @@ class WebSockifyServer():
         #       calling `log` in the signal handlers
         self.terminate()
 
+    def do_SIGHUP(self, sig, stack):
+        self.request_ssl_reload()
+
     def top_new_client(self, startsock, address):
         """ Do something with a WebSockets client connection. """
         # handler process
         client = None
+        metrics.connections.inc()
         try:
             try:
                 client = self.do_handshake(startsock, address)
@@ -729,6 +988,10 @@ class WebSockifyServer():
                 # Original socket closed by caller
                 client.close()
 
+            # Pass on what a handler process has collected before it
+            # exits
+            metrics.REGISTRY.flush()
+
     def get_log_fd(self):
         """
         Get file descriptors for the loggers.
@@ -741,14 +1004,27 @@ class WebSockifyServer():
 
         return descriptors
 
-    def start_server(self):
+    def start_metrics(self):
         """
-        Daemonize if requested. Listen for for connections. Run
-        do_handshake() method for each connection. If the connection
-        is a WebSockets client then call new_websocket_client() method (which must
-        be overridden) for each new client connection.
+        Starts serving metrics, if configured. Must be called after
+        daemonizing, but before any handler processes are started.
         """
+        if not self.metrics_listen:
+            return
 
+        host, port = self.metrics_listen
+        try:
+            metrics.REGISTRY.start_server(host, port)
+        except OSError as e:
+            self.msg("Opening metrics socket failed: %s", str(e))
+            self.vmsg("exception", exc_info=True)
+            sys.exit()
+
+    def listen_socket(self, reuse_port=False):
+        """
+        Creates the socket to accept connections on, as configured.
+        Exits if the socket cannot be opened.
+        """
         try:
             if self.listen_fd is not None:
                 lsock = socket.fromfd(self.listen_fd, socket.AF_INET, socket.SOCK_STREAM)
@@ -763,18 +1039,33 @@ class WebSockifyServer():
                                     tcp_keepalive=self.tcp_keepalive,
                                     tcp_keepcnt=self.tcp_keepcnt,
                                     tcp_keepidle=self.tcp_keepidle,
-                                    tcp_keepintvl=self.tcp_keepintvl)
+                                    tcp_keepintvl=self.tcp_keepintvl,
+                                    reuse_port=reuse_port)
         except OSError as e:
             self.msg("Opening socket failed: %s", str(e))
             self.vmsg("exception", exc_info=True)
             sys.exit()
 
+        return lsock
+
+    def start_server(self):
+        """
+        Daemonize if requested. Listen for for connections. Run
+        do_handshake() method for each connection. If the connection
+        is a WebSockets client then call new_websocket_client() method (which must
+        be overridden) for each new client connection.
+        """
+
+        lsock = self.listen_socket()
+
         if self.daemon:
             keepfd = self.get_log_fd()
             keepfd.append(lsock.fileno())
             self.daemonize(keepfd=keepfd, chdir=self.web)
 
+        self.start_metrics()
         self.started()  # Some things need to happen after daemonizing
+        self.update_ssl_context()
 
         # Allow override of signals
         original_signals = {
@@ -785,6 +1076,9 @@ class WebSockifyServer():
             original_signals[signal.SIGCHLD] = signal.getsignal(signal.SIGCHLD)
         signal.signal(signal.SIGINT, self.do_SIGINT)
         signal.signal(signal.SIGTERM, self.do_SIGTERM)
+        if getattr(signal, 'SIGHUP', None) is not None:
+            original_signals[signal.SIGHUP] = signal.getsignal(signal.SIGHUP)
+            signal.signal(signal.SIGHUP, self.do_SIGHUP)
         # make sure that _cleanup is called when children die
         # by calling active_children on SIGCHLD
         if getattr(signal, 'SIGCHLD', None) is not None:
@@ -823,10 +1117,12 @@ class WebSockifyServer():
 
                         try:
                             self.poll()
+                            self.update_ssl_context()
 
                             ready = select.select([lsock], [], [], 1)[0]
                             if lsock in ready:
                                 startsock, address = lsock.accept()
+                                self.accept_time = time.monotonic()
                                 # Unix Socket will not report address (empty string), but address[0] is logged a bunch
                                 if self.unix_listen is not None:
                                     address = [self.unix_listen]